@@ -21,6 +21,17 @@ from pytest_wdl import fixtures
 import pytest
 
 
+def pytest_addoption(parser):
+    group = parser.getgroup("wdl")
+    group.addoption(
+        "--wdl-offline",
+        action="store_true",
+        default=None,
+        help="Resolve remote test data files only from the cache, and fail "
+             "immediately if any of them are missing"
+    )
+
+
 user_config_file = pytest.fixture(scope="session")(fixtures.user_config_file)
 user_config = pytest.fixture(scope="session")(fixtures.user_config)
 project_root_files = pytest.fixture(scope="module")(fixtures.project_root_files)
@@ -29,6 +40,12 @@ workflow_data_descriptor_file = pytest.fixture(scope="module")(fixtures.workflow
 workflow_data_descriptors = pytest.fixture(scope="module")(fixtures.workflow_data_descriptors)
 workflow_data_resolver = pytest.fixture(scope="module")(fixtures.workflow_data_resolver)
 workflow_data = pytest.fixture(scope="function")(fixtures.workflow_data)
+workflow_data_offline_check = pytest.fixture(scope="session", autouse=True)(
+    fixtures.workflow_data_offline_check
+)
+workflow_data_prefetch = pytest.fixture(scope="session", autouse=True)(
+    fixtures.workflow_data_prefetch
+)
 import_paths = pytest.fixture(scope="module")(fixtures.import_paths)
 import_dirs = pytest.fixture(scope="module")(fixtures.import_dirs)
 workflow_runner = pytest.fixture(scope="function")(fixtures.workflow_runner)
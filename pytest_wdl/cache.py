@@ -0,0 +1,1041 @@
+#    Copyright 2019 Eli Lilly and Company
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Management of the directory in which localized data files are cached.
+
+Files whose digest is known are stored by content, under
+`<cache_dir>/.objects/<algorithm>/<xx>/<digest>`, and the named entries that
+tests request are links to the stored objects. Thus, descriptors that refer to
+the same content under different names share a single copy of the file. Named
+entries are symbolic links by default; with other link strategies (see
+:func:`pytest_wdl.utils.link_file`) an entry may instead be a hard link to, or a
+clone or copy of, the object, and all the names of a hard-linked file are
+evicted together.
+
+The cache can be bounded in size and/or age. The last access time of each cached
+file is recorded (by explicitly setting its atime, which works regardless of the
+mount options of the file system), and the least recently used files are evicted
+first. Files that are used by the current session are never evicted, nor (if the
+cache has a catalog) are files used since the start of the oldest other session
+that is still running.
+
+Metadata about files downloaded from URLs (e.g. the ETag and Last-Modified
+response headers) is stored in a sidecar file next to each file (with the suffix
+".meta.json"), and is used to revalidate cached files with conditional requests.
+
+Each file in a persistent or bounded cache is recorded in a catalog (an SQLite
+database in the cache directory, ".catalog.sqlite") along with its source,
+size, modification time, inode, digest, last access time, and download
+duration, so that lookups, eviction, and statistics do not require walking the
+cache directory. The catalog also records the named entries that link to each
+object, and the temporary files of each download (which may be left behind if
+the download is interrupted), and memoizes the digests of cached files, so that
+a file is only hashed again if its inode, size, or modification time has
+changed. Files that are in the cache directory when the catalog is created are
+added to it. The catalog is opened when it is first needed; if it cannot be
+opened (e.g. because the cache directory is read-only), the cache is used
+without it.
+
+A cache directory may be shared by concurrent processes (e.g. pytest-xdist
+workers). Each file is populated, and each named entry linked to
+its object, while holding a lock on it (see :class:`pytest_wdl.utils.FileLock`),
+so that it is downloaded only once. Eviction holds a lock on the cache
+directory, so that concurrent processes do not evict the same files. Each
+session that uses the catalog holds a lease in it, which it refreshes
+periodically (like a `FileLock`) and ends when the cache is closed, so that
+other sessions know which files it may be about to use.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Union
+
+from pytest_wdl.utils import (
+    DEFAULT_LOCK_STALE_AFTER, LINK_SYMLINK, LOCK_SUFFIX, LOG, PARTIAL_SUFFIX,
+    SEGMENTS_SUFFIX, VALIDATOR_SUFFIX, FileLock, file_digests, lease_expired,
+    lease_token, link_file
+)
+
+
+OBJECTS_DIR = ".objects"
+PREFERRED_DIGESTS = ("sha256", "sha512", "sha1", "md5")
+TEMP_SUFFIXES = (PARTIAL_SUFFIX, SEGMENTS_SUFFIX)
+METADATA_SUFFIX = ".meta.json"
+SECONDS_PER_DAY = 24 * 60 * 60
+REVALIDATE_NEVER = "never"
+REVALIDATE_SESSION = "session"
+CATALOG_FILE = ".catalog.sqlite"
+EVICT_LOCK_FILE = ".evict"
+"""Name of the file that is locked (see `FileLock`) while files are evicted."""
+CATALOG_TIMEOUT = 60
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    source TEXT,
+    size INTEGER,
+    mtime INTEGER,
+    dev INTEGER,
+    inode INTEGER,
+    digest TEXT,
+    last_access REAL,
+    download_seconds REAL
+);
+CREATE TABLE IF NOT EXISTS digests (
+    dev INTEGER,
+    inode INTEGER,
+    size INTEGER,
+    mtime INTEGER,
+    algorithm TEXT,
+    digest TEXT,
+    PRIMARY KEY (dev, inode, size, mtime, algorithm)
+);
+CREATE TABLE IF NOT EXISTS properties (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS links (
+    path TEXT PRIMARY KEY,
+    target TEXT
+);
+CREATE INDEX IF NOT EXISTS links_target ON links (target);
+CREATE TABLE IF NOT EXISTS temp_files (
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    token TEXT PRIMARY KEY,
+    started REAL,
+    refreshed REAL
+);
+"""
+
+
+class CatalogEntry(NamedTuple):
+    """
+    A file recorded in a :class:`Catalog`. `mtime` is in nanoseconds, and
+    `last_access` in seconds, since the epoch.
+    """
+    path: Path
+    source: Optional[str]
+    size: int
+    mtime: int
+    dev: int
+    inode: int
+    digest: Optional[str]
+    last_access: float
+    download_seconds: Optional[float]
+
+
+class Catalog:
+    """
+    SQLite database that records the files in a cache directory, and memoizes
+    the digests of the files in that directory. Safe to use from multiple threads
+    and processes.
+
+    Args:
+        path: The database file, in the cache directory; created if it does not
+            exist.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.root = path.parent.resolve()
+        self._conn = sqlite3.connect(
+            str(path), timeout=CATALOG_TIMEOUT, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript(CATALOG_SCHEMA)
+
+    def get(self, path: Path) -> Optional[CatalogEntry]:
+        """
+        Gets the catalog entry for a file.
+
+        Args:
+            path: The file.
+
+        Returns:
+            The entry, or None if the file is not in the catalog.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM entries WHERE path = ?", (str(path),)
+            ).fetchone()
+        return _entry(row) if row else None
+
+    def entries(self) -> List[CatalogEntry]:
+        """
+        Returns all the entries in the catalog, in order of last access.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM entries ORDER BY last_access"
+            ).fetchall()
+        return [_entry(row) for row in rows]
+
+    def record(
+        self,
+        path: Path,
+        source: Optional[str] = None,
+        digest: Optional[str] = None,
+        download_seconds: Optional[float] = None,
+        last_access: Optional[float] = None,
+        replace: bool = True
+    ) -> None:
+        """
+        Adds or updates the entry for a file, with its current size, modification
+        time, and inode. Values that are not given are kept from the existing
+        entry, except that the digest is discarded if the file has changed.
+
+        Args:
+            path: The file, which must exist.
+            source: Description of where the file came from, e.g. a URL.
+            digest: Digest of the file, as '<algorithm>:<hex digest>'.
+            download_seconds: How long it took to download the file.
+            last_access: Time the file was last used; defaults to now.
+            replace: Whether to update an existing entry; if False, only adds the
+                entry if it does not already exist.
+        """
+        stat = path.stat()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT * FROM entries WHERE path = ?", (str(path),)
+            ).fetchone()
+            if row:
+                if not replace:
+                    return
+                existing = _entry(row)
+                source = source or existing.source
+                if digest is None and (
+                    existing.size, existing.mtime, existing.dev, existing.inode
+                ) == (stat.st_size, stat.st_mtime_ns, stat.st_dev, stat.st_ino):
+                    digest = existing.digest
+                if download_seconds is None:
+                    download_seconds = existing.download_seconds
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(path), source, stat.st_size, stat.st_mtime_ns, stat.st_dev,
+                    stat.st_ino, digest,
+                    time.time() if last_access is None else last_access,
+                    download_seconds
+                )
+            )
+
+    def remove(self, path: Path) -> None:
+        """
+        Removes the entry for a file, if any, and the digests memoized for it, as
+        well as any record of the file as a link or temporary file.
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT dev, inode FROM entries WHERE path = ?", (str(path),)
+            ).fetchone()
+            if row:
+                self._conn.execute(
+                    "DELETE FROM digests WHERE dev = ? AND inode = ?", row
+                )
+            for table in ("entries", "links", "temp_files"):
+                self._conn.execute(
+                    f"DELETE FROM {table} WHERE path = ?", (str(path),)
+                )
+
+    def record_link(self, path: Path, target: Path) -> None:
+        """
+        Records that a named entry links to (or is a copy of) a stored object.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO links VALUES (?, ?)", (str(path), str(target))
+            )
+
+    def links_to(self, target: Path) -> List[Path]:
+        """
+        Returns the named entries recorded as links to a stored object.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path FROM links WHERE target = ?", (str(target),)
+            ).fetchall()
+        return [Path(row[0]) for row in rows]
+
+    def remove_links_to(self, target: Path) -> None:
+        """
+        Removes the records of the links to a stored object.
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM links WHERE target = ?", (str(target),))
+
+    def record_temp_file(self, path: Path) -> None:
+        """
+        Records a temporary file that may be written, e.g. by a download. The
+        file need not exist yet.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO temp_files VALUES (?)", (str(path),)
+            )
+
+    def temp_files(self) -> List[Path]:
+        """
+        Returns the recorded temporary files, which may no longer exist.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT path FROM temp_files").fetchall()
+        return [Path(row[0]) for row in rows]
+
+    def stats(self) -> dict:
+        """
+        Summarizes the cataloged files.
+
+        Returns:
+            Dict with keys 'files' (number of entries), 'size' (total size in
+            bytes, counting hard links to the same file once), and
+            'download_seconds' (total time spent downloading the files).
+        """
+        with self._lock:
+            files, download_seconds = self._conn.execute(
+                "SELECT COUNT(*), TOTAL(download_seconds) FROM entries"
+            ).fetchone()
+            size, = self._conn.execute(
+                "SELECT TOTAL(size) FROM "
+                "(SELECT DISTINCT dev, inode, size FROM entries)"
+            ).fetchone()
+        return {
+            "files": files,
+            "size": int(size),
+            "download_seconds": download_seconds
+        }
+
+    def digest(self, path: Path, algorithm: str = "md5") -> str:
+        """
+        Gets the digest of a file, computing it only if it has not been computed
+        since the file last changed. The digests of files outside the cache
+        directory (e.g. workflow outputs) are not memoized, since those files are
+        never removed from the catalog.
+
+        Args:
+            path: The file, which may be outside the cache directory.
+            algorithm: Name of a hash algorithm supported by `hashlib`.
+
+        Returns:
+            The hex digest.
+        """
+        if self.root not in path.resolve().parents:
+            return file_digests(path, [algorithm])[algorithm]
+        key = _digest_key(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest FROM digests WHERE dev = ? AND inode = ? AND "
+                "size = ? AND mtime = ? AND algorithm = ?",
+                key + (algorithm,)
+            ).fetchone()
+        if row:
+            return row[0]
+        digest = file_digests(path, [algorithm])[algorithm]
+        self._store_digest(key, algorithm, digest)
+        return digest
+
+    def store_digest(self, path: Path, algorithm: str, digest: str) -> None:
+        """
+        Memoizes a known digest of a file, e.g. one that was verified while the
+        file was downloaded.
+        """
+        self._store_digest(_digest_key(path), algorithm, digest.lower())
+
+    def _store_digest(self, key: tuple, algorithm: str, digest: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+                key + (algorithm, digest)
+            )
+
+    def start_session(self, token: str) -> None:
+        """
+        Records a session that uses the cache, identified by a lease token (see
+        :func:`pytest_wdl.utils.lease_token`).
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (token, now, now)
+            )
+
+    def refresh_session(self, token: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE sessions SET refreshed = ? WHERE token = ?",
+                (time.time(), token)
+            )
+
+    def end_session(self, token: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
+
+    def sessions(self) -> List[Tuple[str, float, float]]:
+        """
+        Returns the recorded sessions, as tuples (token, started, refreshed).
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT token, started, refreshed FROM sessions"
+            ).fetchall()
+
+    def get_property(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM properties WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_property(self, key: str, value: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO properties VALUES (?, ?)", (key, value)
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def _entry(row: tuple) -> CatalogEntry:
+    return CatalogEntry(Path(row[0]), *row[1:])
+
+
+def _stat_entry(path: Path) -> CatalogEntry:
+    stat = path.stat()
+    return CatalogEntry(
+        path, None, stat.st_size, stat.st_mtime_ns, stat.st_dev, stat.st_ino, None,
+        max(stat.st_atime, stat.st_mtime), None
+    )
+
+
+def _digest_key(path: Path) -> tuple:
+    stat = path.stat()
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class Cache:
+    """
+    Manages the files in a cache directory.
+
+    Args:
+        root: The cache directory.
+        max_size: Maximum total size of the cached files, in bytes.
+        max_age: Maximum time, in days, since a cached file was last used.
+        link_strategy: The most preferred strategy for exposing stored objects
+            as named entries (see :func:`pytest_wdl.utils.link_file`).
+        persistent: Whether the cache directory is kept after the session. A
+            cache that is neither persistent nor bounded in size or age has no
+            catalog.
+    """
+    def __init__(
+        self,
+        root: Path,
+        max_size: Optional[int] = None,
+        max_age: Optional[float] = None,
+        link_strategy: str = LINK_SYMLINK,
+        persistent: bool = True
+    ):
+        self.root = root
+        self.objects_dir = root / OBJECTS_DIR
+        self.max_size = max_size
+        self.max_age = max_age
+        self.link_strategy = link_strategy
+        self.persistent = persistent
+        self._catalog: Optional[Catalog] = None
+        self._catalog_opened = False
+        self._catalog_lock = threading.Lock()
+        self._session: Optional[str] = None
+        self._stop_refresh: Optional[threading.Event] = None
+        self._in_use: Set[Path] = set()
+        self._validated: Set[Path] = set()
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+
+    @property
+    def catalog(self) -> Optional[Catalog]:
+        """
+        The catalog of the cache, which is opened when it is first used. None if
+        the cache is neither persistent nor bounded, or if the catalog cannot be
+        opened.
+        """
+        with self._catalog_lock:
+            if not self._catalog_opened:
+                self._catalog_opened = True
+                if self.persistent or self.max_size is not None or \
+                        self.max_age is not None:
+                    self._catalog = self._open_catalog()
+                    if self._catalog:
+                        self._start_session()
+            return self._catalog
+
+    def _start_session(self) -> None:
+        """
+        Records the session in the catalog, and refreshes its lease until the
+        cache is closed.
+        """
+        token = lease_token()
+        try:
+            self._catalog.start_session(token)
+        except sqlite3.Error as err:
+            LOG.warning(f"Cannot record the session in the cache catalog: {err}")
+            return
+        self._session = token
+        self._stop_refresh = threading.Event()
+        threading.Thread(
+            target=self._refresh_session,
+            args=(self._catalog, token, self._stop_refresh),
+            daemon=True
+        ).start()
+
+    @staticmethod
+    def _refresh_session(
+        catalog: Catalog, token: str, stop: threading.Event
+    ) -> None:
+        while not stop.wait(DEFAULT_LOCK_STALE_AFTER / 4):
+            try:
+                catalog.refresh_session(token)
+            except sqlite3.Error as err:
+                LOG.debug(f"Cannot refresh the session in the cache catalog: {err}")
+
+    def _open_catalog(self) -> Optional[Catalog]:
+        path = self.root / CATALOG_FILE
+        if not os.access(self.root, os.W_OK):
+            LOG.warning(
+                f"Cache directory {self.root} is not writable; the cache is used "
+                f"without a catalog"
+            )
+            return None
+        try:
+            return Catalog(path)
+        except sqlite3.Error as err:
+            LOG.warning(
+                f"Cannot open the cache catalog {path}; the cache is used without "
+                f"a catalog: {err}"
+            )
+            return None
+
+    def object_path(self, digests: Dict[str, str]) -> Path:
+        """
+        Gets the path at which the object with the given digests is stored.
+
+        Args:
+            digests: Mapping of hash algorithm name to hex digest.
+
+        Returns:
+            The object path; the file may not yet exist.
+        """
+        algorithm, digest = select_digest(digests)
+        return self.objects_dir / algorithm / digest[:2] / digest
+
+    def link(self, destination: Path, object_path: Path) -> None:
+        """
+        Exposes a stored object at `destination`.
+
+        Args:
+            destination: The path of the named entry.
+            object_path: The path of the stored object.
+        """
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        with FileLock(destination):
+            # Another process may have linked the object while we waited
+            if destination.exists() and os.path.samefile(destination, object_path):
+                return
+            # Link under a temporary name and rename it over any existing entry
+            # (which may be a dangling symlink, if the object was removed), so
+            # that the entry never disappears while another process is using it
+            temp = destination.with_name(f"{destination.name}{PARTIAL_SUFFIX}")
+            if temp.is_symlink() or temp.exists():
+                temp.unlink()
+            link_file(object_path, temp, self.link_strategy)
+            temp.replace(destination)
+        catalog = self.catalog
+        if catalog:
+            catalog.record_link(destination, object_path)
+
+    def touch(self, path: Path) -> None:
+        """
+        Records that a file is used by the current session, and updates its last
+        access time if it exists. Files outside the cache directory are ignored.
+
+        Args:
+            path: Path to a cached file, or to a link to a cached object.
+        """
+        paths = {path, path.resolve()}
+        with self._lock:
+            for p in paths:
+                if self._contains(p):
+                    self._in_use.add(p)
+        catalog = self.catalog
+        for p in paths:
+            if self._contains(p) and p.exists() and not p.is_symlink():
+                now = time.time()
+                try:
+                    os.utime(p, ns=(int(now * 1e9), p.stat().st_mtime_ns))
+                except OSError as err:
+                    LOG.debug(f"Cannot update the access time of {p}: {err}")
+                if catalog:
+                    catalog.record(p, last_access=now)
+
+    def record(
+        self,
+        path: Path,
+        source: Optional[str] = None,
+        digests: Optional[Dict[str, str]] = None,
+        download_seconds: Optional[float] = None
+    ) -> None:
+        """
+        Records a file that has been added to the cache.
+
+        Args:
+            path: The cached file.
+            source: Description of where the file came from, e.g. a URL.
+            digests: Known (verified) digests of the file.
+            download_seconds: How long it took to download the file.
+        """
+        catalog = self.catalog
+        if catalog is None:
+            return
+        digest = ":".join(select_digest(digests)) if digests else None
+        catalog.record(path, source, digest, download_seconds)
+        for algorithm, value in (digests or {}).items():
+            catalog.store_digest(path, algorithm, value)
+
+    def record_download(self, destination: Path) -> None:
+        """
+        Records the temporary files of a download that is about to start, so that
+        they can be evicted if the download is interrupted and never resumed.
+
+        Args:
+            destination: The file being downloaded.
+        """
+        catalog = self.catalog
+        if catalog is None:
+            return
+        for suffix in TEMP_SUFFIXES:
+            catalog.record_temp_file(
+                destination.with_name(f"{destination.name}{suffix}")
+            )
+
+    def read_metadata(self, path: Path) -> Optional[dict]:
+        """
+        Reads the metadata stored for a cached file.
+
+        Args:
+            path: The cached file.
+
+        Returns:
+            The metadata dict, or None if there is no (valid) metadata.
+        """
+        metadata_path = _metadata_path(path)
+        if metadata_path.exists():
+            try:
+                with open(metadata_path, "rt") as inp:
+                    return json.load(inp)
+            except ValueError:
+                LOG.warning(f"Ignoring invalid cache metadata file {metadata_path}")
+        return None
+
+    def write_metadata(self, path: Path, metadata: dict) -> None:
+        """
+        Stores metadata for a cached file, and records that it has been validated
+        in the current session.
+
+        Args:
+            path: The cached file.
+            metadata: Dict of metadata values; the current time is added with the
+                key 'validated'.
+        """
+        metadata = dict(metadata, validated=time.time())
+        metadata_path = _metadata_path(path)
+        temp = metadata_path.with_name(f"{metadata_path.name}{PARTIAL_SUFFIX}")
+        with open(temp, "wt") as out:
+            json.dump(metadata, out)
+        temp.replace(metadata_path)
+        self.mark_validated(path)
+
+    def needs_revalidation(self, path: Path, policy: Union[str, int, None]) -> bool:
+        """
+        Determines whether a cached file should be revalidated against its source.
+
+        Args:
+            path: The cached file.
+            policy: The revalidation policy - 'never' (or None), 'session' (once
+                per session), or the maximum time (in seconds) since the file was
+                last validated.
+
+        Returns:
+            True if the file should be revalidated.
+        """
+        if policy in (None, REVALIDATE_NEVER):
+            return False
+        with self._lock:
+            if path in self._validated:
+                return False
+        if policy == REVALIDATE_SESSION:
+            return True
+        metadata = self.read_metadata(path)
+        return (
+            metadata is None or
+            time.time() - metadata.get("validated", 0) > policy
+        )
+
+    def mark_validated(self, path: Path) -> None:
+        """
+        Records that a cached file has been validated in the current session.
+        """
+        with self._lock:
+            self._validated.add(path)
+
+    def reserve(self, size: int) -> None:
+        """
+        Makes room for a new file of `size` bytes, evicting files if necessary.
+
+        Args:
+            size: The size of the new file, in bytes.
+        """
+        if self.max_size is not None:
+            self.evict(reserve=size)
+
+    def evict(self, reserve: int = 0) -> List[Path]:
+        """
+        Evicts files that have not been used for longer than `max_age`, and then
+        the least recently used files until the total size of the cache plus
+        `reserve` is no more than `max_size`. Links to evicted objects are removed.
+        The temporary files of interrupted downloads count toward the size of the
+        cache, and are evicted like other files unless they have been modified
+        within the lease time of a lock (i.e. they may still be downloading).
+
+        Args:
+            reserve: Number of bytes to make available in addition to `max_size`.
+
+        Returns:
+            The list of evicted files.
+        """
+        if self.max_size is None and self.max_age is None:
+            return []
+
+        # Concurrent threads and processes would otherwise choose the same files
+        # to evict
+        with self._evict_lock, FileLock(self.root / EVICT_LOCK_FILE):
+            return self._evict(reserve)
+
+    def _evict(self, reserve: int) -> List[Path]:
+        with self._lock:
+            in_use = set(self._in_use)
+        # Files used by other sessions since they started may be about to be
+        # opened
+        used_since = self._oldest_session_start()
+
+        # Hard links to the same file are evicted together, and are as recently
+        # used as the most recently used of them
+        groups = {}
+        for entry in self._entries() + self._temp_file_entries():
+            if not entry.path.exists():
+                if self.catalog:
+                    self.catalog.remove(entry.path)
+                continue
+            key = (entry.dev, entry.inode)
+            if key in groups:
+                last_used, size, paths = groups[key]
+                groups[key] = (max(last_used, entry.last_access), size, paths)
+                paths.append(entry.path)
+            else:
+                groups[key] = (entry.last_access, entry.size, [entry.path])
+        total_size = sum(size for _, size, _ in groups.values())
+        entries = sorted(
+            (last_used, size, paths)
+            for last_used, size, paths in groups.values()
+            if not (used_since is not None and last_used >= used_since) and not any(
+                path in in_use or self._temp_file_in_use(path, in_use) or
+                self._temp_file_active(path)
+                for path in paths
+            )
+        )
+
+        evicted = []
+        if self.max_age is not None:
+            cutoff = time.time() - (self.max_age * SECONDS_PER_DAY)
+            while entries and entries[0][0] < cutoff:
+                _, size, paths = entries.pop(0)
+                for path in paths:
+                    self._remove(path)
+                total_size -= size
+                evicted.extend(paths)
+
+        if self.max_size is not None:
+            while entries and total_size + reserve > self.max_size:
+                _, size, paths = entries.pop(0)
+                for path in paths:
+                    self._remove(path)
+                total_size -= size
+                evicted.extend(paths)
+            if total_size + reserve > self.max_size:
+                LOG.warning(
+                    f"Cache {self.root} exceeds the maximum size of {self.max_size} "
+                    f"bytes, but all remaining files are in use"
+                )
+
+        if evicted:
+            self._remove_dangling_links(evicted)
+
+        return evicted
+
+    def _oldest_session_start(self) -> Optional[float]:
+        """
+        Returns the start time of the oldest session, other than the current one,
+        whose lease has not expired, or None if there is no such session. The
+        records of expired sessions are removed.
+        """
+        catalog = self.catalog
+        if catalog is None:
+            return None
+        started = []
+        for token, start, refreshed in catalog.sessions():
+            if token == self._session:
+                continue
+            if lease_expired(token, refreshed, DEFAULT_LOCK_STALE_AFTER):
+                LOG.debug(f"Removing expired cache session {token}")
+                catalog.end_session(token)
+            else:
+                started.append(start)
+        return min(started, default=None)
+
+    def size(self) -> int:
+        """
+        Returns the total size, in bytes, of the files in the cache (counting
+        hard-linked files once).
+        """
+        return self.stats()["size"]
+
+    def stats(self) -> dict:
+        """
+        Returns statistics about the files in the cache (see
+        :meth:`Catalog.stats`).
+        """
+        catalog = self.catalog
+        if catalog is None:
+            entries = self._entries()
+            return {
+                "files": len(entries),
+                "size": sum(dict(
+                    ((entry.dev, entry.inode), entry.size) for entry in entries
+                ).values()),
+                "download_seconds": 0.0
+            }
+        self._sync()
+        return catalog.stats()
+
+    def close(self) -> None:
+        """
+        Closes the catalog, if it is open.
+        """
+        with self._catalog_lock:
+            if self._catalog:
+                if self._session:
+                    self._stop_refresh.set()
+                    self._catalog.end_session(self._session)
+                    self._session = None
+                self._catalog.close()
+
+    def _entries(self) -> List[CatalogEntry]:
+        catalog = self.catalog
+        if catalog is None:
+            # Without a catalog, the cache directory is walked
+            return sorted(
+                (_stat_entry(path) for path in self._files()),
+                key=lambda entry: entry.last_access
+            )
+        self._sync()
+        return catalog.entries()
+
+    def _sync(self) -> None:
+        """
+        Adds the files that were in the cache directory before the catalog was
+        created.
+        """
+        if self.catalog.get_property("synced"):
+            return
+        for path in self._files():
+            stat = path.stat()
+            self.catalog.record(
+                path, last_access=max(stat.st_atime, stat.st_mtime), replace=False
+            )
+        self.catalog.set_property("synced", "1")
+
+    def _temp_file_entries(self) -> List[CatalogEntry]:
+        """
+        Returns entries for the existing temporary files recorded in the catalog
+        (which are not in `_entries`, since their size changes while they are
+        written), and removes the records of those that no longer exist. Without a
+        catalog, temporary files are found by `_entries`.
+        """
+        catalog = self.catalog
+        if catalog is None:
+            return []
+        entries = []
+        for path in catalog.temp_files():
+            try:
+                entry = _stat_entry(path)
+            except FileNotFoundError:
+                catalog.remove(path)
+                continue
+            entries.append(entry._replace(last_access=entry.mtime / 1e9))
+        return entries
+
+    def _contains(self, path: Path) -> bool:
+        return self.root in path.parents
+
+    def _files(self) -> List[Path]:
+        return [
+            path
+            for path in self.root.glob("**/*")
+            if path.is_file() and not (
+                path.is_symlink() or
+                path.name.endswith(METADATA_SUFFIX) or
+                path.name.endswith(LOCK_SUFFIX) or
+                path.name.endswith(VALIDATOR_SUFFIX) or
+                path.name.startswith(CATALOG_FILE)
+            )
+        ]
+
+    @staticmethod
+    def _temp_file_in_use(path: Path, in_use: Set[Path]) -> bool:
+        for suffix in TEMP_SUFFIXES:
+            if path.name.endswith(suffix):
+                return path.with_name(path.name[:-len(suffix)]) in in_use
+        return False
+
+    @staticmethod
+    def _temp_file_active(path: Path) -> bool:
+        """
+        Whether a temporary file may still be written by another process, i.e.
+        it was modified more recently than a lock would be considered stale.
+        """
+        if not path.name.endswith(TEMP_SUFFIXES):
+            return False
+        try:
+            return time.time() - path.stat().st_mtime < DEFAULT_LOCK_STALE_AFTER
+        except FileNotFoundError:
+            # The download finished, and the file was renamed
+            return False
+
+    def _remove(self, path: Path) -> None:
+        """
+        Removes a file, its sidecar files, and its catalog entry. Files that have
+        already been removed (e.g. by another process) are ignored.
+        """
+        LOG.debug(f"Evicting {path} from the cache")
+        for p in (
+            path,
+            _metadata_path(path),
+            path.with_name(f"{path.name}{VALIDATOR_SUFFIX}")
+        ):
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+        if self.catalog:
+            self.catalog.remove(path)
+        parent = path.parent
+        while parent != self.root and self.objects_dir in parent.parents:
+            try:
+                parent.rmdir()
+            except OSError:
+                break
+            parent = parent.parent
+
+    def _remove_dangling_links(self, evicted: List[Path]) -> None:
+        """
+        Removes the symbolic links to evicted objects. Without a catalog, the
+        cache directory is walked for dangling links.
+        """
+        catalog = self.catalog
+        if catalog is None:
+            links = [path for path in self.root.glob("**/*") if path.is_symlink()]
+        else:
+            links = [link for path in evicted for link in catalog.links_to(path)]
+        for path in links:
+            if path.is_symlink() and not path.exists():
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+        if catalog:
+            for path in evicted:
+                catalog.remove_links_to(path)
+
+
+def validate_revalidation_policy(policy: Union[str, int, None]) -> Union[str, int]:
+    """
+    Checks that a revalidation policy is valid.
+
+    Args:
+        policy: 'never', 'session', a maximum age in seconds, or None (which is the
+            same as 'never').
+
+    Returns:
+        The policy, with None replaced by 'never'.
+
+    Raises:
+        ValueError: if the policy is invalid.
+    """
+    if policy is None:
+        return REVALIDATE_NEVER
+    if policy in (REVALIDATE_NEVER, REVALIDATE_SESSION) or (
+        isinstance(policy, (int, float)) and not isinstance(policy, bool) and
+        policy >= 0
+    ):
+        return policy
+    raise ValueError(
+        f"Invalid revalidation policy {policy}; expected '{REVALIDATE_NEVER}', "
+        f"'{REVALIDATE_SESSION}', or a maximum age in seconds"
+    )
+
+
+def _metadata_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}{METADATA_SUFFIX}")
+
+
+def select_digest(digests: Dict[str, str]) -> Tuple[str, str]:
+    """
+    Selects the digest to use as the key of a stored object - the strongest of
+    the commonly used algorithms if available, otherwise the first (alphabetically)
+    of the given algorithms.
+
+    Args:
+        digests: Mapping of hash algorithm name to hex digest.
+
+    Returns:
+        Tuple (algorithm, digest), where digest is lower-case.
+
+    Raises:
+        ValueError: if `digests` is empty or contains an unsupported algorithm.
+    """
+    if not digests:
+        raise ValueError("At least one digest is required")
+    for algorithm in digests:
+        if algorithm not in hashlib.algorithms_available:
+            raise ValueError(f"Unsupported digest algorithm {algorithm}")
+    for algorithm in PREFERRED_DIGESTS:
+        if algorithm in digests:
+            break
+    else:
+        algorithm = sorted(digests)[0]
+    return algorithm, digests[algorithm].lower()
@@ -0,0 +1,822 @@
+#    Copyright 2019 Eli Lilly and Company
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Streaming comparison of line-oriented files.
+
+Lines are compared in lock-step until the inputs differ. At that point, up to
+`window` lines are buffered from each input, and the buffers are aligned the same
+way as by `diff` (a longest common subsequence found with Myers' algorithm, with
+runs of differing lines shifted to merge them), starting with a small prefix and
+extending it until the inputs are found to be equal again. Each run of differing
+lines (a "hunk") counts as the larger of the numbers of lines removed and added,
+which is the number of lines reported by `diff -y --suppress-common-lines`.
+Memory use is bounded by the window size, and the comparison stops as soon as
+the number of differing lines exceeds the allowed limit.
+
+Gzip-compressed files (including bgzip files) are detected by their magic bytes
+and decompressed while they are read, so a compressed file can be compared with
+an uncompressed file. Bgzip (BGZF) files consist of independently compressed
+blocks, which are decompressed concurrently in a thread pool (zlib releases the
+GIL) and passed on in order.
+
+Inputs whose lines may be in any order are compared by `diff_unordered`, which
+first compares an order-independent fingerprint of each input: the number and
+the sum of the hashes of the lines in each of a fixed number of buckets. Only if
+the fingerprints differ are the lines in the differing buckets written to
+temporary files and compared as multisets, one bucket at a time.
+"""
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import gzip
+import hashlib
+import io
+from itertools import islice, zip_longest
+import os
+from pathlib import Path
+import struct
+import zlib
+from typing import (
+    BinaryIO, Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple,
+    Optional, Tuple, Union
+)
+
+from pytest_wdl.utils import tempdir
+
+
+DEFAULT_WINDOW = 1000
+ALIGN_CHUNK = 32
+"""Number of lines of each input that are aligned at first when they differ."""
+RESYNC_LINES = 3
+"""Number of equal lines that must follow a differing section for the inputs to
+be considered resynchronized."""
+DEFAULT_MAX_SAMPLE = 10
+DEFAULT_BUCKETS = 256
+GZIP_MAGIC = b"\x1f\x8b"
+BGZF_HEADER = struct.Struct("<4BI2BH")
+"""Fixed part of a gzip member header: ID1, ID2, CM, FLG, MTIME, XFL, OS, XLEN."""
+BGZF_TRAILER = struct.Struct("<2I")
+"""Gzip member trailer: CRC32, ISIZE."""
+FEXTRA = 4
+DEFAULT_DECOMPRESS_THREADS = min(os.cpu_count() or 1, 8)
+HASH_MASK = (1 << 64) - 1
+
+Line = Union[str, bytes]
+
+_END = object()
+
+
+class DiffLine(NamedTuple):
+    """
+    A pair of differing lines, as they would be shown side by side. One side is
+    None if a line was only removed or only added. Line numbers are 1-based, or
+    None if they are not known.
+    """
+    line_no1: Optional[int]
+    line1: Optional[Line]
+    line_no2: Optional[int]
+    line2: Optional[Line]
+
+    def __str__(self) -> str:
+        return f"{_format_line(self.line_no1, self.line1)} | " \
+               f"{_format_line(self.line_no2, self.line2)}"
+
+
+class DiffResult(NamedTuple):
+    """
+    The result of comparing two inputs.
+
+    Attributes:
+        count: Number of differing lines. If `complete` is False, the comparison
+            stopped once this exceeded the limit, and the actual number may be
+            larger.
+        sample: The first differing lines.
+        complete: Whether the inputs were compared to the end.
+    """
+    count: int
+    sample: List[DiffLine]
+    complete: bool = True
+
+    def __str__(self) -> str:
+        return "\n".join(str(diff_line) for diff_line in self.sample)
+
+
+class Fingerprint(NamedTuple):
+    """
+    An order-independent fingerprint of a sequence of lines. Equal multisets of
+    lines have equal fingerprints.
+
+    Attributes:
+        count: Number of lines.
+        buckets: For each bucket, the number of lines and the sum (modulo 2^64)
+            of the 64-bit hashes of the lines in the bucket.
+    """
+    count: int
+    buckets: List[Tuple[int, int]]
+
+
+def diff_files(
+    file1: Path,
+    file2: Path,
+    limit: Optional[int] = None,
+    window: int = DEFAULT_WINDOW,
+    max_sample: int = DEFAULT_MAX_SAMPLE
+) -> DiffResult:
+    """
+    Compares two files line by line. Either file may be gzip-compressed.
+
+    Args:
+        file1: The first file.
+        file2: The second file.
+        limit: Stop comparing once more than this many lines differ; if None,
+            the files are compared to the end.
+        window: Maximum number of lines to buffer from each file in order to
+            align differing sections.
+        max_sample: Maximum number of differing lines to return.
+
+    Returns:
+        A `DiffResult`.
+    """
+    with open_file(file1) as inp1, open_file(file2) as inp2:
+        return diff_lines(inp1, inp2, limit, window, max_sample)
+
+
+def open_file(path: Path, threads: int = DEFAULT_DECOMPRESS_THREADS) -> BinaryIO:
+    """
+    Opens a file for reading in binary mode, decompressing it while it is read
+    if it is gzip-compressed.
+
+    Args:
+        path: The file to open.
+        threads: Number of threads used to decompress BGZF blocks.
+
+    Returns:
+        A binary file object.
+    """
+    if is_bgzf(path) and threads > 1:
+        return io.BufferedReader(BgzfReader(path, threads))
+    if is_gzip(path):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def read_lines(path: Path) -> Iterator[bytes]:
+    """
+    Yields the lines of a file, which may be gzip-compressed, and closes the file
+    once all lines have been read.
+    """
+    with open_file(path) as inp:
+        yield from inp
+
+
+def is_bgzf(path: Path) -> bool:
+    """
+    Whether a file is BGZF-compressed (i.e. with bgzip), according to the header
+    of its first block.
+    """
+    with open(path, "rb") as inp:
+        return _bgzf_block_size(inp.read(BGZF_HEADER.size + 6)) is not None
+
+
+def is_gzip(path: Path) -> bool:
+    """
+    Whether a file is gzip-compressed, according to its magic bytes.
+    """
+    with open(path, "rb") as inp:
+        return inp.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    Reads a BGZF file, decompressing its blocks concurrently. At most a fixed
+    number of blocks are read ahead and decompressed, and blocks are returned in
+    order.
+
+    Args:
+        path: The BGZF file.
+        threads: Number of decompression threads.
+        read_ahead: Maximum number of blocks being decompressed at once; defaults
+            to four times the number of threads.
+    """
+    def __init__(
+        self, path: Path, threads: int = DEFAULT_DECOMPRESS_THREADS,
+        read_ahead: Optional[int] = None
+    ):
+        super().__init__()
+        self.path = path
+        self._file = open(path, "rb")
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._read_ahead = read_ahead or 4 * threads
+        self._pending: Deque[Future] = deque()
+        self._block = memoryview(b"")
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._block:
+            self._submit()
+            if not self._pending:
+                return 0
+            self._block = memoryview(self._pending.popleft().result())
+        size = min(len(buffer), len(self._block))
+        buffer[:size] = self._block[:size]
+        self._block = self._block[size:]
+        return size
+
+    def close(self) -> None:
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown()
+            self._file.close()
+        super().close()
+
+    def _submit(self) -> None:
+        """
+        Reads blocks and submits them for decompression, until the read-ahead
+        limit or the end of the file is reached.
+        """
+        while not self._eof and len(self._pending) < self._read_ahead:
+            header = self._file.read(BGZF_HEADER.size + 6)
+            if not header:
+                self._eof = True
+                break
+            block_size = _bgzf_block_size(header)
+            if block_size is None:
+                raise OSError(f"Invalid BGZF block in file {self.path}")
+            rest = self._file.read(block_size - len(header))
+            if len(rest) != block_size - len(header):
+                raise EOFError(f"Truncated BGZF block in file {self.path}")
+            self._pending.append(
+                self._executor.submit(_inflate_block, header + rest, self.path)
+            )
+
+
+def _bgzf_block_size(header: bytes) -> Optional[int]:
+    """
+    Returns the total size of a BGZF block, given (at least) its first 18 bytes,
+    or None if they are not the header of a BGZF block.
+    """
+    if len(header) < BGZF_HEADER.size + 6:
+        return None
+    id1, id2, method, flags, _, _, _, extra_len = BGZF_HEADER.unpack_from(header)
+    if (id1, id2, method) != (0x1F, 0x8B, 8) or not flags & FEXTRA or extra_len < 6:
+        return None
+    # The BC subfield, holding the block size minus one, comes first in blocks
+    # written by bgzip/htslib
+    subfield_id, subfield_len, block_size = struct.unpack_from(
+        "<2sHH", header, BGZF_HEADER.size
+    )
+    if subfield_id != b"BC" or subfield_len != 2:
+        return None
+    return block_size + 1
+
+
+def _inflate_block(block: bytes, path: Path) -> bytes:
+    extra_len = BGZF_HEADER.unpack_from(block)[-1]
+    data = zlib.decompress(
+        block[BGZF_HEADER.size + extra_len:-BGZF_TRAILER.size], -zlib.MAX_WBITS
+    )
+    crc, size = BGZF_TRAILER.unpack_from(block, len(block) - BGZF_TRAILER.size)
+    if len(data) != size or zlib.crc32(data) != crc:
+        raise OSError(f"Corrupt BGZF block in file {path}")
+    return data
+
+
+def diff_lines(
+    lines1: Iterable[Line],
+    lines2: Iterable[Line],
+    limit: Optional[int] = None,
+    window: int = DEFAULT_WINDOW,
+    max_sample: int = DEFAULT_MAX_SAMPLE
+) -> DiffResult:
+    """
+    Compares two sequences of lines. Trailing newlines are ignored.
+
+    Args:
+        lines1: The first sequence of lines (e.g. an open file).
+        lines2: The second sequence of lines.
+        limit: Stop comparing once more than this many lines differ; if None,
+            the sequences are compared to the end.
+        window: Maximum number of lines to buffer from each sequence in order to
+            align differing sections.
+        max_sample: Maximum number of differing lines to return.
+
+    Returns:
+        A `DiffResult`.
+    """
+    iter1 = (_strip(line) for line in lines1)
+    iter2 = (_strip(line) for line in lines2)
+    buf1: Deque[Line] = deque()
+    buf2: Deque[Line] = deque()
+    line_no1 = line_no2 = 0
+    count = 0
+    sample: List[DiffLine] = []
+
+    while True:
+        if not (buf1 or buf2):
+            # Fast path: compare lines in lock-step until they differ
+            for line1, line2 in zip_longest(iter1, iter2, fillvalue=_END):
+                if line1 == line2:
+                    line_no1 += 1
+                    line_no2 += 1
+                    continue
+                if line1 is not _END:
+                    buf1.append(line1)
+                if line2 is not _END:
+                    buf2.append(line2)
+                break
+            else:
+                return DiffResult(count, sample)
+
+        _fill(buf1, iter1, window)
+        _fill(buf2, iter2, window)
+        exhausted = len(buf1) < window and len(buf2) < window
+
+        while buf1 and buf2 and buf1[0] == buf2[0]:
+            buf1.popleft()
+            buf2.popleft()
+            line_no1 += 1
+            line_no2 += 1
+
+        for end1, end2, equal in _align(buf1, buf2, exhausted):
+            hunk1 = [buf1.popleft() for _ in range(end1)]
+            hunk2 = [buf2.popleft() for _ in range(end2)]
+            for i in range(max(end1, end2)):
+                if len(sample) >= max_sample:
+                    break
+                sample.append(DiffLine(
+                    line_no1 + i + 1 if i < end1 else None,
+                    hunk1[i] if i < end1 else None,
+                    line_no2 + i + 1 if i < end2 else None,
+                    hunk2[i] if i < end2 else None
+                ))
+            line_no1 += end1
+            line_no2 += end2
+            count += max(end1, end2)
+
+            if limit is not None and count > limit:
+                return DiffResult(count, sample, complete=False)
+
+            for _ in range(equal):
+                buf1.popleft()
+                buf2.popleft()
+            line_no1 += equal
+            line_no2 += equal
+
+
+def fingerprint(lines: Iterable[Line], buckets: int = DEFAULT_BUCKETS) -> Fingerprint:
+    """
+    Computes an order-independent fingerprint of a sequence of lines, in one pass.
+    Trailing newlines are ignored.
+
+    Args:
+        lines: The sequence of lines.
+        buckets: Number of buckets into which lines are partitioned by hash.
+
+    Returns:
+        A `Fingerprint`.
+    """
+    counts = [0] * buckets
+    sums = [0] * buckets
+    count = 0
+    for line in lines:
+        line_hash = _hash(line)
+        bucket = line_hash % buckets
+        counts[bucket] += 1
+        sums[bucket] = (sums[bucket] + line_hash) & HASH_MASK
+        count += 1
+    return Fingerprint(count, list(zip(counts, sums)))
+
+
+def diff_unordered(
+    lines1: Callable[[], Iterable[Line]],
+    lines2: Callable[[], Iterable[Line]],
+    limit: Optional[int] = None,
+    buckets: int = DEFAULT_BUCKETS,
+    max_sample: int = DEFAULT_MAX_SAMPLE
+) -> DiffResult:
+    """
+    Compares two sequences of lines regardless of the order of the lines. Lines
+    are counted as differing the same way as by `diff_lines` if both inputs were
+    sorted: a line that occurs more times in one input than in the other is
+    removed or added, and the number of differing lines is the larger of the
+    numbers of lines removed and added.
+
+    Args:
+        lines1: Callable that returns the first sequence of lines (e.g. opens a
+            file). It is called a second time if the fingerprints differ.
+        lines2: Callable that returns the second sequence of lines.
+        limit: Stop comparing once more than this many lines differ; if None,
+            all differing buckets are compared.
+        buckets: Number of buckets into which lines are partitioned by hash.
+        max_sample: Maximum number of differing lines to return.
+
+    Returns:
+        A `DiffResult`. Line numbers are not reported.
+    """
+    fingerprint1 = fingerprint(lines1(), buckets)
+    fingerprint2 = fingerprint(lines2(), buckets)
+    differing = set(
+        i for i, (bucket1, bucket2) in enumerate(
+            zip(fingerprint1.buckets, fingerprint2.buckets)
+        )
+        if bucket1 != bucket2
+    )
+    if not differing:
+        return DiffResult(0, [])
+
+    removed = added = 0
+    sample: List[DiffLine] = []
+    with tempdir() as temp:
+        bucket_files1 = _write_buckets(lines1(), buckets, differing, temp / "1")
+        bucket_files2 = _write_buckets(lines2(), buckets, differing, temp / "2")
+        for bucket in sorted(differing):
+            counter = Counter(_read_bucket(bucket_files1.get(bucket)))
+            counter.subtract(_read_bucket(bucket_files2.get(bucket)))
+            for line, diff in counter.items():
+                if diff > 0:
+                    removed += diff
+                elif diff < 0:
+                    added -= diff
+                else:
+                    continue
+                if len(sample) < max_sample:
+                    sample.append(
+                        DiffLine(None, line, None, None) if diff > 0
+                        else DiffLine(None, None, None, line)
+                    )
+            count = max(removed, added)
+            if limit is not None and count > limit:
+                return DiffResult(count, sample, complete=False)
+
+    return DiffResult(max(removed, added), sample)
+
+
+def _hash(line: Line) -> int:
+    if isinstance(line, str):
+        line = line.encode()
+    digest = hashlib.blake2b(_strip(line), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _write_buckets(
+    lines: Iterable[Line], buckets: int, selected: set, prefix: Path
+) -> Dict[int, Path]:
+    """
+    Writes the lines that fall in the selected buckets to one file per bucket.
+    """
+    files = {}
+    paths = {}
+    try:
+        for line in lines:
+            if isinstance(line, str):
+                line = line.encode()
+            line = _strip(line)
+            bucket = _hash(line) % buckets
+            if bucket not in selected:
+                continue
+            if bucket not in files:
+                paths[bucket] = Path(f"{prefix}.{bucket}")
+                files[bucket] = open(paths[bucket], "wb")
+            files[bucket].write(line + b"\n")
+    finally:
+        for out in files.values():
+            out.close()
+    return paths
+
+
+def _read_bucket(path: Optional[Path]) -> Iterator[bytes]:
+    if path is None:
+        return
+    with open(path, "rb") as inp:
+        for line in inp:
+            yield line[:-1]
+
+
+def _align(
+    buf1: Deque[Line], buf2: Deque[Line], exhausted: bool
+) -> List[Tuple[int, int, int]]:
+    """
+    Aligns the buffered lines, starting with a differing line, and returns the
+    leading hunks that can be committed to, as tuples (removed, added, equal): the
+    numbers of differing lines of each input, and of the equal lines that follow.
+
+    A prefix of the buffers (starting with `ALIGN_CHUNK` lines, and doubled as
+    needed) is aligned with `_hunks`. Since the alignment of the lines near the
+    end of the prefix may change once more lines are considered, hunks are only
+    committed if they are followed by at least `RESYNC_LINES` equal lines, or end
+    in the first half of the prefix (see `_committed_hunks`). If the inputs are
+    `exhausted` and fully buffered, all the hunks are committed. If the whole
+    buffers are aligned, hunks are committed up to the last one followed by any
+    equal line; if there is none, all the buffered lines differ.
+    """
+    if not (buf1 and buf2):
+        return [(len(buf1), len(buf2), 0)]
+    size = ALIGN_CHUNK
+    while True:
+        lines1 = list(islice(buf1, size))
+        lines2 = list(islice(buf2, size))
+        whole = len(lines1) == len(buf1) and len(lines2) == len(buf2)
+        hunks = _hunks(lines1, lines2)
+        if whole and exhausted:
+            return hunks
+        committed = _committed_hunks(
+            hunks, len(lines1) // 2 if not whole else None
+        )
+        if committed:
+            return committed
+        if whole:
+            return [(len(buf1), len(buf2), 0)]
+        size *= 2
+
+
+def _committed_hunks(
+    hunks: List[Tuple[int, int, int]], reliable: Optional[int]
+) -> List[Tuple[int, int, int]]:
+    """
+    Returns the leading hunks up to the last one that is followed by at least
+    `RESYNC_LINES` equal lines, or that is followed by any equal lines and ends
+    within the first `reliable` lines of the first input (or anywhere, if
+    `reliable` is None), whichever is later.
+    """
+    end = 0
+    last_equal = 0
+    position = 0
+    for index, (removed, added, equal) in enumerate(hunks):
+        position += removed + equal
+        if equal >= RESYNC_LINES:
+            end = index + 1
+        elif equal and (reliable is None or position <= reliable):
+            last_equal = index + 1
+    return hunks[:max(end, last_equal)]
+
+
+def _hunks(lines1: List[Line], lines2: List[Line]) -> List[Tuple[int, int, int]]:
+    """
+    Compares two lists of lines the way `diff` does, and returns the hunks as
+    tuples (removed, added, equal).
+    """
+    # Whether each line is changed, with an unchanged sentinel line at each end
+    changed1 = [False] * (len(lines1) + 2)
+    changed2 = [False] * (len(lines2) + 2)
+    # Lines that do not occur in the other list are changed; like `diff`, only
+    # the remaining lines are aligned
+    set1 = set(lines1)
+    set2 = set(lines2)
+    kept1 = [i for i, line in enumerate(lines1) if line in set2]
+    kept2 = [j for j, line in enumerate(lines2) if line in set1]
+    kept_changed1 = [False] * (len(kept1) + 2)
+    kept_changed2 = [False] * (len(kept2) + 2)
+    _compare_sequences(
+        [lines1[i] for i in kept1], [lines2[j] for j in kept2],
+        kept_changed1, kept_changed2
+    )
+    changed1[1:-1] = [True] * len(lines1)
+    changed2[1:-1] = [True] * len(lines2)
+    for k, i in enumerate(kept1):
+        changed1[i + 1] = kept_changed1[k + 1]
+    for k, j in enumerate(kept2):
+        changed2[j + 1] = kept_changed2[k + 1]
+    _shift_boundaries(lines1, changed1, changed2)
+    _shift_boundaries(lines2, changed2, changed1)
+
+    hunks = []
+    i = j = 0
+    while i < len(lines1) or j < len(lines2):
+        removed = added = equal = 0
+        while changed1[i + removed + 1]:
+            removed += 1
+        while changed2[j + added + 1]:
+            added += 1
+        i += removed
+        j += added
+        while i < len(lines1) and j < len(lines2) and not (
+            changed1[i + 1] or changed2[j + 1]
+        ):
+            equal += 1
+            i += 1
+            j += 1
+        hunks.append((removed, added, equal))
+    return hunks
+
+
+def _shift_boundaries(
+    lines: List[Line], changed: List[bool], other_changed: List[bool]
+) -> None:
+    """
+    Slides each run of changed lines of one input as far as possible while it
+    changes the same lines, such that it merges with adjacent runs, and is then
+    aligned with a run of changed lines of the other input if possible, as `diff`
+    does (see `shift_boundaries` in GNU diffutils). `changed` and `other_changed`
+    are indexed by line number + 1.
+    """
+    end = len(lines)
+    i = j = 0
+    while True:
+        # Find the beginning of the next run of changes, and the corresponding
+        # point in the other input
+        while i < end and not changed[i + 1]:
+            while other_changed[j + 1]:
+                j += 1
+            j += 1
+            i += 1
+        if i == end:
+            break
+        start = i
+        i += 1
+        while changed[i + 1]:
+            i += 1
+        while other_changed[j + 1]:
+            j += 1
+
+        while True:
+            run_length = i - start
+            # Move the run back while the previous unchanged line equals the
+            # last changed one, merging it with previous runs
+            while start and lines[start - 1] == lines[i - 1]:
+                start -= 1
+                changed[start + 1] = True
+                i -= 1
+                changed[i + 1] = False
+                while changed[start]:
+                    start -= 1
+                j -= 1
+                while other_changed[j + 1]:
+                    j -= 1
+            # The end of the run, at the last point where it corresponds to a
+            # run of changes in the other input, if any
+            corresponding = i if other_changed[j] else end
+            # Move the run forward while the first changed line equals the next
+            # unchanged one, merging it with following runs
+            while i != end and lines[start] == lines[i]:
+                changed[start + 1] = False
+                start += 1
+                changed[i + 1] = True
+                i += 1
+                while changed[i + 1]:
+                    i += 1
+                j += 1
+                while other_changed[j + 1]:
+                    j += 1
+                    corresponding = i
+            if run_length == i - start:
+                break
+
+        # Move the merged run back to the corresponding run in the other input
+        while corresponding < i:
+            start -= 1
+            changed[start + 1] = True
+            i -= 1
+            changed[i + 1] = False
+            j -= 1
+            while other_changed[j + 1]:
+                j -= 1
+
+
+def _compare_sequences(
+    lines1: List[Line],
+    lines2: List[Line],
+    changed1: List[bool],
+    changed2: List[bool]
+) -> None:
+    """
+    Marks the lines of two lists that are not in a longest common subsequence,
+    which is found the same way as by `diff` (see `compareseq` in GNU
+    diffutils): the lists are divided recursively at the middle snake of Myers'
+    O(ND) algorithm. `changed1` and `changed2` are indexed by line number + 1.
+    """
+    offset = len(lines2) + 1
+    size = len(lines1) + len(lines2) + 3
+    forward = [0] * size
+    backward = [0] * size
+    pending = [(0, len(lines1), 0, len(lines2))]
+    while pending:
+        xoff, xlim, yoff, ylim = pending.pop()
+        while xoff < xlim and yoff < ylim and lines1[xoff] == lines2[yoff]:
+            xoff += 1
+            yoff += 1
+        while xoff < xlim and yoff < ylim and lines1[xlim - 1] == lines2[ylim - 1]:
+            xlim -= 1
+            ylim -= 1
+        if xoff == xlim:
+            for y in range(yoff, ylim):
+                changed2[y + 1] = True
+        elif yoff == ylim:
+            for x in range(xoff, xlim):
+                changed1[x + 1] = True
+        else:
+            xmid, ymid = _middle_snake(
+                lines1, lines2, xoff, xlim, yoff, ylim, forward, backward, offset
+            )
+            pending.append((xmid, xlim, ymid, ylim))
+            pending.append((xoff, xmid, yoff, ymid))
+
+
+def _middle_snake(
+    lines1: List[Line],
+    lines2: List[Line],
+    xoff: int,
+    xlim: int,
+    yoff: int,
+    ylim: int,
+    forward: List[int],
+    backward: List[int],
+    offset: int
+) -> Tuple[int, int]:
+    """
+    Finds the point at which a shortest edit script of `lines1[xoff:xlim]` and
+    `lines2[yoff:ylim]` is divided, by searching forward and backward at once
+    (see `diag` in GNU diffutils). `forward` and `backward` hold the furthest
+    points reached on each diagonal, indexed by diagonal + `offset`.
+    """
+    dmin = xoff - ylim
+    dmax = xlim - yoff
+    fmid = xoff - yoff
+    bmid = xlim - ylim
+    fmin = fmax = fmid
+    bmin = bmax = bmid
+    odd = (fmid - bmid) & 1
+    forward[fmid + offset] = xoff
+    backward[bmid + offset] = xlim
+    while True:
+        if fmin > dmin:
+            fmin -= 1
+            forward[fmin - 1 + offset] = -1
+        else:
+            fmin += 1
+        if fmax < dmax:
+            fmax += 1
+            forward[fmax + 1 + offset] = -1
+        else:
+            fmax -= 1
+        for d in range(fmax, fmin - 1, -2):
+            low = forward[d - 1 + offset]
+            high = forward[d + 1 + offset]
+            x = high if low < high else low + 1
+            y = x - d
+            while x < xlim and y < ylim and lines1[x] == lines2[y]:
+                x += 1
+                y += 1
+            forward[d + offset] = x
+            if odd and bmin <= d <= bmax and backward[d + offset] <= x:
+                return x, y
+
+        if bmin > dmin:
+            bmin -= 1
+            backward[bmin - 1 + offset] = xlim + 1
+        else:
+            bmin += 1
+        if bmax < dmax:
+            bmax += 1
+            backward[bmax + 1 + offset] = xlim + 1
+        else:
+            bmax -= 1
+        for d in range(bmax, bmin - 1, -2):
+            low = backward[d - 1 + offset]
+            high = backward[d + 1 + offset]
+            x = low if low < high else high - 1
+            y = x - d
+            while xoff < x and yoff < y and lines1[x - 1] == lines2[y - 1]:
+                x -= 1
+                y -= 1
+            backward[d + offset] = x
+            if not odd and fmin <= d <= fmax and x <= forward[d + offset]:
+                return x, y
+
+
+def _fill(buf: Deque[Line], lines: Iterator[Line], window: int) -> None:
+    while len(buf) < window:
+        line = next(lines, _END)
+        if line is _END:
+            break
+        buf.append(line)
+
+
+def _strip(line: Line) -> Line:
+    if isinstance(line, bytes):
+        return line.rstrip(b"\r\n")
+    return line.rstrip("\r\n")
+
+
+def _format_line(line_no: Optional[int], line: Optional[Line]) -> str:
+    if line is None:
+        return "-"
+    if isinstance(line, bytes):
+        line = line.decode(errors="replace")
+    if line_no is None:
+        return line
+    return f"{line_no}: {line}"
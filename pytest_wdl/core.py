@@ -13,20 +13,36 @@
 #    limitations under the License.
 
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
 import hashlib
+import inspect
 import json
+import math
 import os
 from pathlib import Path
 import re
 import shutil
 import tempfile
-from typing import Callable, Dict, List, Optional, Pattern, Type, Union, cast
-
-import delegator
+import threading
+import time
+from typing import (
+    Callable, Dict, Iterator, List, Optional, Pattern, Sequence, Tuple, Type, Union,
+    cast
+)
+from urllib import parse
 
+from pytest_wdl.cache import (
+    Cache, Catalog, select_digest, validate_revalidation_policy
+)
+from pytest_wdl.compare import (
+    DiffResult, diff_files, diff_unordered, is_gzip, open_file, read_lines
+)
 from pytest_wdl.utils import (
-    LOG, tempdir, ensure_path, plugin_factory_map, env_map,
-    resolve_value_descriptor, download_file
+    LOG, DEFAULT_MIN_SEGMENT_SIZE, DEFAULT_POOL_IDLE_TIMEOUT, DEFAULT_POOL_SIZE,
+    DEFAULT_PROBE_TIMEOUT, HASH_BLOCK_SIZE,
+    LINK_COPY, LINK_REFLINK, LINK_STRATEGIES, LINK_SYMLINK, PARTIAL_SUFFIX,
+    ConnectionPool, FileLock, ensure_path, plugin_factory_map, env_map,
+    resolve_value_descriptor, download_file, file_digests, link_file, probe_url
 )
 
 
@@ -37,6 +53,18 @@ KEY_EXECUTION_DIR = "execution_dir"
 KEY_PROXIES = "proxies"
 KEY_HTTP_HEADERS = "http_headers"
 KEY_SHOW_PROGRESS = "show_progress"
+KEY_PREFETCH_THREADS = "prefetch_threads"
+KEY_DOWNLOAD_SEGMENTS = "download_segments"
+KEY_MIN_SEGMENT_SIZE = "min_segment_size"
+KEY_CACHE_MAX_SIZE = "cache_max_size"
+KEY_CACHE_MAX_AGE = "cache_max_age"
+KEY_REVALIDATE = "revalidate"
+KEY_CONNECTION_POOL_SIZE = "connection_pool_size"
+KEY_CONNECTION_IDLE_TIMEOUT = "connection_idle_timeout"
+KEY_LOCALIZATION_STRATEGY = "localization_strategy"
+DEFAULT_HASH_ALGORITHM = "md5"
+ENV_OFFLINE = "PYTEST_WDL_OFFLINE"
+KEY_OFFLINE = "offline"
 KEY_EXECUTORS = "executors"
 
 
@@ -53,6 +81,23 @@ class UserConfiguration:
         remove_cache_dir: Whether to remove the cache directory; if None, takes the
             value True if a temp directory is used for caching, and False, if
             a value for `cache_dir` is specified.
+        cache_max_size: Maximum total size, in bytes, of the files in the cache
+            directory. When a persistent cache directory exceeds this size, the
+            least recently used files are evicted at the end of the session, or
+            when room is needed for a new download.
+        cache_max_age: Maximum time, in days, since a file in a persistent cache
+            directory was last used; older files are evicted at the end of the
+            session.
+        revalidate: When to check whether cached files that were downloaded from
+            URLs are still up-to-date: 'never' (the default), 'session' (the first
+            time each file is used in a session), or a maximum time (in seconds)
+            since the file was last validated. A file is downloaded again only if
+            it has changed.
+        localization_strategy: How local files are made available at their
+            destination, and cached files at the paths of named cache entries:
+            'reflink' (copy-on-write clone), 'hardlink', 'symlink' (the default),
+            or 'copy'. If a strategy is not supported for a given file, the next
+            one in that order is tried.
         execution_dir: The directory in which to run workflows. Defaults to None,
             which signals that a different temporary directory should be used for
             each workflow run.
@@ -69,17 +114,43 @@ class UserConfiguration:
             files.
         executor_defaults: Mapping of executor name to dict of executor-specific
             configuration options.
+        prefetch_threads: Number of threads to use for localizing remote test data
+            files in the background at the start of the test session. If None or 0,
+            files are only localized when they are first requested.
+        download_segments: Maximum number of byte ranges of a single remote file to
+            download concurrently, if the server supports range requests. If None
+            or 1, each file is downloaded as a single stream.
+        min_segment_size: Minimum size, in bytes, of each byte range when
+            downloading a file in segments.
+        connection_pool_size: Maximum number of idle HTTP(S) connections to keep
+            open for reuse by subsequent downloads. If 0, a new connection is
+            opened for each request.
+        connection_idle_timeout: Number of seconds after which an idle HTTP(S)
+            connection is closed.
+        offline: Whether to run in offline mode, in which remote data files are
+            only resolved from the cache directory, and are never downloaded or
+            revalidated.
     """
     def __init__(
         self,
         config_file: Optional[Path] = None,
         cache_dir: Optional[Path] = None,
         remove_cache_dir: Optional[bool] = None,
+        cache_max_size: Optional[int] = None,
+        cache_max_age: Optional[float] = None,
+        revalidate: Optional[Union[str, int]] = None,
+        localization_strategy: Optional[str] = None,
         execution_dir: Optional[Path] = None,
         proxies: Optional[Dict[str, Union[str, Dict[str, str]]]] = None,
         http_headers: Optional[List[dict]] = None,
         show_progress: Optional[bool] = None,
         executor_defaults: Optional[Dict[str, dict]] = None,
+        prefetch_threads: Optional[int] = None,
+        download_segments: Optional[int] = None,
+        min_segment_size: Optional[int] = None,
+        connection_pool_size: Optional[int] = None,
+        connection_idle_timeout: Optional[float] = None,
+        offline: Optional[bool] = None,
     ):
         if config_file:
             with open(config_file, "rt") as inp:
@@ -100,6 +171,26 @@ class UserConfiguration:
             if remove_cache_dir is None:
                 remove_cache_dir = True
         self.remove_cache_dir = remove_cache_dir
+        if cache_max_size is None:
+            cache_max_size = defaults.get(KEY_CACHE_MAX_SIZE)
+        if cache_max_age is None:
+            cache_max_age = defaults.get(KEY_CACHE_MAX_AGE)
+        if localization_strategy is None:
+            localization_strategy = defaults.get(KEY_LOCALIZATION_STRATEGY, LINK_SYMLINK)
+        if localization_strategy not in LINK_STRATEGIES:
+            raise ValueError(
+                f"Invalid localization strategy {localization_strategy}; expected "
+                f"one of {', '.join(LINK_STRATEGIES)}"
+            )
+        self.localization_strategy = localization_strategy
+        self.cache = Cache(
+            self.cache_dir, cache_max_size, cache_max_age, localization_strategy,
+            persistent=not remove_cache_dir
+        )
+
+        if revalidate is None:
+            revalidate = defaults.get(KEY_REVALIDATE)
+        self.revalidate = validate_revalidation_policy(revalidate)
 
         if not execution_dir:
             execution_dir_str = os.environ.get(
@@ -135,6 +226,47 @@ class UserConfiguration:
                 if name not in self.executor_defaults:
                     self.executor_defaults[name] = d
 
+        if offline is None:
+            offline_str = os.environ.get(ENV_OFFLINE)
+            if offline_str:
+                offline = offline_str.lower() in ("1", "true", "yes")
+            else:
+                offline = defaults.get(KEY_OFFLINE, False)
+        self.offline = offline
+        self.mirrors = MirrorSelector()
+
+        if prefetch_threads is None:
+            prefetch_threads = defaults.get(KEY_PREFETCH_THREADS)
+        if prefetch_threads and not self.offline:
+            self.prefetcher = Prefetcher(prefetch_threads)
+        else:
+            self.prefetcher = None
+
+        if download_segments is None:
+            download_segments = defaults.get(KEY_DOWNLOAD_SEGMENTS)
+        self.download_segments = download_segments or 1
+
+        if min_segment_size is None:
+            min_segment_size = defaults.get(
+                KEY_MIN_SEGMENT_SIZE, DEFAULT_MIN_SEGMENT_SIZE
+            )
+        self.min_segment_size = min_segment_size
+
+        if connection_pool_size is None:
+            connection_pool_size = defaults.get(
+                KEY_CONNECTION_POOL_SIZE, DEFAULT_POOL_SIZE
+            )
+        if connection_idle_timeout is None:
+            connection_idle_timeout = defaults.get(
+                KEY_CONNECTION_IDLE_TIMEOUT, DEFAULT_POOL_IDLE_TIMEOUT
+            )
+        if connection_pool_size:
+            self.connection_pool = ConnectionPool(
+                connection_pool_size, connection_idle_timeout
+            )
+        else:
+            self.connection_pool = None
+
     def get_executor_defaults(self, executor_name: str) -> dict:
         """
         Get default configuration values for the given executor.
@@ -149,9 +281,18 @@ class UserConfiguration:
 
     def cleanup(self) -> None:
         """
-        Preforms cleanup operations, such as deleting the cache directory if
-        `self.remove_cache_dir` is True.
+        Preforms cleanup operations, such as stopping any background localization,
+        closing pooled connections, and deleting the cache directory if
+        `self.remove_cache_dir` is True, or otherwise evicting files from the cache
+        if it exceeds its size or age limits.
         """
+        if self.prefetcher:
+            self.prefetcher.shutdown()
+        if self.connection_pool:
+            self.connection_pool.close()
+        if not self.remove_cache_dir:
+            self.cache.evict()
+        self.cache.close()
         if self.remove_cache_dir:
             shutil.rmtree(self.cache_dir)
 
@@ -170,35 +311,236 @@ class Localizer(metaclass=ABCMeta):  # pragma: no-cover
         """
         pass
 
+    def revalidate(self, destination: Path) -> None:
+        """
+        Checks whether a previously localized resource is still up-to-date, and
+        localizes it again if not. By default, resources are assumed not to change.
+
+        Args:
+            destination: Path to file where the resource was localized.
+        """
+        pass
+
 
 class UrlLocalizer(Localizer):
     """
-    Localizes a file specified by a URL.
+    Localizes a file specified by a URL, or by a list of URLs of mirrors that
+    serve identical copies of the file. Mirrors are tried in order of how quickly
+    they respond (see :class:`MirrorSelector`), and if a download fails, it is
+    resumed from the next mirror.
+
+    Args:
+        url: The URL of the file, or a list of mirror URLs.
+        user_config: The user configuration.
+        http_headers: Mapping of HTTP header names to value descriptors.
+        digests: Mapping of hash algorithm name to the expected hex digest of the
+            file. If specified, the file is verified while it is downloaded and
+            stored in the cache by content, and `destination` is a link to the
+            stored file.
     """
     def __init__(
         self,
-        url: str,
+        url: Union[str, Sequence[str]],
         user_config: UserConfiguration,
-        http_headers: Optional[dict] = None
+        http_headers: Optional[dict] = None,
+        digests: Optional[Dict[str, str]] = None
     ):
-        self.url = url
+        self.urls = [url] if isinstance(url, str) else list(url)
+        if not self.urls:
+            raise ValueError("At least one url is required")
         self.user_config = user_config
         self._http_headers = http_headers
+        self.digests = digests
 
     def localize(self, destination: Path):
+        prefetcher = self.user_config.prefetcher
+        if prefetcher and prefetcher.wait(destination):
+            return
+        self.download(destination)
+
+    def revalidate(self, destination: Path):
+        prefetcher = self.user_config.prefetcher
+        if prefetcher and prefetcher.wait(destination):
+            return
+        self.refresh(destination)
+
+    def needs_revalidation(self, destination: Path) -> bool:
+        """
+        Whether the file at `destination` is due to be revalidated, according to
+        the user configuration. Files with known digests, and files in offline
+        mode, never need revalidation.
+        """
+        return (
+            not (self.digests or self.user_config.offline) and
+            self.user_config.cache.needs_revalidation(
+                destination, self.user_config.revalidate
+            )
+        )
+
+    def is_cached(self, destination: Path) -> bool:
+        """
+        Whether the file is available locally, either at `destination` or (if its
+        digests are known) in the cache's object store.
+        """
+        return destination.exists() or bool(
+            self.digests and self.user_config.cache.object_path(self.digests).exists()
+        )
+
+    def refresh(self, destination: Path):
+        """
+        Revalidates a previously downloaded file, if it is due, by sending a
+        conditional request based on the stored metadata for the file, and
+        downloads the file again if it has changed. If the request fails, the
+        cached file continues to be used.
+
+        Args:
+            destination: Path to which the file was downloaded.
+        """
+        if not self.needs_revalidation(destination):
+            return
+
+        cache = self.user_config.cache
+        metadata = cache.read_metadata(destination) or {}
+        validators = {}
+        if metadata.get("etag"):
+            validators["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            validators["If-Modified-Since"] = metadata["last_modified"]
+        if not validators:
+            LOG.info(
+                f"No metadata is available to revalidate {destination}; "
+                f"downloading it again"
+            )
+
         try:
-            download_file(
-                self.url,
-                destination,
-                http_headers=self.http_headers,
-                proxies=self.user_config.proxies,
-                show_progress=self.user_config.show_progress
+            with FileLock(destination):
+                new_metadata = self._download_file(destination, validators)
+        except RuntimeError as err:
+            LOG.warning(
+                f"Could not revalidate {destination}; using the cached file: "
+                f"{err.__cause__}"
             )
-        except Exception as err:
-            raise RuntimeError(f"Error localizing url {self.url}") from err
+            cache.mark_validated(destination)
+            return
+
+        if new_metadata is None:
+            LOG.debug(f"Cached file {destination} is up-to-date")
+            cache.write_metadata(destination, metadata)
+        else:
+            LOG.debug(f"Downloaded updated file {destination} from {self.url}")
+            cache.write_metadata(destination, new_metadata)
+
+    def download(self, destination: Path):
+        """
+        Downloads the file to `destination`, regardless of whether it is also
+        being localized in the background.
+
+        Args:
+            destination: Path to file where the file is to be downloaded.
+
+        Raises:
+            FileNotFoundError: if in offline mode and the file is not cached.
+        """
+        if self.user_config.offline and not self.is_cached(destination):
+            raise FileNotFoundError(
+                f"{destination} is not in the cache, and cannot be downloaded from "
+                f"{self.url} in offline mode"
+            )
+        if self.digests:
+            object_path = self.user_config.cache.object_path(self.digests)
+            self.user_config.cache.touch(object_path)
+            object_path.parent.mkdir(parents=True, exist_ok=True)
+            with FileLock(object_path):
+                # Another process may have stored the object while we waited
+                if not object_path.exists():
+                    self._download_file(object_path)
+            self.user_config.cache.link(destination, object_path)
+        else:
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            with FileLock(destination):
+                if destination.exists():
+                    LOG.debug(f"{destination} was downloaded by another process")
+                else:
+                    metadata = self._download_file(destination)
+                    self.user_config.cache.write_metadata(destination, metadata)
+        self.user_config.cache.touch(destination)
+
+    def _download_file(
+        self, destination: Path, validators: Optional[Dict[str, str]] = None
+    ) -> Optional[dict]:
+        cache = self.user_config.cache
+        start = time.time()
+        urls = self.user_config.mirrors.order(
+            self.urls, self.headers_for, self.proxies
+        )
+        error = None
+        cache.record_download(destination)
+        for url in urls:
+            try:
+                metadata = download_file(
+                    url,
+                    destination,
+                    http_headers=self.headers_for(url),
+                    proxies=self.user_config.proxies,
+                    show_progress=self.user_config.show_progress,
+                    segments=self.user_config.download_segments,
+                    min_segment_size=self.user_config.min_segment_size,
+                    digests=self.digests,
+                    reserve_space=self.user_config.cache.reserve,
+                    validators=validators,
+                    connection_pool=self.user_config.connection_pool
+                )
+            except Exception as err:
+                if len(urls) > 1:
+                    LOG.warning(f"Error downloading {destination} from {url}: {err}")
+                    self.user_config.mirrors.demote(url)
+                error = err
+                continue
+            if metadata is not None:
+                cache.record(
+                    destination, source=url, digests=self.digests,
+                    download_seconds=time.time() - start
+                )
+            return metadata
+
+        raise RuntimeError(f"Error localizing url {' '.join(urls)}") from error
+
+    @property
+    def url(self) -> str:
+        """
+        The URL of the file - the first of the mirror URLs.
+        """
+        return self.urls[0]
+
+    @property
+    def cache_key(self) -> str:
+        """
+        Key that identifies the content of the file - the digest, if known,
+        otherwise the URL(s).
+        """
+        if self.digests:
+            return ":".join(select_digest(self.digests))
+        return " ".join(self.urls)
 
     @property
     def http_headers(self) -> dict:
+        """
+        The HTTP headers to send with requests for `url`.
+        """
+        return self.headers_for(self.url)
+
+    def headers_for(self, url: str) -> dict:
+        """
+        Gets the HTTP headers to send with requests for one of the mirror URLs.
+        Headers specified for the data file apply to all mirrors, while headers
+        in the user configuration apply to the URLs that match their patterns.
+
+        Args:
+            url: The URL.
+
+        Returns:
+            Mapping of header name to value.
+        """
         http_headers = {}
 
         if self._http_headers:
@@ -209,7 +551,7 @@ class UrlLocalizer(Localizer):
                 name = value_dict["name"]
                 pattern = value_dict.get("pattern")
                 if name not in http_headers and (
-                    pattern is None or pattern.match(self.url)
+                    pattern is None or pattern.match(url)
                 ):
                     value = resolve_value_descriptor(value_dict)
                     if value:
@@ -237,13 +579,260 @@ class StringLocalizer(Localizer):
 
 class LinkLocalizer(Localizer):
     """
-    Localizes a file to another destination using a symlink.
+    Localizes a file to another destination using a link or copy. A copy (or
+    clone) is given the modification time of the source, so that it can be
+    revalidated against the source.
+
+    Args:
+        source: The file to localize.
+        strategy: The most preferred localization strategy (see
+            :func:`pytest_wdl.utils.link_file`); defaults to a symlink.
     """
-    def __init__(self, source: Path):
+    def __init__(self, source: Path, strategy: str = LINK_SYMLINK):
         self.source = source
+        self.strategy = strategy
 
     def localize(self, destination: Path):
-        destination.symlink_to(self.source)
+        strategy = link_file(self.source, destination, self.strategy)
+        self._copy_mtime(destination, strategy)
+        LOG.debug(f"Localized {self.source} to {destination} using {strategy}")
+
+    def revalidate(self, destination: Path):
+        """
+        Localizes the source again if `destination` is neither the same file as
+        the source (i.e. a symlink or hard link to it) nor a copy with the same
+        size and modification time, e.g. because the source was edited, or
+        replaced by renaming another file over it.
+        """
+        if self._is_current(destination):
+            return
+        with FileLock(destination):
+            if self._is_current(destination):
+                return
+            # Link under a temporary name and rename it over the stale file, so
+            # that the destination never disappears while it may be in use
+            temp = destination.with_name(f"{destination.name}{PARTIAL_SUFFIX}")
+            if temp.is_symlink() or temp.exists():
+                temp.unlink()
+            strategy = link_file(self.source, temp, self.strategy)
+            self._copy_mtime(temp, strategy)
+            temp.replace(destination)
+        LOG.debug(
+            f"Localized {self.source} to {destination} again using {strategy}, "
+            f"since the source has changed"
+        )
+
+    def _is_current(self, destination: Path) -> bool:
+        try:
+            source_stat = self.source.stat()
+        except FileNotFoundError:
+            LOG.warning(
+                f"Source {self.source} of {destination} no longer exists; using "
+                f"the previously localized file"
+            )
+            return True
+        try:
+            dest_stat = destination.stat()
+        except FileNotFoundError:
+            return False
+        if (dest_stat.st_dev, dest_stat.st_ino) == (
+            source_stat.st_dev, source_stat.st_ino
+        ):
+            return True
+        return not destination.is_symlink() and (
+            dest_stat.st_size == source_stat.st_size and
+            dest_stat.st_mtime_ns == source_stat.st_mtime_ns
+        )
+
+    def _copy_mtime(self, destination: Path, strategy: str) -> None:
+        if strategy in (LINK_REFLINK, LINK_COPY):
+            os.utime(destination, ns=(
+                destination.stat().st_atime_ns, self.source.stat().st_mtime_ns
+            ))
+
+
+class MirrorSelector:
+    """
+    Orders the mirrors of remote data files by how quickly they respond. Each
+    origin (scheme, host, and port) is probed at most once per session, with a
+    HEAD request for the first file requested from it, and the results are
+    reused for all files. Mirrors that fail are moved to the end of the order for
+    the rest of the session.
+
+    Args:
+        timeout: Number of seconds to wait for a response to each probe.
+    """
+    def __init__(self, timeout: float = DEFAULT_PROBE_TIMEOUT):
+        self.timeout = timeout
+        self._latencies: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def order(
+        self,
+        urls: Sequence[str],
+        http_headers: Callable[[str], dict],
+        proxies: Optional[dict] = None
+    ) -> List[str]:
+        """
+        Orders mirror URLs from fastest to slowest, probing any whose origins
+        have not yet been probed.
+
+        Args:
+            urls: The mirror URLs.
+            http_headers: Function that returns the HTTP headers for a URL.
+            proxies: Mapping of proxy type to proxy URL.
+
+        Returns:
+            The URLs, fastest first; URLs whose origins did not respond are last.
+        """
+        if len(urls) < 2:
+            return list(urls)
+
+        with self._lock:
+            to_probe = {}
+            for url in urls:
+                origin = _origin(url)
+                if origin not in self._latencies and origin not in to_probe:
+                    to_probe[origin] = url
+
+        if to_probe:
+            with ThreadPoolExecutor(max_workers=len(to_probe)) as executor:
+                latencies = executor.map(
+                    lambda url: probe_url(url, http_headers(url), proxies, self.timeout),
+                    to_probe.values()
+                )
+                for origin, latency in zip(to_probe.keys(), latencies):
+                    LOG.debug(f"Mirror {origin} responded in {latency} seconds")
+                    with self._lock:
+                        self._latencies.setdefault(
+                            origin, math.inf if latency is None else latency
+                        )
+
+        with self._lock:
+            return sorted(
+                urls, key=lambda url: self._latencies.get(_origin(url), math.inf)
+            )
+
+    def demote(self, url: str) -> None:
+        """
+        Moves the origin of a URL that failed to the end of the order.
+        """
+        with self._lock:
+            self._latencies[_origin(url)] = math.inf
+
+
+def _origin(url: str) -> str:
+    parts = parse.urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class Prefetcher:
+    """
+    Localizes remote data files in the background using a bounded thread pool.
+    Downloaded and copied files only appear at their destination once they are
+    complete, so a file that exists at its destination is fully localized.
+
+    Args:
+        max_workers: Maximum number of files to localize concurrently.
+    """
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures: Dict[Path, Future] = {}
+        self._source_futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, destination: Path, localizer: UrlLocalizer) -> Future:
+        """
+        Schedules localization of a file. If the same URL has already been
+        scheduled for a different destination (or a file with the same digest),
+        the file is only downloaded once and then copied to `destination`.
+
+        Args:
+            destination: Path to which the file is to be localized.
+            localizer: The localizer for the remote file.
+
+        Returns:
+            A `Future` that resolves to `destination` once the file is localized.
+        """
+        with self._lock:
+            future = self._futures.get(destination)
+            if future is None:
+                source_future = self._source_futures.get(localizer.cache_key)
+                if source_future is None:
+                    future = self._executor.submit(
+                        self._localize, localizer, destination
+                    )
+                    self._source_futures[localizer.cache_key] = future
+                else:
+                    future = self._executor.submit(
+                        self._copy, source_future, localizer, destination
+                    )
+                self._futures[destination] = future
+            return future
+
+    def wait(self, destination: Path) -> bool:
+        """
+        Blocks until the localization of `destination` (if any) is complete.
+
+        Args:
+            destination: Path to which the file is being localized.
+
+        Returns:
+            True if `destination` was localized successfully in the background,
+            otherwise False.
+        """
+        with self._lock:
+            future = self._futures.get(destination)
+        if future is None:
+            return False
+        try:
+            future.result()
+        except Exception as err:
+            LOG.warning(f"Background localization of {destination} failed: {err}")
+            return False
+        return destination.exists()
+
+    def shutdown(self) -> None:
+        """
+        Cancels pending localizations and waits for running ones to finish.
+        """
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+        self._executor.shutdown(wait=True)
+
+    @staticmethod
+    def _localize(localizer: UrlLocalizer, destination: Path) -> Path:
+        if destination.exists():
+            localizer.refresh(destination)
+        else:
+            localizer.download(destination)
+        return destination
+
+    @staticmethod
+    def _copy(
+        source_future: Future, localizer: UrlLocalizer, destination: Path
+    ) -> Path:
+        source = source_future.result()
+        if localizer.digests:
+            # The object is now in the cache, so this only creates the link
+            localizer.download(destination)
+            return destination
+        temp = destination.with_name(f"{destination.name}{PARTIAL_SUFFIX}")
+        if temp.is_symlink() or temp.exists():
+            temp.unlink()
+        try:
+            # Use the configured strategy, but never a symlink, since the source
+            # may be evicted or replaced independently of the destination
+            strategy = localizer.user_config.localization_strategy
+            if strategy == LINK_SYMLINK:
+                strategy = LINK_COPY
+            link_file(source, temp, strategy)
+            temp.replace(destination)
+        finally:
+            if temp.exists():
+                temp.unlink()
+        return destination
 
 
 class DataFile:
@@ -255,12 +844,29 @@ class DataFile:
         localizer: Localizer object, for persisting the file on the local disk.
         allowed_diff_lines: Number of lines by which the file is allowed to differ
             from another and still be considered equal.
+        catalog: Cache catalog in which to memoize the digests of compared files
+            that are in the cache directory, so that unchanged files are not hashed
+            again.
+        hash_algorithm: Name of the `hashlib` algorithm used to compare files
+            that must be identical (e.g. 'md5', 'sha256', or 'blake2b').
+        unordered: Whether to compare the lines of files regardless of their
+            order, i.e. as multisets of lines.
+
+    Attributes:
+        cpu_bound: Whether comparing files of this type is dominated by work done
+            in Python, in which case executors compare them in separate processes
+            rather than in threads.
     """
+    cpu_bound = False
+
     def __init__(
         self,
         local_path: Path,
         localizer: Optional[Localizer] = None,
-        allowed_diff_lines: Optional[int] = 0
+        allowed_diff_lines: Optional[int] = 0,
+        catalog: Optional[Catalog] = None,
+        hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+        unordered: bool = False
     ):
         if localizer is None and not local_path.exists():
             raise ValueError(
@@ -269,22 +875,42 @@ class DataFile:
         self.local_path = local_path
         self.localizer = localizer
         self.allowed_diff_lines = allowed_diff_lines or 0
+        self.catalog = catalog
+        if (
+            hash_algorithm not in hashlib.algorithms_available or
+            hash_algorithm.startswith("shake_")
+        ):
+            raise ValueError(f"Unsupported hash algorithm {hash_algorithm}")
+        self.hash_algorithm = hash_algorithm
+        self.unordered = unordered
 
     @property
     def path(self) -> Path:
         if not self.local_path.exists():
             self.localizer.localize(self.local_path)
+        elif self.localizer:
+            self.localizer.revalidate(self.local_path)
         return self.local_path
 
     def __str__(self) -> str:
         return str(self.local_path)
 
+    def __getstate__(self) -> dict:
+        # The localizer and catalog hold locks and open connections; a copy sent
+        # to another process only compares the already-localized file
+        state = self.__dict__.copy()
+        state["localizer"] = None
+        state["catalog"] = None
+        return state
+
     def assert_contents_equal(self, other: Union[str, Path, "DataFile"]) -> None:
         """
         Assert the contents of two files are equal.
 
-        If `allowed_diff_lines == 0`, files are compared using MD5 hashes, otherwise
-        their contents are compared using the linux `diff` command.
+        If `allowed_diff_lines == 0`, files are compared by size and then by their
+        hashes (using `hash_algorithm`), or, if either file is gzip-compressed, by
+        the hashes of their decompressed contents. Otherwise (or if `unordered`)
+        their contents are compared line by line (see :mod:`pytest_wdl.compare`).
 
         Args:
             other: A `DataFile` or string file path.
@@ -304,49 +930,123 @@ class DataFile:
 
         self._assert_contents_equal(self.path, other_path, allowed_diff_lines)
 
-    @classmethod
     def _assert_contents_equal(
-        cls, file1: Path, file2: Path, allowed_diff_lines: int
+        self, file1: Path, file2: Path, allowed_diff_lines: int
     ) -> None:
-        if allowed_diff_lines:
-            cls._diff_contents(file1, file2, allowed_diff_lines)
+        if allowed_diff_lines or self.unordered:
+            self._diff_contents(file1, file2, allowed_diff_lines)
+        elif is_gzip(file1) or is_gzip(file2):
+            # Compressed bytes depend on the compressor and on header fields such
+            # as the modification time, so compare the decompressed contents
+            self._compare_decompressed_hashes(file1, file2)
         else:
-            cls._compare_hashes(file1, file2)
-
-    @classmethod
-    def _diff_contents(cls, file1: Path, file2: Path, allowed_diff_lines: int) -> None:
-        if file1.suffix == ".gz":
-            with tempdir() as temp:
-                temp_file1 = temp / "file1"
-                temp_file2 = temp / "file2"
-                delegator.run(f"gunzip -c {file1} > {temp_file1}", block=True)
-                delegator.run(f"gunzip -c {file2} > {temp_file2}", block=True)
-                diff_lines = cls._diff(temp_file1, temp_file2)
+            self._compare_hashes(file1, file2)
+
+    def _diff_contents(self, file1: Path, file2: Path, allowed_diff_lines: int) -> None:
+        if _accepts_keyword(self._diff, "limit"):
+            result = self._diff(file1, file2, limit=allowed_diff_lines)
         else:
-            diff_lines = cls._diff(file1, file2)
+            # Subclasses may override `_diff` without the `limit` parameter
+            result = self._diff(file1, file2)
 
-        if diff_lines > allowed_diff_lines:
-            raise AssertionError(
-                f"{diff_lines} lines (which is > {allowed_diff_lines} allowed) are "
+        if isinstance(result, int):
+            # Subclasses may return only the number of differing lines
+            result = DiffResult(result, [])
+
+        if result.count > allowed_diff_lines:
+            if result.complete:
+                count = f"{result.count} lines"
+            else:
+                count = f"More than {allowed_diff_lines} lines"
+            message = (
+                f"{count} (which is > {allowed_diff_lines} allowed) are "
                 f"different between files {file1}, {file2}"
             )
+            if result.sample:
+                message += f"; first differing lines:\n{result}"
+            raise AssertionError(message)
+
+    def _diff(
+        self, file1: Path, file2: Path, limit: Optional[int] = None
+    ) -> Union[DiffResult, int]:
+        """
+        Compares two files line by line, or regardless of the order of the lines
+        if `unordered`. Gzip-compressed files are decompressed while they are
+        compared.
+
+        Args:
+            file1: First file to compare
+            file2: Second file to compare
+            limit: Stop comparing once more than this many lines differ.
+
+        Returns:
+            A `DiffResult`, or (in subclasses) the number of differing lines.
+        """
+        if self.unordered:
+            return diff_unordered(
+                lambda: read_lines(file1), lambda: read_lines(file2), limit=limit
+            )
+        return diff_files(file1, file2, limit=limit)
 
-    @classmethod
-    def _diff(cls, file1: Path, file2: Path) -> int:
-        cmd = f"diff -y --suppress-common-lines {file1} {file2} | grep '^' | wc -l"
-        return int(delegator.run(cmd, block=True).out)
-
-    @classmethod
-    def _compare_hashes(cls, file1: Path, file2: Path) -> None:
-        with open(file1, "rb") as inp1:
-            file1_md5 = hashlib.md5(inp1.read()).hexdigest()
-        with open(file2, "rb") as inp2:
-            file2_md5 = hashlib.md5(inp2.read()).hexdigest()
-        if file1_md5 != file2_md5:
+    def _compare_hashes(self, file1: Path, file2: Path) -> None:
+        size1 = file1.stat().st_size
+        size2 = file2.stat().st_size
+        if size1 != size2:
+            raise AssertionError(
+                f"Sizes differ between expected identical files {file1} "
+                f"({size1} bytes), {file2} ({size2} bytes)"
+            )
+        # The files are hashed in blocks, concurrently; hashlib releases the GIL
+        # while hashing each block
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            digest1, digest2 = executor.map(self._digest, (file1, file2))
+        if digest1 != digest2:
             raise AssertionError(
-                f"MD5 hashes differ between expected identical files "
-                f"{file1}, {file2}"
+                f"{self.hash_algorithm.upper()} hashes differ between expected "
+                f"identical files {file1}, {file2}"
+            )
+
+    def _compare_decompressed_hashes(self, file1: Path, file2: Path) -> None:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            digest1, digest2 = executor.map(
+                self._decompressed_digest, (file1, file2)
+            )
+        if digest1 != digest2:
+            raise AssertionError(
+                f"{self.hash_algorithm.upper()} hashes differ between the "
+                f"decompressed contents of expected identical files {file1}, "
+                f"{file2}"
+            )
+
+    def _decompressed_digest(self, path: Path) -> str:
+        hasher = hashlib.new(self.hash_algorithm)
+        with open_file(path) as inp:
+            for block in iter(lambda: inp.read(HASH_BLOCK_SIZE), b""):
+                hasher.update(block)
+        return hasher.hexdigest()
+
+    def _digest(self, path: Path) -> str:
+        if self.catalog:
+            return self.catalog.digest(path, self.hash_algorithm)
+        return file_digests(path, [self.hash_algorithm])[self.hash_algorithm]
+
+
+def _accepts_keyword(func: Callable, name: str) -> bool:
+    """
+    Whether `func` accepts a keyword argument called `name`.
+    """
+    try:
+        parameters = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    return any(
+        param.kind == param.VAR_KEYWORD or (
+            param.name == name and param.kind in (
+                param.POSITIONAL_OR_KEYWORD, param.KEYWORD_ONLY
             )
+        )
+        for param in parameters
+    )
 
 
 DATA_TYPES = plugin_factory_map(DataFile, "pytest_wdl.data_types")
@@ -429,16 +1129,69 @@ class DataResolver:
         else:
             return value
 
+    def prefetch(self) -> None:
+        """
+        Starts localizing all remote data files that are not already present in
+        the cache, and revalidating those that are present, if they are due.
+        Does nothing if background localization is disabled in the user
+        configuration.
+        """
+        prefetcher = self.user_config.prefetcher
+        if not prefetcher:
+            return
+
+        for name, data_file in self._url_data_files():
+            localizer = cast(UrlLocalizer, data_file.localizer)
+            if (
+                not data_file.local_path.exists() or
+                localizer.needs_revalidation(data_file.local_path)
+            ):
+                prefetcher.submit(data_file.local_path, localizer)
+
+    def find_uncached(self) -> List[Tuple[str, str]]:
+        """
+        Finds the remote data files that are not available locally, e.g. to
+        report them all at once in offline mode.
+
+        Returns:
+            List of tuples (name, url).
+        """
+        return [
+            (name, cast(UrlLocalizer, data_file.localizer).url)
+            for name, data_file in self._url_data_files()
+            if not cast(UrlLocalizer, data_file.localizer).is_cached(
+                data_file.local_path
+            )
+        ]
+
+    def _url_data_files(self) -> Iterator[Tuple[str, DataFile]]:
+        """
+        Yields the data files that are localized from URLs. Descriptors that
+        cannot be resolved are skipped, since they may depend on a test's data
+        directories.
+        """
+        for name, value in self.data_descriptors.items():
+            if not (isinstance(value, dict) and "url" in value):
+                continue
+            try:
+                data_file = self.resolve(name)
+            except Exception as err:
+                LOG.debug(f"Could not resolve data file {name}: {err}")
+                continue
+            if isinstance(data_file.localizer, UrlLocalizer):
+                yield name, data_file
+
     def create_data_file(
         self,
         type: Optional[str] = "default",
         name: Optional[str] = None,
         path: Optional[str] = None,
-        url: Optional[str] = None,
+        url: Optional[Union[str, List[str]]] = None,
         contents: Optional[str] = None,
         env: Optional[str] = None,
         datadirs: Optional[DataDirs] = None,
         http_headers: Optional[dict] = None,
+        digests: Optional[Dict[str, str]] = None,
         **kwargs
     ) -> DataFile:
         data_file_class = DATA_TYPES.get(type, DataFile)
@@ -449,20 +1202,35 @@ class DataResolver:
             local_path = ensure_path(path, self.user_config.cache_dir)
 
         if local_path and local_path.exists():
-            pass
+            # Enables the file to be revalidated against its source
+            if url:
+                localizer = UrlLocalizer(url, self.user_config, http_headers, digests)
+            elif env and env in os.environ:
+                localizer = LinkLocalizer(
+                    ensure_path(os.environ[env], exists=True),
+                    self.user_config.localization_strategy
+                )
+            elif name and datadirs:
+                dd_path = _find_in_datadirs(name, datadirs)
+                if dd_path:
+                    localizer = LinkLocalizer(
+                        dd_path, self.user_config.localization_strategy
+                    )
         elif env and env in os.environ:
             env_path = ensure_path(os.environ[env], exists=True)
             if not local_path:
                 local_path = env_path
             else:
-                localizer = LinkLocalizer(env_path)
+                localizer = LinkLocalizer(
+                    env_path, self.user_config.localization_strategy
+                )
         elif url:
-            localizer = UrlLocalizer(url, self.user_config, http_headers)
+            localizer = UrlLocalizer(url, self.user_config, http_headers, digests)
             if not local_path:
                 if name:
                     local_path = ensure_path(self.user_config.cache_dir / name)
                 else:
-                    filename = url.rsplit("/", 1)[1]
+                    filename = localizer.url.rsplit("/", 1)[1]
                     local_path = ensure_path(self.user_config.cache_dir / filename)
         elif contents:
             localizer = StringLocalizer(contents)
@@ -474,11 +1242,8 @@ class DataResolver:
                         tempfile.mktemp(dir=self.user_config.cache_dir)
                     )
         elif name and datadirs:
-            for dd in datadirs.paths:
-                dd_path = dd / name
-                if dd_path.exists():
-                    break
-            else:
+            dd_path = _find_in_datadirs(name, datadirs)
+            if not dd_path:
                 raise FileNotFoundError(
                     f"File {name} not found in any of the following datadirs: "
                     f"{datadirs.paths}"
@@ -486,14 +1251,31 @@ class DataResolver:
             if not local_path:
                 local_path = dd_path
             else:
-                localizer = LinkLocalizer(dd_path)
+                localizer = LinkLocalizer(
+                    dd_path, self.user_config.localization_strategy
+                )
         else:
             raise FileNotFoundError(
                 f"File {path or name} does not exist. Either a url, file contents, "
                 f"or a local file must be provided."
             )
 
-        return data_file_class(local_path, localizer, **kwargs)
+        self.user_config.cache.touch(local_path)
+
+        data_file = data_file_class(local_path, localizer, **kwargs)
+        # Set after construction rather than passed to the constructor, since
+        # plugin data types need not accept a catalog argument
+        if self.user_config.cache.catalog is not None:
+            data_file.catalog = self.user_config.cache.catalog
+        return data_file
+
+
+def _find_in_datadirs(name: str, datadirs: DataDirs) -> Optional[Path]:
+    for dd in datadirs.paths:
+        dd_path = dd / name
+        if dd_path.exists():
+            return dd_path
+    return None
 
 
 class DataManager:
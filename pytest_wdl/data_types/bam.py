@@ -16,13 +16,26 @@
 #    limitations under the License.
 
 """
-Convert BAM to SAM for diff.
+Compare BAM files as SAM text, record by record.
+
+When both files are coordinate-sorted and indexed, the records are compared in
+shards (regions of each reference sequence, plus the reads without coordinates)
+in a process pool, and the differences are summed over the shards.
+
+If the order of the records is not deterministic, the records can instead be
+compared regardless of their order (see :func:`pytest_wdl.compare.diff_unordered`).
 """
+from concurrent.futures import ThreadPoolExecutor
+import os
 from pathlib import Path
 import re
-from typing import Optional
+from typing import Iterator, List, Optional, Tuple
 
-from pytest_wdl.core import DataFile, tempdir
+from pytest_wdl.compare import (
+    DEFAULT_MAX_SAMPLE, DiffLine, DiffResult, diff_lines, diff_unordered
+)
+from pytest_wdl.core import DataFile
+from pytest_wdl.utils import in_worker_process, process_pool
 
 
 try:
@@ -34,44 +47,225 @@ except ImportError:
     )
 
 
+SHARD_SIZE = 10_000_000
+"""Length (in bases) of the reference regions compared in each shard."""
+MIN_SHARDED_SIZE = 64 * 1024 * 1024
+"""Smallest BAM file (in bytes) that is compared in shards."""
+UNPLACED = "*"
+DECOMPRESS_THREADS = 4
+"""Maximum number of threads used by htslib to decompress each BAM file."""
+
+Shard = Tuple[str, Optional[int], Optional[int]]
+
+
 class BamDataFile(DataFile):
     """
-    Supports comparing output of BAM file. This uses pysam to convert BAM to
-    SAM, so that DataFile can carry out a regular diff on the SAM files.
+    Supports comparing output of BAM file. This uses pysam to read the header and
+    records of both files as SAM lines, which are compared in lock-step, so that
+    neither file is converted to SAM in memory or on disk.
+
+    Args:
+        processes: Maximum number of processes used to compare coordinate-sorted,
+            indexed BAM files in shards; defaults to the number of CPUs. If 1, the
+            files are always compared in a single pass. Files compared in a single
+            pass are decompressed by this many threads (but at most
+            `DECOMPRESS_THREADS`) each.
+        kwargs: Arguments to :class:`pytest_wdl.core.DataFile`. If `unordered`,
+            the records are compared regardless of their order, but the header
+            lines are still compared in order.
     """
-    @classmethod
+    cpu_bound = True
+
+    def __init__(
+        self,
+        *args,
+        processes: Optional[int] = None,
+        **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.processes = processes or os.cpu_count() or 1
+
     def _assert_contents_equal(
-        cls, file1: Path, file2: Path, allowed_diff_lines: Optional[int] = None
+        self, file1: Path, file2: Path, allowed_diff_lines: Optional[int] = None
     ):
-        cls._diff_contents(file1, file2, allowed_diff_lines)
+        self._diff_contents(file1, file2, allowed_diff_lines)
 
-    @classmethod
-    def _diff(cls, file1: Path, file2: Path):
+    def _diff(
+        self, file1: Path, file2: Path, limit: Optional[int] = None
+    ) -> DiffResult:
         """
-        Special handling for BAM files to read them into SAM so we can
+        Special handling for BAM files to read them as SAM so we can
         compare them.
 
         Args:
-            file1:
-            file2:
+            file1: First file to compare
+            file2: Second file to compare
+            limit: Stop comparing once more than this many lines differ
+
+        Returns:
+            A `DiffResult`.
         """
-        with tempdir() as temp:
-            cmp_file1 = temp / "file1"
-            cmp_file2 = temp / "file2"
-            _bam_to_sam(file1, cmp_file1)
-            _bam_to_sam(file2, cmp_file2)
-            return super()._diff(cmp_file1, cmp_file2)
-
-
-def _bam_to_sam(input_bam: Path, output_sam: Path):
-    """Use PySAM to convert bam to sam."""
-    samfile = pysam.view("-h", str(input_bam))
-    # avoid trailing newline.
-    newline = ""
-    with open(output_sam, "w") as file_handle:
-        for row in samfile.splitlines():
-            file_handle.write(newline + _remove_samtools_randomness(row))
-            newline = "\n"
+        threads = min(self.processes, DECOMPRESS_THREADS)
+        with pysam.AlignmentFile(str(file1), "rb", threads=threads) as bam1, \
+                pysam.AlignmentFile(str(file2), "rb", threads=threads) as bam2:
+            shards = None if self.unordered else self._shards(
+                file1, file2, bam1, bam2
+            )
+            if not (shards or self.unordered):
+                return diff_lines(_sam_lines(bam1), _sam_lines(bam2), limit)
+
+            result = diff_lines(_header_lines(bam1), _header_lines(bam2), limit)
+
+        if not result.complete:
+            return result
+
+        if self.unordered:
+            records_result = diff_unordered(
+                lambda: _record_lines(file1, threads),
+                lambda: _record_lines(file2, threads),
+                None if limit is None else limit - result.count
+            )
+            return DiffResult(
+                result.count + records_result.count,
+                (result.sample + records_result.sample)[:DEFAULT_MAX_SAMPLE],
+                records_result.complete
+            )
+
+        return _diff_shards(
+            file1, file2, shards, limit, result, min(self.processes, len(shards))
+        )
+
+    def _shards(
+        self,
+        file1: Path,
+        file2: Path,
+        bam1: "pysam.AlignmentFile",
+        bam2: "pysam.AlignmentFile"
+    ) -> Optional[List[Shard]]:
+        """
+        Splits the files into shards if they can be compared in parallel.
+
+        Returns:
+            List of shards (contig, start, end), or None if the files should be
+            compared in a single pass.
+        """
+        if (
+            self.processes < 2 or
+            # Workers of another process pool (e.g. the one in which executors
+            # check outputs) do not start pools of their own
+            in_worker_process() or
+            max(file1.stat().st_size, file2.stat().st_size) < MIN_SHARDED_SIZE or
+            not (_is_sorted(bam1) and _is_sorted(bam2)) or
+            not (bam1.has_index() and bam2.has_index()) or
+            bam1.references != bam2.references or
+            bam1.lengths != bam2.lengths
+        ):
+            return None
+
+        shards: List[Shard] = [
+            (contig, start, min(start + SHARD_SIZE, length))
+            for contig, length in zip(bam1.references, bam1.lengths)
+            for start in range(0, length, SHARD_SIZE)
+        ]
+        shards.append((UNPLACED, None, None))
+        return shards
+
+
+def _diff_shards(
+    file1: Path,
+    file2: Path,
+    shards: List[Shard],
+    limit: Optional[int],
+    header_result: DiffResult,
+    processes: int
+) -> DiffResult:
+    """
+    Compares the records of two BAM files shard by shard in a process pool (or,
+    in Python 3.6, one at a time in this process), and adds up the differences.
+    The comparison stops once more than `limit` lines differ in total.
+    """
+    count = header_result.count
+    results = {}
+    complete = True
+    futures = []
+    executor = process_pool(processes) or ThreadPoolExecutor(max_workers=1)
+    try:
+        futures = [
+            executor.submit(_diff_shard, file1, file2, shard, limit)
+            for shard in shards
+        ]
+        for i, future in enumerate(futures):
+            result = future.result()
+            results[i] = result
+            count += result.count
+            if limit is not None and count > limit:
+                complete = False
+                break
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+
+    # Line numbers are relative to each shard, so they are not reported
+    sample = list(header_result.sample)
+    for i in sorted(results.keys()):
+        sample.extend(
+            DiffLine(None, diff.line1, None, diff.line2)
+            for diff in results[i].sample
+        )
+    return DiffResult(count, sample[:DEFAULT_MAX_SAMPLE], complete)
+
+
+def _diff_shard(
+    file1: Path, file2: Path, shard: Shard, limit: Optional[int] = None
+) -> DiffResult:
+    with pysam.AlignmentFile(str(file1), "rb") as bam1, \
+            pysam.AlignmentFile(str(file2), "rb") as bam2:
+        return diff_lines(
+            _shard_lines(bam1, shard), _shard_lines(bam2, shard), limit
+        )
+
+
+def _shard_lines(bam: "pysam.AlignmentFile", shard: Shard) -> Iterator[str]:
+    """
+    Yield the records in a shard as SAM lines. A region yields the records that
+    start in it, rather than all the records that overlap it, so that every
+    record belongs to exactly one shard.
+    """
+    contig, start, end = shard
+    if contig == UNPLACED:
+        records = bam.fetch(contig)
+    else:
+        records = (
+            record
+            for record in bam.fetch(contig, start, end)
+            if record.reference_start >= start
+        )
+    for record in records:
+        yield _remove_samtools_randomness(record.to_string())
+
+
+def _is_sorted(bam: "pysam.AlignmentFile") -> bool:
+    return bam.header.to_dict().get("HD", {}).get("SO") == "coordinate"
+
+
+def _header_lines(bam: "pysam.AlignmentFile") -> Iterator[str]:
+    for line in str(bam.header).splitlines():
+        yield _remove_samtools_randomness(line)
+
+
+def _record_lines(path: Path, threads: int = 1) -> Iterator[str]:
+    """Yield the records of a BAM file as SAM lines."""
+    with pysam.AlignmentFile(str(path), "rb", threads=threads) as bam:
+        for record in bam.fetch(until_eof=True):
+            yield _remove_samtools_randomness(record.to_string())
+
+
+def _sam_lines(bam: "pysam.AlignmentFile") -> Iterator[str]:
+    """Yield the header lines and the records of a BAM file as SAM lines."""
+    yield from _header_lines(bam)
+    for record in bam.fetch(until_eof=True):
+        yield _remove_samtools_randomness(record.to_string())
 
 
 def _remove_samtools_randomness(sam_line):
@@ -0,0 +1,501 @@
+#    Copyright 2019 Eli Lilly and Company
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Compare delimited tables (e.g. metrics and QC reports), allowing numeric values to
+differ within a tolerance.
+
+Rows are read in chunks, and each column of a chunk is compared as a NumPy
+array: numeric columns with `numpy.isclose`, and other columns exactly. Whether
+a column is numeric is decided once per table, from the first chunk of the
+expected table unless the numeric columns are given explicitly. If key
+columns are given, rows are matched by key rather than by position; the rows of
+large tables are first partitioned by the hash of their key into temporary
+files, so that only one partition of each table is in memory at a time.
+"""
+import csv
+import hashlib
+import io
+import re
+from itertools import islice
+from pathlib import Path
+from typing import (
+    Dict, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple, Union, cast
+)
+
+from pytest_wdl.compare import open_file
+from pytest_wdl.core import DataFile
+from pytest_wdl.utils import tempdir
+
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError(
+        "Failed to import dependencies for tsv and csv types. To add support for "
+        "delimited tables, install the plugin with pip install pytest-wdl[tsv]"
+    )
+
+
+CHUNK_SIZE = 10000
+"""Number of rows compared at a time."""
+PARTITION_SIZE = 64 * 1024 * 1024
+"""Approximate size (in bytes) of each partition of a table compared by key."""
+MAX_PARTITIONS = 256
+MAX_SAMPLE = 10
+MISSING_VALUES = ("", ".", "NA", "N/A")
+"""Values that are allowed in (but not compared as numbers in) numeric columns."""
+ZERO_PADDED_RE = re.compile(r"[+-]?0\d")
+
+Row = List[str]
+
+
+class TableDiff(NamedTuple):
+    """
+    The result of comparing two tables.
+
+    Attributes:
+        count: Number of differing rows, including rows only in one table. If
+            `complete` is False, the comparison stopped once this exceeded the
+            limit.
+        sample: Descriptions of the first differences.
+        complete: Whether the tables were compared to the end.
+    """
+    count: int
+    sample: List[str]
+    complete: bool = True
+
+
+class TsvDataFile(DataFile):
+    """
+    Compares tab-delimited tables.
+
+    Args:
+        header: Whether the first row contains the column names. The column names
+            must be equal in both tables.
+        key_columns: Names (if `header` is True) or 0-based indices of the columns
+            that identify a row. If specified, rows are matched by key, regardless
+            of their order. Key columns are always compared as strings.
+        numeric_columns: Names (if `header` is True) or 0-based indices of the
+            columns whose values are compared as numbers, within tolerance; all
+            other columns are compared as strings. If not specified, a column is
+            numeric if all of its values in the first chunk of rows of the
+            expected table are numbers (or in `MISSING_VALUES`), and none of
+            them is zero-padded (like an ID such as "007").
+        abs_tolerance: Maximum absolute difference between numeric values.
+        rel_tolerance: Maximum difference between numeric values, relative to the
+            value in the expected table.
+        kwargs: Arguments to :class:`pytest_wdl.core.DataFile`. Here,
+            `allowed_diff_lines` is the number of rows that may differ.
+    """
+    cpu_bound = True
+    delimiter = "\t"
+
+    def __init__(
+        self,
+        *args,
+        header: bool = True,
+        key_columns: Optional[Sequence[Union[str, int]]] = None,
+        numeric_columns: Optional[Sequence[Union[str, int]]] = None,
+        abs_tolerance: float = 0.0,
+        rel_tolerance: float = 0.0,
+        **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        for kind, columns in (("Key", key_columns), ("Numeric", numeric_columns)):
+            if columns is not None and not header and not all(
+                isinstance(column, int) for column in columns
+            ):
+                raise ValueError(
+                    f"{kind} columns must be specified by index if the table has "
+                    f"no header"
+                )
+        self.header = header
+        self.key_columns = list(key_columns) if key_columns else None
+        self.numeric_columns = (
+            list(numeric_columns) if numeric_columns is not None else None
+        )
+        self.abs_tolerance = abs_tolerance
+        self.rel_tolerance = rel_tolerance
+
+    def _assert_contents_equal(
+        self, file1: Path, file2: Path, allowed_diff_lines: Optional[int] = None
+    ):
+        result = self._diff_tables(file1, file2, allowed_diff_lines)
+        if result.count > allowed_diff_lines:
+            if result.complete:
+                count = f"{result.count} rows"
+            else:
+                count = f"More than {allowed_diff_lines} rows"
+            sample = "\n".join(result.sample)
+            raise AssertionError(
+                f"{count} (which is > {allowed_diff_lines} allowed) are different "
+                f"between files {file1}, {file2}; first differences:\n{sample}"
+            )
+
+    def _diff_tables(
+        self, file1: Path, file2: Path, limit: Optional[int] = None
+    ) -> TableDiff:
+        """
+        Compares two tables.
+
+        Args:
+            file1: The expected table.
+            file2: The actual table.
+            limit: Stop comparing once more than this many rows differ.
+
+        Returns:
+            A `TableDiff`.
+
+        Raises:
+            AssertionError: if the tables have different column names.
+            ValueError: if a key or numeric column is not in the header.
+        """
+        with self._open(file1) as inp1, self._open(file2) as inp2:
+            rows1 = csv.reader(inp1, delimiter=self.delimiter)
+            rows2 = csv.reader(inp2, delimiter=self.delimiter)
+            names = None
+            if self.header:
+                names = next(rows1, [])
+                names2 = next(rows2, [])
+                if names != names2:
+                    # Rows cannot be compared column by column, so this is not
+                    # subject to allowed_diff_lines
+                    raise AssertionError(
+                        f"Column names differ between files {file1}, {file2}: "
+                        f"{names} != {names2}"
+                    )
+
+            keys = None
+            if self.key_columns is not None:
+                keys = self._column_indices("Key", self.key_columns, names, file1)
+            numeric = None
+            if self.numeric_columns is not None:
+                numeric = self._column_indices(
+                    "Numeric", self.numeric_columns, names, file1
+                )
+            comparer = _ChunkComparer(
+                names, self.abs_tolerance, self.rel_tolerance, numeric, keys or ()
+            )
+            if keys is None:
+                _diff_ordered(rows1, rows2, comparer, limit)
+            else:
+                partitions = min(
+                    MAX_PARTITIONS,
+                    max(file1.stat().st_size, file2.stat().st_size) //
+                    PARTITION_SIZE + 1
+                )
+                _diff_keyed(rows1, rows2, keys, partitions, comparer, limit)
+
+        return comparer.result(limit)
+
+    @staticmethod
+    def _column_indices(
+        kind: str,
+        columns: List[Union[str, int]],
+        names: Optional[Row],
+        path: Path
+    ) -> List[int]:
+        """
+        Resolves column names to indices, checking them against the header.
+        """
+        if names is None:
+            return cast(List[int], columns)
+        missing = [
+            column for column in columns
+            if column not in names and not (
+                isinstance(column, int) and 0 <= column < len(names)
+            )
+        ]
+        if missing:
+            raise ValueError(
+                f"{kind} columns {missing} are not in the header of {path}; the "
+                f"available columns are {names}"
+            )
+        return [
+            column if isinstance(column, int) else names.index(column)
+            for column in columns
+        ]
+
+    def _open(self, path: Path) -> io.TextIOWrapper:
+        return io.TextIOWrapper(open_file(path), encoding="utf-8", newline="")
+
+
+class CsvDataFile(TsvDataFile):
+    """
+    Compares comma-delimited tables; see :class:`TsvDataFile`.
+    """
+    delimiter = ","
+
+
+class _ChunkComparer:
+    """
+    Compares aligned chunks of rows column by column, and keeps count of the
+    differing rows. Numeric columns are compared within tolerance; if they are
+    not given, they are inferred from the first chunk of the first table.
+    """
+    def __init__(
+        self,
+        names: Optional[Row],
+        abs_tolerance: float,
+        rel_tolerance: float,
+        numeric_columns: Optional[Sequence[int]] = None,
+        string_columns: Sequence[int] = ()
+    ):
+        self.names = names
+        self.abs_tolerance = abs_tolerance
+        self.rel_tolerance = rel_tolerance
+        self.numeric: Optional[Set[int]] = (
+            set(numeric_columns) if numeric_columns is not None else None
+        )
+        self.string_columns = set(string_columns)
+        self.count = 0
+        self.sample: List[str] = []
+
+    def compare(self, rows1: List[Row], rows2: List[Row], labels: List[str]) -> None:
+        """
+        Compares two lists of rows of the same length.
+
+        Args:
+            rows1: Rows of the first table.
+            rows2: Matching rows of the second table.
+            labels: Description of each pair of rows (e.g. row number or key).
+        """
+        if not rows1:
+            return
+        if self.numeric is None:
+            self.numeric = self._infer_numeric(rows1)
+        width = max(len(row) for row in rows1 + rows2)
+        differs = np.zeros(len(rows1), dtype=bool)
+        first_column = np.full(len(rows1), -1)
+        for column in range(width):
+            values1 = [row[column] if column < len(row) else "" for row in rows1]
+            values2 = [row[column] if column < len(row) else "" for row in rows2]
+            column_differs = self._compare_column(
+                values1, values2, column in self.numeric
+            )
+            first_column[column_differs & ~differs] = column
+            differs |= column_differs
+
+        self.count += int(differs.sum())
+        for i in np.flatnonzero(differs)[:MAX_SAMPLE - len(self.sample)]:
+            column = int(first_column[i])
+            name = self.names[column] if self.names and column < len(self.names) \
+                else column
+            value1 = rows1[i][column] if column < len(rows1[i]) else ""
+            value2 = rows2[i][column] if column < len(rows2[i]) else ""
+            self.sample.append(f"{labels[i]}: column {name}: {value1} != {value2}")
+
+    def add_missing(self, label: str) -> None:
+        """Counts a row that is only in one table."""
+        self.count += 1
+        if len(self.sample) < MAX_SAMPLE:
+            self.sample.append(label)
+
+    def exceeds(self, limit: Optional[int]) -> bool:
+        return limit is not None and self.count > limit
+
+    def result(self, limit: Optional[int]) -> TableDiff:
+        return TableDiff(self.count, self.sample, not self.exceeds(limit))
+
+    def _infer_numeric(self, rows: List[Row]) -> Set[int]:
+        """
+        Returns the indices of the columns whose values are all numbers (or
+        missing), and not zero-padded.
+        """
+        width = max(len(row) for row in rows)
+        numeric = set()
+        for column in range(width):
+            if column in self.string_columns:
+                continue
+            values = [
+                row[column] for row in rows
+                if column < len(row) and row[column] not in MISSING_VALUES
+            ]
+            if values and _to_numbers(values)[1].all() and not any(
+                ZERO_PADDED_RE.match(value) for value in values
+            ):
+                numeric.add(column)
+        return numeric
+
+    def _compare_column(
+        self, values1: List[str], values2: List[str], numeric: bool
+    ) -> "np.ndarray":
+        """
+        Returns a boolean array of the positions at which two columns differ. In
+        a numeric column, values that are both numbers are compared within
+        tolerance, and other values exactly.
+        """
+        strings1 = np.array(values1, dtype=object)
+        strings2 = np.array(values2, dtype=object)
+        differs = strings1 != strings2
+        if not numeric or not differs.any():
+            return differs
+        numbers1, numeric1 = _to_numbers(values1)
+        numbers2, numeric2 = _to_numbers(values2)
+        numeric = numeric1 & numeric2
+        close = np.isclose(
+            numbers2, numbers1, rtol=self.rel_tolerance, atol=self.abs_tolerance,
+            equal_nan=True
+        )
+        return np.where(numeric, ~close, differs)
+
+
+def _to_numbers(values: List[str]) -> Tuple["np.ndarray", "np.ndarray"]:
+    """
+    Converts a column to floats.
+
+    Returns:
+        A tuple (numbers, numeric), where `numeric` is a boolean array of the
+        values that are numbers, and `numbers` is NaN elsewhere.
+    """
+    try:
+        numbers = np.array(values, dtype=float)
+        return numbers, np.ones(len(values), dtype=bool)
+    except ValueError:
+        pass
+    numbers = np.full(len(values), np.nan)
+    numeric = np.zeros(len(values), dtype=bool)
+    for i, value in enumerate(values):
+        try:
+            numbers[i] = float(value)
+            numeric[i] = True
+        except ValueError:
+            pass
+    return numbers, numeric
+
+
+def _diff_ordered(
+    rows1: Iterator[Row],
+    rows2: Iterator[Row],
+    comparer: _ChunkComparer,
+    limit: Optional[int]
+) -> None:
+    """
+    Compares the rows of two tables in order, one chunk at a time.
+    """
+    row_number = 0
+    while not comparer.exceeds(limit):
+        chunk1 = list(islice(rows1, CHUNK_SIZE))
+        chunk2 = list(islice(rows2, CHUNK_SIZE))
+        if not (chunk1 or chunk2):
+            break
+        size = min(len(chunk1), len(chunk2))
+        comparer.compare(
+            chunk1[:size], chunk2[:size],
+            [f"row {row_number + i + 1}" for i in range(size)]
+        )
+        for i, _ in enumerate(chunk1[size:], row_number + size + 1):
+            comparer.add_missing(f"row {i}: only in the first file")
+        for i, _ in enumerate(chunk2[size:], row_number + size + 1):
+            comparer.add_missing(f"row {i}: only in the second file")
+        row_number += max(len(chunk1), len(chunk2))
+
+
+def _diff_keyed(
+    rows1: Iterator[Row],
+    rows2: Iterator[Row],
+    keys: List[int],
+    partitions: int,
+    comparer: _ChunkComparer,
+    limit: Optional[int]
+) -> None:
+    """
+    Compares the rows of two tables that have the same key, regardless of their
+    order. If there is more than one partition, the rows are first partitioned by
+    the hash of their key into temporary files.
+    """
+    if partitions == 1:
+        _diff_partition(rows1, rows2, keys, comparer, limit)
+        return
+
+    with tempdir() as temp:
+        paths1 = _partition(rows1, keys, partitions, temp / "1")
+        paths2 = _partition(rows2, keys, partitions, temp / "2")
+        for path1, path2 in zip(paths1, paths2):
+            with open(path1, "rt", newline="") as inp1, \
+                    open(path2, "rt", newline="") as inp2:
+                _diff_partition(
+                    csv.reader(inp1), csv.reader(inp2), keys, comparer, limit
+                )
+            if comparer.exceeds(limit):
+                break
+
+
+def _partition(
+    rows: Iterator[Row], keys: List[int], partitions: int, prefix: Path
+) -> List[Path]:
+    paths = [Path(f"{prefix}.{i}") for i in range(partitions)]
+    files = [open(path, "wt", newline="") for path in paths]
+    try:
+        writers = [csv.writer(out) for out in files]
+        for row in rows:
+            key = "\t".join(_key(row, keys)).encode()
+            digest = hashlib.blake2b(key, digest_size=8).digest()
+            writers[int.from_bytes(digest, "little") % partitions].writerow(row)
+    finally:
+        for out in files:
+            out.close()
+    return paths
+
+
+def _diff_partition(
+    rows1: Iterator[Row],
+    rows2: Iterator[Row],
+    keys: List[int],
+    comparer: _ChunkComparer,
+    limit: Optional[int]
+) -> None:
+    """
+    Compares rows with the same key, in chunks. Rows with duplicate keys are
+    matched in order.
+    """
+    by_key: Dict[Tuple[str, ...], List[Row]] = {}
+    for row in rows1:
+        by_key.setdefault(_key(row, keys), []).append(row)
+
+    chunk1: List[Row] = []
+    chunk2: List[Row] = []
+    labels: List[str] = []
+
+    def compare_chunk():
+        comparer.compare(chunk1, chunk2, labels)
+        chunk1.clear()
+        chunk2.clear()
+        labels.clear()
+
+    for row2 in rows2:
+        key = _key(row2, keys)
+        matches = by_key.get(key)
+        if not matches:
+            comparer.add_missing(f"key {key}: only in the second file")
+        else:
+            chunk1.append(matches.pop(0))
+            chunk2.append(row2)
+            labels.append(f"key {key}")
+            if len(chunk1) >= CHUNK_SIZE:
+                compare_chunk()
+        if comparer.exceeds(limit):
+            return
+    compare_chunk()
+
+    for key, matches in by_key.items():
+        for _ in matches:
+            comparer.add_missing(f"key {key}: only in the first file")
+            if comparer.exceeds(limit):
+                return
+
+
+def _key(row: Row, keys: List[int]) -> Tuple[str, ...]:
+    return tuple(row[i] if i < len(row) else "" for i in keys)
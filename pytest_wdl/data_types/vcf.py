@@ -16,43 +16,797 @@
 Some tools that generate VCF (callers) will result in very slightly different qual
 scores and other floating-point-valued fields when run on different hardware. This
 handler ignores the QUAL and INFO columns and only compares the genotype (GT) field
-of sample columns. Only works for single-sample VCFs.
+of sample columns.
+
+VCF files (plain, gzip- or bgzip-compressed) are read by a streaming record
+reader, and the selected fields of each record are compared line by line.
+
+Alternatively, numeric QUAL, INFO, and FORMAT fields can be compared within a
+tolerance. The records of the two files are then merge-joined on
+(CHROM, POS, REF, ALT), which requires both files to be sorted by position, with
+the contigs in the same order (or declared in `##contig` header lines).
+
+For cohort VCFs, the genotypes of joined records can instead be compared in
+blocks, as NumPy matrices of genotype codes (records x samples), to compute the
+discordance rate of each sample.
 """
+import io
+import math
 from pathlib import Path
-from typing import Optional
-
-import delegator
+import re
+from typing import (
+    Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+)
 
+from pytest_wdl.compare import DiffResult, diff_lines, diff_unordered, open_file
 from pytest_wdl.core import DataFile
-from pytest_wdl.utils import tempdir
+from pytest_wdl.utils import LOG
+
+
+try:
+    import numpy as np
+except ImportError:
+    LOG.debug(
+        "numpy is not installed; VCF genotype concordance will not be available"
+    )
+    np = None
+
+
+MISSING = "."
+QUAL = "QUAL"
+INFO_PREFIX = "INFO/"
+FORMAT_PREFIX = "FORMAT/"
+MAX_SAMPLE = 10
+BLOCK_SIZE = 1000
+"""Number of records whose genotypes are compared as one block."""
+MISSING_GENOTYPE = -1
+ALLELE_SEPARATOR_RE = re.compile(r"[/|]")
+TAB = ord("\t")
+COLON = ord(":")
+
+
+class VcfRecord(NamedTuple):
+    """
+    A VCF data line, split into columns. Columns missing from the end of the line
+    are None (`format`) or empty (`samples`).
+    """
+    chrom: str
+    pos: int
+    id: str
+    ref: str
+    alt: str
+    qual: str
+    filter: str
+    info: str
+    format: Optional[str]
+    samples: List[str]
+
+    @property
+    def info_values(self) -> Dict[str, str]:
+        """
+        The INFO fields, by key. Flags have empty values.
+        """
+        if self.info in ("", MISSING):
+            return {}
+        values = {}
+        for field in self.info.split(";"):
+            key, _, value = field.partition("=")
+            values[key] = value
+        return values
+
+    def format_values(self, key: str) -> List[str]:
+        """
+        The value of a FORMAT field for each sample; missing if the record has no
+        such field.
+        """
+        keys = self.format.split(":") if self.format else []
+        if key not in keys:
+            return [MISSING] * len(self.samples)
+        index = keys.index(key)
+        values = []
+        for sample in self.samples:
+            sample_values = sample.split(":")
+            values.append(
+                sample_values[index] if index < len(sample_values) else MISSING
+            )
+        return values
+
+    @property
+    def genotypes(self) -> List[str]:
+        """
+        The GT field of each sample; missing if the record has no GT field.
+        """
+        if self.format == "GT" or (self.format and self.format.startswith("GT:")):
+            # GT is usually the first field
+            return [sample.partition(":")[0] for sample in self.samples]
+        return self.format_values("GT")
+
+
+class VcfReader:
+    """
+    Reads the records of a VCF file one at a time. The file may be compressed.
+
+    Args:
+        path: The VCF file.
+
+    Attributes:
+        samples: The sample names, from the header line; empty if the file has no
+            header line.
+        contigs: The contig names declared in `##contig` header lines, in order.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.samples: List[str] = []
+        self.contigs: List[str] = []
+        self._file = io.TextIOWrapper(open_file(path), encoding="utf-8")
+        self._line: Optional[str] = None
+        for line in self._file:
+            if not line.startswith("#"):
+                self._line = line
+                break
+            if line.startswith("##contig=<"):
+                for attr in line.rstrip("\r\n")[10:-1].split(","):
+                    key, _, value = attr.partition("=")
+                    if key == "ID":
+                        self.contigs.append(value)
+                        break
+            elif line.startswith("#CHROM"):
+                self.samples = line.rstrip("\r\n").split("\t")[9:]
+
+    def __enter__(self) -> "VcfReader":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self) -> Iterator[VcfRecord]:
+        if self._line is not None:
+            line, self._line = self._line, None
+            if line.strip():
+                yield _parse_record(line)
+        for line in self._file:
+            if line.strip():
+                yield _parse_record(line)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class Concordance(NamedTuple):
+    """
+    The result of joining the records of two VCF files.
+
+    Attributes:
+        both: Number of records in both files.
+        concordant: Number of records in both files whose compared fields are
+            equal (or within tolerance).
+        only1: Number of records only in the first file.
+        only2: Number of records only in the second file.
+        sample: Descriptions of the first differences.
+        complete: Whether the files were compared to the end.
+    """
+    both: int
+    concordant: int
+    only1: int
+    only2: int
+    sample: List[str]
+    complete: bool = True
+
+    @property
+    def discordant(self) -> int:
+        return self.both - self.concordant
+
+    @property
+    def count(self) -> int:
+        """Number of records that are discordant or only in one file."""
+        return self.discordant + self.only1 + self.only2
+
+    def __str__(self) -> str:
+        return (
+            f"{self.both} records in both files ({self.concordant} concordant, "
+            f"{self.discordant} discordant), {self.only1} only in the first file, "
+            f"{self.only2} only in the second file"
+        )
+
+
+class GenotypeConcordance(NamedTuple):
+    """
+    The result of comparing the genotypes of two VCF files.
+
+    Attributes:
+        samples: The sample names.
+        both: Number of records in both files.
+        only1: Number of records only in the first file.
+        only2: Number of records only in the second file.
+        discordant: Number of discordant genotypes of each sample. A record that
+            is only in one file counts as discordant for every sample.
+    """
+    samples: List[str]
+    both: int
+    only1: int
+    only2: int
+    discordant: List[int]
+
+    @property
+    def genotypes(self) -> int:
+        """Number of genotypes compared."""
+        return (self.both + self.only1 + self.only2) * len(self.samples)
+
+    @property
+    def rate(self) -> float:
+        """Fraction of the genotypes that are discordant."""
+        if not self.genotypes:
+            return 0.0
+        return sum(self.discordant) / self.genotypes
+
+    def sample_rates(self) -> Dict[str, float]:
+        """The discordance rate of each sample."""
+        records = self.both + self.only1 + self.only2
+        return dict(
+            (sample, count / records if records else 0.0)
+            for sample, count in zip(self.samples, self.discordant)
+        )
+
+    def __str__(self) -> str:
+        worst = sorted(
+            self.sample_rates().items(), key=lambda item: item[1], reverse=True
+        )[:MAX_SAMPLE]
+        samples = ", ".join(
+            f"{sample} ({rate:.2%})" for sample, rate in worst if rate > 0
+        )
+        return (
+            f"{sum(self.discordant)} of {self.genotypes} genotypes are discordant "
+            f"({self.rate:.4%}) in {self.both} records in both files, "
+            f"{self.only1} only in the first file, and {self.only2} only in the "
+            f"second file; most discordant samples: {samples or 'none'}"
+        )
 
 
 class VcfDataFile(DataFile):
-    @classmethod
+    """
+    Compares VCF files, ignoring the header, QUAL, INFO, and all FORMAT fields
+    except GT.
+
+    Args:
+        fields: QUAL, INFO, and FORMAT fields (named "QUAL", "INFO/<key>", and
+            "FORMAT/<key>") to compare within the tolerances. If specified, the
+            records of the two files are joined on (CHROM, POS, REF, ALT), and
+            `allowed_diff_lines` is the number of records that may be discordant
+            or in only one file.
+        abs_tolerance: Maximum absolute difference between numeric values.
+        rel_tolerance: Maximum difference between numeric values, relative to the
+            larger of their absolute values.
+        max_discordance_rate: If specified, only the genotypes are compared
+            (requires numpy), and the files are considered equal if at most this
+            fraction of all genotypes is discordant; `allowed_diff_lines` is
+            ignored. Cannot be combined with `fields`.
+        kwargs: Arguments to :class:`pytest_wdl.core.DataFile`.
+    """
+    cpu_bound = True
+
+    def __init__(
+        self,
+        *args,
+        fields: Optional[Sequence[str]] = None,
+        abs_tolerance: float = 0.0,
+        rel_tolerance: float = 0.0,
+        max_discordance_rate: Optional[float] = None,
+        **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        if max_discordance_rate is not None:
+            if np is None:
+                raise ImportError(
+                    "Failed to import numpy, which is required to compare VCF "
+                    "genotypes by discordance rate; install the plugin with pip "
+                    "install pytest-wdl[vcf]"
+                )
+            if fields is not None:
+                raise ValueError(
+                    "Only one of 'fields' and 'max_discordance_rate' may be specified"
+                )
+        self.max_discordance_rate = max_discordance_rate
+        if fields is not None:
+            for field in fields:
+                if not (
+                    field == QUAL or
+                    field.startswith(INFO_PREFIX) or
+                    field.startswith(FORMAT_PREFIX)
+                ):
+                    raise ValueError(
+                        f"Invalid VCF field {field}; expected QUAL, INFO/<key>, or "
+                        f"FORMAT/<key>"
+                    )
+            fields = list(fields)
+        self.fields = fields
+        self.abs_tolerance = abs_tolerance
+        self.rel_tolerance = rel_tolerance
+
     def _assert_contents_equal(
-        cls, file1: Path, file2: Path, allowed_diff_lines: Optional[int] = None
+        self, file1: Path, file2: Path, allowed_diff_lines: Optional[int] = None
     ):
-        cls._diff_contents(file1, file2, allowed_diff_lines)
+        if self.max_discordance_rate is not None:
+            self._assert_genotypes_concordant(file1, file2)
+            return
+        if self.fields is None:
+            self._diff_contents(file1, file2, allowed_diff_lines)
+            return
 
-    @classmethod
-    def _diff(cls, file1: Path, file2: Path):
+        with VcfReader(file1) as reader1, VcfReader(file2) as reader2:
+            result = join_records(
+                reader1, reader2, self.fields, self.abs_tolerance,
+                self.rel_tolerance, limit=allowed_diff_lines,
+                contigs=reader1.contigs + reader2.contigs
+            )
+
+        if result.count > allowed_diff_lines:
+            if result.complete:
+                count = f"{result.count} records"
+            else:
+                count = f"More than {allowed_diff_lines} records"
+            sample = "\n".join(result.sample)
+            raise AssertionError(
+                f"{count} (which is > {allowed_diff_lines} allowed) are different "
+                f"between files {file1}, {file2}: {result}; first differences:\n"
+                f"{sample}"
+            )
+
+    def _diff(
+        self, file1: Path, file2: Path, limit: Optional[int] = None
+    ) -> DiffResult:
         """
         Special handling for VCF files to ignore QUAL, INFO, and FORMAT, and only
-        compares genotypes in the first sample column
+        compares genotypes in the sample columns
 
         Args:
             file1: First file to compare
             file2: Second file to compare
+            limit: Stop comparing once more than this many lines differ
+
+        Returns:
+            A `DiffResult`.
         """
-        with tempdir() as temp:
-            cmp_file1 = temp / "file1"
-            cmp_file2 = temp / "file2"
-            job1 = delegator.run(
-                f"cat {file1} | grep -vP '^#' | cut -d$'\t' -f 1-5,7,10 | cut -d$':' -f 1 > {cmp_file1}"
+        if self.unordered:
+            return diff_unordered(
+                lambda: _read_compared_lines(file1),
+                lambda: _read_compared_lines(file2),
+                limit
+            )
+        with VcfReader(file1) as reader1, VcfReader(file2) as reader2:
+            return diff_lines(_compared_lines(reader1), _compared_lines(reader2), limit)
+
+    def _assert_genotypes_concordant(self, file1: Path, file2: Path) -> None:
+        with VcfReader(file1) as reader1, VcfReader(file2) as reader2:
+            if sorted(reader1.samples) != sorted(reader2.samples):
+                raise AssertionError(
+                    f"Files {file1}, {file2} have different samples: "
+                    f"{reader1.samples} != {reader2.samples}"
+                )
+            result = genotype_concordance(
+                reader1, reader2, contigs=reader1.contigs + reader2.contigs
+            )
+
+        if result.rate > self.max_discordance_rate:
+            raise AssertionError(
+                f"Genotype discordance rate {result.rate:.4%} (which is > "
+                f"{self.max_discordance_rate:.4%} allowed) between files {file1}, "
+                f"{file2}: {result}"
             )
-            job2 = delegator.run(
-                f"cat {file2} | grep -vP '^#' | cut -d$'\t' -f 1-5,7,10 | cut -d$':' -f 1 > {cmp_file2}"
+
+
+def genotype_concordance(
+    reader1: VcfReader,
+    reader2: VcfReader,
+    block_size: int = BLOCK_SIZE,
+    contigs: Sequence[str] = ()
+) -> GenotypeConcordance:
+    """
+    Compares the genotypes of two VCF files with the same samples (in any order).
+    The records are merge-joined on (CHROM, POS, REF, ALT) (see `join_records`),
+    and the genotypes of blocks of joined records are encoded as integer matrices
+    (records x samples) and compared with vectorized operations. Genotypes are
+    compared regardless of phasing and allele order.
+
+    Args:
+        reader1: Reader of the first file.
+        reader2: Reader of the second file.
+        block_size: Number of records to compare at a time.
+        contigs: The order of the contigs.
+
+    Returns:
+        A `GenotypeConcordance`.
+
+    Raises:
+        ValueError: if the files have different samples.
+        AssertionError: if the files have no samples (i.e. there are no genotypes
+            to compare), if either file is not sorted in the contig order, or if
+            either file has an invalid genotype.
+    """
+    samples = reader1.samples
+    if sorted(samples) != sorted(reader2.samples):
+        raise ValueError(
+            f"VCF files have different samples: {samples} != {reader2.samples}"
+        )
+    if not samples:
+        raise AssertionError(
+            f"VCF files {reader1.path}, {reader2.path} have no samples, so there "
+            f"are no genotypes to compare"
+        )
+    # Column of each sample of the first file in the second file
+    columns = np.array([reader2.samples.index(sample) for sample in samples])
+    discordant = np.zeros(len(samples), dtype=np.int64)
+    codes: Dict[str, int] = {}
+    alleles: Dict[Tuple[int, ...], int] = {}
+    block1: List[str] = []
+    block2: List[str] = []
+    records1: List[VcfRecord] = []
+    records2: List[VcfRecord] = []
+    both = only1 = only2 = 0
+
+    def locate(reader: VcfReader, records: List[VcfRecord]) -> Callable[[int], str]:
+        def locate_genotype(i: int) -> str:
+            sample = reader.samples[i % len(samples)]
+            record = records[i // len(samples)]
+            return f"sample {sample} at {_locus(record)} in {reader.path}"
+        return locate_genotype
+
+    def compare_block():
+        matrix1 = _encode_genotypes(
+            block1, codes, alleles, locate(reader1, records1)
+        ).reshape(-1, len(samples))
+        matrix2 = _encode_genotypes(
+            block2, codes, alleles, locate(reader2, records2)
+        ).reshape(-1, len(samples))
+        discordant[:] += (matrix1 != matrix2[:, columns]).sum(axis=0)
+        for block in (block1, block2, records1, records2):
+            block.clear()
+
+    for record1, record2 in _join(reader1, reader2, contigs):
+        if record2 is None:
+            only1 += 1
+        elif record1 is None:
+            only2 += 1
+        else:
+            both += 1
+            block1.extend(_pad(_genotype_fields(record1), len(samples)))
+            block2.extend(_pad(_genotype_fields(record2), len(samples)))
+            records1.append(record1)
+            records2.append(record2)
+            if len(block1) >= block_size * len(samples):
+                compare_block()
+    if block1:
+        compare_block()
+
+    discordant += only1 + only2
+    return GenotypeConcordance(
+        samples, both, only1, only2, [int(count) for count in discordant]
+    )
+
+
+def _pad(genotypes: List[str], samples: int) -> List[str]:
+    if len(genotypes) < samples:
+        return genotypes + [MISSING] * (samples - len(genotypes))
+    return genotypes[:samples]
+
+
+def _genotype_fields(record: VcfRecord) -> List[str]:
+    """
+    The sample columns of a record if GT is their first field (as it usually
+    is), so that the GT values are extracted by `_encode_genotypes`; otherwise
+    the GT values.
+    """
+    if record.format == "GT" or (record.format and record.format.startswith("GT:")):
+        return record.samples
+    return record.genotypes
+
+
+def _encode_genotypes(
+    genotypes: List[str],
+    codes: Dict[str, int],
+    alleles: Dict[Tuple[int, ...], int],
+    locate: Callable[[int], str] = str
+) -> "np.ndarray":
+    """
+    Encodes genotypes as integers, such that genotypes with the same alleles
+    (regardless of phasing and order) have the same code, and missing genotypes
+    have code -1. Each genotype may be followed by other FORMAT fields (after a
+    ':'), which are ignored. `codes` and `alleles` cache the codes of genotype
+    strings and allele tuples. `locate` describes the genotype at an index, for
+    the message of the AssertionError raised if a genotype has a non-numeric
+    allele.
+
+    The GT values are extracted as a NumPy array, and only its unique values
+    are looked up in (or added to) `codes`.
+    """
+    values = _genotype_array(genotypes)
+    unique, inverse = np.unique(values, return_inverse=True)
+    unique_codes = np.empty(len(unique), dtype=np.int32)
+    for i, value in enumerate(unique.view(f"S{unique.itemsize}").tolist()):
+        genotype = value.decode()
+        if genotype not in codes:
+            codes[genotype] = _encode_genotype(
+                genotype, alleles,
+                lambda: locate(int(np.flatnonzero(inverse == i)[0]))
+            )
+        unique_codes[i] = codes[genotype]
+    return unique_codes[inverse.reshape(-1)]
+
+
+def _genotype_array(fields: List[str]) -> "np.ndarray":
+    """
+    Extracts the text before the first ':' of each field, as a NumPy array of
+    byte strings, padded with NULs to a multiple of eight bytes. The fields are
+    joined into one buffer, and the GT values are cut out of it at the positions
+    of the tabs and colons. Values of up to eight bytes (i.e. almost all) are
+    viewed as integers, which sort much faster than byte strings.
+    """
+    data = np.frombuffer("\t".join(fields).encode(), dtype=np.uint8)
+    delimiters = np.flatnonzero((data == TAB) | (data == COLON))
+    # Each field starts after a tab, and its GT ends at the next delimiter
+    tabs = np.flatnonzero(data[delimiters] == TAB)
+    starts = np.concatenate(([0], delimiters[tabs] + 1))
+    ends = np.append(delimiters, len(data))[np.concatenate(([0], tabs + 1))]
+    lengths = ends - starts
+    width = -(-max(int(lengths.max()), 1) // 8) * 8
+    padded = np.concatenate((data, np.zeros(width, dtype=np.uint8)))
+    windows = np.lib.stride_tricks.as_strided(
+        padded, shape=(len(data) + 1, width), strides=(1, 1), writeable=False
+    )[starts]
+    windows[np.arange(width) >= lengths[:, None]] = 0
+    return windows.view(np.uint64 if width == 8 else f"S{width}").reshape(-1)
+
+
+def _encode_genotype(
+    genotype: str, alleles: Dict[Tuple[int, ...], int], locate: Callable[[], str]
+) -> int:
+    try:
+        allele_list = [
+            -1 if allele in ("", MISSING) else int(allele)
+            for allele in ALLELE_SEPARATOR_RE.split(genotype)
+        ]
+    except ValueError:
+        raise AssertionError(f"Invalid genotype {genotype!r} of {locate()}")
+    if all(allele == -1 for allele in allele_list):
+        return MISSING_GENOTYPE
+    return alleles.setdefault(tuple(sorted(allele_list)), len(alleles))
+
+
+def join_records(
+    records1: Iterator[VcfRecord],
+    records2: Iterator[VcfRecord],
+    fields: Sequence[str],
+    abs_tolerance: float = 0.0,
+    rel_tolerance: float = 0.0,
+    limit: Optional[int] = None,
+    contigs: Sequence[str] = ()
+) -> Concordance:
+    """
+    Merge-joins two sorted streams of VCF records on (CHROM, POS, REF, ALT), and
+    compares the ID, FILTER, and genotypes of records in both streams exactly,
+    and the given fields within tolerance.
+
+    Args:
+        records1: The first stream of records.
+        records2: The second stream of records.
+        fields: Fields to compare within tolerance ("QUAL", "INFO/<key>",
+            "FORMAT/<key>").
+        abs_tolerance: Maximum absolute difference between numeric values.
+        rel_tolerance: Maximum relative difference between numeric values.
+        limit: Stop comparing once more than this many records are discordant or
+            in only one stream.
+        contigs: The order of the contigs; contigs that are not listed are
+            ordered by their first appearance.
+
+    Returns:
+        A `Concordance`.
+
+    Raises:
+        AssertionError: if either stream is not sorted in the contig order.
+    """
+    both = concordant = only1 = only2 = 0
+    sample: List[str] = []
+
+    for record1, record2 in _join(records1, records2, contigs):
+        if record2 is None:
+            only1 += 1
+            difference = "only in the first file"
+        elif record1 is None:
+            only2 += 1
+            difference = "only in the second file"
+        else:
+            both += 1
+            difference = _compare_records(
+                record1, record2, fields, abs_tolerance, rel_tolerance
             )
-            for job in (job1, job2):
-                job.block()
-            return super()._diff(cmp_file1, cmp_file2)
+            if not difference:
+                concordant += 1
+                continue
+
+        if len(sample) < MAX_SAMPLE:
+            sample.append(f"{_locus(record1 or record2)}: {difference}")
+        if limit is not None and (both - concordant) + only1 + only2 > limit:
+            return Concordance(both, concordant, only1, only2, sample, False)
+
+    return Concordance(both, concordant, only1, only2, sample)
+
+
+def _join(
+    records1: Iterator[VcfRecord],
+    records2: Iterator[VcfRecord],
+    contigs: Sequence[str] = ()
+) -> Iterator[Tuple[Optional[VcfRecord], Optional[VcfRecord]]]:
+    """
+    Merge-joins two sorted streams of VCF records on (CHROM, POS, REF, ALT).
+
+    Yields:
+        Pairs of matching records, in position order; one side is None for a
+        record that is only in one stream.
+
+    Raises:
+        AssertionError: if either stream is not sorted in the contig order.
+    """
+    ranks: Dict[str, int] = {}
+    for contig in contigs:
+        ranks.setdefault(contig, len(ranks))
+
+    groups1 = _position_groups(records1, ranks, _source(records1, "first"))
+    groups2 = _position_groups(records2, ranks, _source(records2, "second"))
+    group1 = next(groups1, None)
+    group2 = next(groups2, None)
+
+    while group1 is not None or group2 is not None:
+        if group2 is None or (group1 is not None and group1[0] < group2[0]):
+            for record1 in group1[1]:
+                yield record1, None
+            group1 = next(groups1, None)
+        elif group1 is None or group2[0] < group1[0]:
+            for record2 in group2[1]:
+                yield None, record2
+            group2 = next(groups2, None)
+        else:
+            # Records at the same position are matched by allele, in any order
+            alleles2: Dict[Tuple[str, str], List[VcfRecord]] = {}
+            for record2 in group2[1]:
+                alleles2.setdefault((record2.ref, record2.alt), []).append(record2)
+            for record1 in group1[1]:
+                matches = alleles2.get((record1.ref, record1.alt))
+                yield record1, (matches.pop(0) if matches else None)
+            for matches in alleles2.values():
+                for record2 in matches:
+                    yield None, record2
+            group1 = next(groups1, None)
+            group2 = next(groups2, None)
+
+
+def _source(records: Iterator[VcfRecord], ordinal: str) -> str:
+    if isinstance(records, VcfReader):
+        return f"file {records.path}"
+    return f"the {ordinal} stream"
+
+
+def _position_groups(
+    records: Iterator[VcfRecord], ranks: Dict[str, int], source: str
+) -> Iterator[Tuple[Tuple[int, int], List[VcfRecord]]]:
+    """
+    Groups consecutive records at the same position, and yields them with their
+    sort key (contig rank, position). `source` describes the records in the
+    message of the AssertionError raised if they are not sorted.
+    """
+    key = None
+    group: List[VcfRecord] = []
+    for record in records:
+        record_key = (ranks.setdefault(record.chrom, len(ranks)), record.pos)
+        if record_key != key:
+            if group:
+                yield key, group
+            if key is not None and record_key < key:
+                raise AssertionError(
+                    f"VCF records in {source} are not sorted: "
+                    f"{record.chrom}:{record.pos} follows "
+                    f"{group[0].chrom}:{group[0].pos}; the contigs must be in the "
+                    f"same order in both files, or declared in ##contig header "
+                    f"lines"
+                )
+            key = record_key
+            group = []
+        group.append(record)
+    if group:
+        yield key, group
+
+
+def _compare_records(
+    record1: VcfRecord,
+    record2: VcfRecord,
+    fields: Sequence[str],
+    abs_tolerance: float,
+    rel_tolerance: float
+) -> Optional[str]:
+    """
+    Returns a description of the first difference between two records, or None
+    if they are concordant.
+    """
+    for name, value1, value2 in (
+        ("ID", record1.id, record2.id),
+        ("FILTER", record1.filter, record2.filter),
+        ("GT", record1.genotypes, record2.genotypes)
+    ):
+        if value1 != value2:
+            return f"{name} {value1} != {value2}"
+
+    for field in fields:
+        if field == QUAL:
+            values1, values2 = [record1.qual], [record2.qual]
+        elif field.startswith(INFO_PREFIX):
+            key = field[len(INFO_PREFIX):]
+            values1 = [record1.info_values.get(key, MISSING)]
+            values2 = [record2.info_values.get(key, MISSING)]
+        else:
+            key = field[len(FORMAT_PREFIX):]
+            values1 = record1.format_values(key)
+            values2 = record2.format_values(key)
+        if len(values1) != len(values2) or not all(
+            _values_close(value1, value2, abs_tolerance, rel_tolerance)
+            for value1, value2 in zip(values1, values2)
+        ):
+            return f"{field} {values1} != {values2}"
+
+    return None
+
+
+def _values_close(
+    value1: str, value2: str, abs_tolerance: float, rel_tolerance: float
+) -> bool:
+    """
+    Compares two field values, which may be comma-separated lists. Numbers are
+    compared within tolerance, and anything else must be equal.
+    """
+    if value1 == value2:
+        return True
+    items1 = value1.split(",")
+    items2 = value2.split(",")
+    if len(items1) != len(items2):
+        return False
+    for item1, item2 in zip(items1, items2):
+        if item1 == item2:
+            continue
+        try:
+            number1 = float(item1)
+            number2 = float(item2)
+        except ValueError:
+            return False
+        if not math.isclose(
+            number1, number2, rel_tol=rel_tolerance, abs_tol=abs_tolerance
+        ):
+            return False
+    return True
+
+
+def _locus(record: VcfRecord) -> str:
+    return f"{record.chrom}:{record.pos} {record.ref}>{record.alt}"
+
+
+def _parse_record(line: str) -> VcfRecord:
+    columns: List[Optional[str]] = line.rstrip("\r\n").split("\t")
+    if len(columns) < 9:
+        columns = columns + [""] * (8 - len(columns)) + [None]
+    return VcfRecord(
+        columns[0], int(columns[1]), columns[2], columns[3], columns[4],
+        columns[5], columns[6], columns[7], columns[8], list(columns[9:])
+    )
+
+
+def _read_compared_lines(path: Path) -> Iterator[str]:
+    with VcfReader(path) as reader:
+        yield from _compared_lines(reader)
+
+
+def _compared_lines(records: Iterator[VcfRecord]) -> Iterator[str]:
+    """
+    Yield the compared fields of each record (CHROM, POS, ID, REF, ALT, FILTER,
+    and the genotype of each sample) as a line.
+    """
+    for record in records:
+        yield "\t".join([
+            record.chrom, str(record.pos), record.id, record.ref, record.alt,
+            record.filter
+        ] + record.genotypes)
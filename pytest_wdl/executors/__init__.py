@@ -12,16 +12,18 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+from concurrent.futures import Executor, ThreadPoolExecutor
 import glob
 import json
+import os
 from pathlib import Path
 import tempfile
-from typing import List, Optional, Tuple, Union
+from typing import Any, List, Optional, Tuple, Union
 
 import delegator
 
 from pytest_wdl.core import DataFile
-from pytest_wdl.utils import LOG, ensure_path, safe_string
+from pytest_wdl.utils import LOG, ensure_path, process_pool, safe_string
 
 
 def get_workflow(
@@ -141,3 +143,115 @@ def get_workflow_imports(
                 )
 
     return imports_path
+
+
+def check_outputs(
+    workflow_name: str,
+    outputs: dict,
+    expected: dict,
+    max_workers: Optional[int] = None
+) -> None:
+    """
+    Checks workflow outputs against expected values. The checks are run
+    concurrently: data files are localized and compared in a thread pool, and
+    data files whose type is `cpu_bound` are compared in a process pool (see
+    :func:`pytest_wdl.utils.process_pool`; in Python 3.6 they are compared in the
+    thread pool). All checks are run, and all the mismatches are reported
+    together.
+
+    Args:
+        workflow_name: Name of the workflow; used to prefix the output names.
+        outputs: Dict of actual outputs, with names prefixed by the workflow name.
+        expected: Dict mapping output names to expected values.
+        max_workers: Maximum number of outputs to check concurrently; defaults to
+            the number of CPUs. If 1, the outputs are checked one at a time.
+
+    Raises:
+        AssertionError: if any of the actual outputs don't match the expected
+            outputs
+        Exception: any other error raised while checking an output (e.g. if an
+            expected file could not be localized)
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    cpu_bound = sum(
+        1 for value in expected.values()
+        if isinstance(value, DataFile) and value.cpu_bound
+    )
+    # The process pool is created before the thread pool, and does not fork
+    # this process, so the workers do not inherit the state of other threads
+    processes = None
+    if max_workers > 1 and cpu_bound > 1:
+        processes = process_pool(min(max_workers, cpu_bound))
+
+    try:
+        if max_workers > 1 and len(expected) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(max_workers, len(expected))
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        _check_output, workflow_name, outputs, name, value,
+                        processes
+                    )
+                    for name, value in expected.items()
+                ]
+            errors = [future.exception() for future in futures]
+        else:
+            errors = []
+            for name, value in expected.items():
+                try:
+                    _check_output(workflow_name, outputs, name, value)
+                    errors.append(None)
+                except Exception as err:
+                    errors.append(err)
+    finally:
+        if processes:
+            processes.shutdown()
+
+    for err in errors:
+        if err is not None and not isinstance(err, AssertionError):
+            raise err
+
+    failures = [
+        f"{workflow_name}.{name}: {err}"
+        for name, err in zip(expected.keys(), errors)
+        if err is not None
+    ]
+    if failures:
+        raise AssertionError(
+            f"{len(failures)} of {len(expected)} expected outputs did not match:\n" +
+            "\n".join(failures)
+        )
+
+
+def _check_output(
+    workflow_name: str,
+    outputs: dict,
+    name: str,
+    expected_value: Any,
+    processes: Optional[Executor] = None
+) -> None:
+    key = f"{workflow_name}.{name}"
+    if key not in outputs:
+        raise AssertionError(f"Workflow did not generate output {key}")
+    actual_value = outputs[key]
+    if isinstance(expected_value, DataFile):
+        if processes and expected_value.cpu_bound:
+            # Localize the expected file in this process before it is sent to
+            # the worker, which does not have access to the localizer
+            _ = expected_value.path
+            processes.submit(
+                _assert_contents_equal, expected_value, actual_value
+            ).result()
+        else:
+            expected_value.assert_contents_equal(actual_value)
+    elif expected_value != actual_value:
+        raise AssertionError(
+            f"expected value {expected_value!r} != actual value {actual_value!r}"
+        )
+
+
+def _assert_contents_equal(expected_value: DataFile, actual_value: Any) -> None:
+    expected_value.assert_contents_equal(actual_value)
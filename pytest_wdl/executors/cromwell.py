@@ -20,8 +20,10 @@ from typing import List, Optional, Union
 
 import delegator
 
-from pytest_wdl.executors import get_workflow, get_workflow_inputs, get_workflow_imports
-from pytest_wdl.core import Executor, DataFile
+from pytest_wdl.executors import (
+    check_outputs, get_workflow, get_workflow_inputs, get_workflow_imports
+)
+from pytest_wdl.core import Executor
 from pytest_wdl.utils import LOG, ensure_path, find_executable_path, find_in_classpath
 
 
@@ -47,6 +49,9 @@ class CromwellExecutor(Executor):
         cromwell_jar_file: Path to the Cromwell JAR file.
         cromwell_args: Default Cromwell arguments to use; can be overridden by
             passing `cromwell_args=...` to `run_workflow`.
+        output_check_workers: Maximum number of expected outputs to check
+            concurrently; defaults to the number of CPUs. Can be overridden by
+            passing `output_check_workers=...` to `run_workflow`.
     """
     def __init__(
         self,
@@ -56,7 +61,8 @@ class CromwellExecutor(Executor):
         java_args: Optional[str] = None,
         cromwell_jar_file: Optional[Union[str, Path]] = None,
         cromwell_config_file: Optional[Union[str, Path]] = None,
-        cromwell_args: Optional[str] = None
+        cromwell_args: Optional[str] = None,
+        output_check_workers: Optional[int] = None
     ):
         self.project_root = project_root
         self.import_dirs = import_dirs
@@ -105,6 +111,7 @@ class CromwellExecutor(Executor):
         self.java_args = java_args
 
         self.cromwell_args = cromwell_args or os.environ.get(ENV_CROMWELL_ARGS)
+        self.output_check_workers = output_check_workers
 
     def run_workflow(
         self,
@@ -132,13 +139,16 @@ class CromwellExecutor(Executor):
                     written to this file only if it doesn't exist.
                 * java_args: Additional arguments to pass to Java runtime.
                 * cromwell_args: Additional arguments to pass to `cromwell run`.
+                * output_check_workers: Maximum number of expected outputs to
+                    check concurrently.
 
         Returns:
             Dict of outputs.
 
         Raises:
             Exception: if there was an error executing Cromwell
-            AssertionError: if the actual outputs don't match the expected outputs
+            AssertionError: if the actual outputs don't match the expected outputs;
+                all the mismatched outputs are reported together
         """
         wdl_path, workflow_name = get_workflow(
             self.project_root, wdl_script, workflow_name,
@@ -174,14 +184,10 @@ class CromwellExecutor(Executor):
         outputs = CromwellExecutor.get_cromwell_outputs(exe.out)
 
         if expected:
-            for name, expected_value in expected.items():
-                key = f"{workflow_name}.{name}"
-                if key not in outputs:
-                    raise AssertionError(f"Workflow did not generate output {key}")
-                if isinstance(expected_value, DataFile):
-                    expected_value.assert_contents_equal(outputs[key])
-                else:
-                    assert expected_value == outputs[key]
+            check_outputs(
+                workflow_name, outputs, expected,
+                kwargs.get("output_check_workers", self.output_check_workers)
+            )
 
         return outputs
 
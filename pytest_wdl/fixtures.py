@@ -22,14 +22,15 @@ still return string paths, but this support will be dropped in a future version.
 import json
 import os
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 from _pytest.fixtures import FixtureRequest
+import pytest
 
 from pytest_wdl.core import (
     EXECUTORS, DataResolver, DataManager, DataDirs, Executor, UserConfiguration
 )
-from pytest_wdl.utils import ensure_path, context_dir, find_project_path
+from pytest_wdl.utils import LOG, ensure_path, context_dir, find_project_path
 
 
 ENV_USER_CONFIG = "PYTEST_WDL_CONFIG"
@@ -59,8 +60,15 @@ def user_config_file() -> Optional[Path]:
     return config_path
 
 
-def user_config(user_config_file: Optional[Path]) -> UserConfiguration:
-    config = UserConfiguration(user_config_file)
+def user_config(
+    request: FixtureRequest, user_config_file: Optional[Path]
+) -> UserConfiguration:
+    """
+    Fixture that provides the user configuration, loaded from `user_config_file`.
+    Offline mode is enabled if the `--wdl-offline` command line option is given.
+    """
+    offline = request.config.getoption("wdl_offline", default=None) or None
+    config = UserConfiguration(user_config_file, offline=offline)
     yield config
     config.cleanup()
 
@@ -121,17 +129,30 @@ def workflow_data_descriptors(workflow_data_descriptor_file: Union[str, Path]) -
 
 
 def workflow_data_resolver(
+    request: FixtureRequest,
     workflow_data_descriptors: dict,
     user_config: UserConfiguration
 ) -> DataResolver:
     """
     Provides access to test data files for tests in a module.
 
+    The session-level `workflow_data_prefetch` and `workflow_data_offline_check`
+    fixtures only find data descriptor files at the default locations, so the
+    descriptors of a module (which may come from an overridden
+    `workflow_data_descriptor_file` fixture) are also prefetched and checked here,
+    before the first test in the module that uses them runs.
+
     Args:
+        request: FixtureRequest object
         workflow_data_descriptors: workflow_data_descriptors fixture.
         user_config:
     """
-    return DataResolver(workflow_data_descriptors, user_config)
+    resolver = DataResolver(workflow_data_descriptors, user_config)
+    if user_config.offline:
+        _exit_if_uncached([(request.node.nodeid, resolver)])
+    # Files that are already being prefetched are not submitted again
+    resolver.prefetch()
+    return resolver
 
 
 def workflow_data(
@@ -161,6 +182,109 @@ def workflow_data(
     return DataManager(workflow_data_resolver, datadirs)
 
 
+def workflow_data_prefetch(request: FixtureRequest) -> None:
+    """
+    Session-level fixture that starts localizing, in the background, the remote
+    data files used by all the tests selected for this session. Only has an effect
+    if `prefetch_threads` is set in the user configuration.
+
+    Data descriptor files are looked up in the same directory as each test module
+    that uses the `workflow_data` fixture, and at the default location
+    (`tests/test_data.json`). Data files described by other descriptor files
+    (e.g. provided by an overridden `workflow_data_descriptor_file` fixture) are
+    prefetched when the first test of a module that uses them is set up (see
+    `workflow_data_resolver`).
+
+    Args:
+        request: FixtureRequest object
+    """
+    resolvers = _session_data_resolvers(request, lambda config: config.prefetcher)
+    for _, resolver in resolvers:
+        resolver.prefetch()
+
+
+def workflow_data_offline_check(request: FixtureRequest) -> None:
+    """
+    Session-level fixture that, in offline mode, checks that the remote data
+    files used by all the tests selected for this session are in the cache, and
+    exits the session immediately, listing all the missing files, if any are not.
+
+    Data descriptor files are found the same way as for `workflow_data_prefetch`;
+    files described by other descriptor files are checked when the first test of
+    a module that uses them is set up.
+
+    Args:
+        request: FixtureRequest object
+    """
+    _exit_if_uncached(
+        _session_data_resolvers(request, lambda config: config.offline)
+    )
+
+
+def _exit_if_uncached(resolvers: Iterable[Tuple[Union[str, Path], DataResolver]]):
+    """
+    Exits the session, listing the remote data files that are not in the cache,
+    if there are any. `resolvers` yields tuples (source, resolver), where source
+    describes where the data descriptors came from.
+    """
+    missing = [
+        f"{name} ({url}) in {source}"
+        for source, resolver in resolvers
+        for name, url in resolver.find_uncached()
+    ]
+    if missing:
+        pytest.exit(
+            "Running in offline mode, but the following data files are not in the "
+            "cache:\n  " + "\n  ".join(missing),
+            returncode=1
+        )
+
+
+def _session_data_resolvers(
+    request: FixtureRequest, enabled: Callable[[UserConfiguration], bool]
+) -> Iterator[Tuple[Path, DataResolver]]:
+    """
+    Yields a tuple (descriptor_file, resolver) for each data descriptor file used
+    by the tests selected for this session, if `enabled` returns True for the
+    user configuration.
+    """
+    items = [
+        item
+        for item in request.session.items
+        if "workflow_data" in getattr(item, "fixturenames", ())
+    ]
+    if not items:
+        return
+
+    config = request.getfixturevalue("user_config")
+    if not enabled(config):
+        return
+
+    for descriptor_file in _find_data_descriptor_files(items):
+        try:
+            descriptors = workflow_data_descriptors(descriptor_file)
+        except Exception as err:
+            LOG.warning(f"Could not load data descriptors from {descriptor_file}: {err}")
+            continue
+        yield descriptor_file, DataResolver(descriptors, config)
+
+
+def _find_data_descriptor_files(items: Iterable) -> List[Path]:
+    paths: Set[Path] = set()
+
+    for item in items:
+        path = ensure_path(item.fspath.dirpath()) / DEFAULT_TEST_DATA_FILE
+        if path.exists():
+            paths.add(path)
+
+    try:
+        paths.add(ensure_path(workflow_data_descriptor_file()))
+    except FileNotFoundError:
+        pass
+
+    return sorted(paths)
+
+
 def import_paths(request: FixtureRequest) -> Union[str, Path, None]:
     """
     Fixture that provides the path to a file that lists directories containing WDL
@@ -18,20 +18,31 @@
 Utility functions for pytest-wdl.
 """
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import contextlib
+import errno
 import fnmatch
-import functools
+import hashlib
+import http.client
 import logging
+import multiprocessing
 import os
 from pathlib import Path
 import re
 import shutil
+import socket
 import stat
+import sys
 import tempfile
+import threading
+import time
+import uuid
 from typing import (
-    Dict, Generic, Iterable, Optional, Sequence, Type, TypeVar, Union, cast
+    Callable, Dict, Generic, Iterable, List, Optional, Sequence, Tuple, Type,
+    TypeVar, Union, cast
 )
-from urllib import request
+from urllib import parse, request
+from urllib.error import HTTPError
 
 from pkg_resources import EntryPoint, iter_entry_points
 from py._path.local import LocalPath
@@ -41,6 +52,12 @@ LOG = logging.getLogger("pytest-wdl")
 LOG.setLevel(os.environ.get("LOGLEVEL", "WARNING").upper())
 
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
 try:
     from tqdm import tqdm as progress
 except:
@@ -57,6 +74,28 @@ DEFAULT_CLASSPATH = "."
 
 UNSAFE_RE = re.compile(r"[^\w.-]")
 
+PARTIAL_SUFFIX = ".partial"
+VALIDATOR_SUFFIX = ".validator"
+SEGMENTS_SUFFIX = ".segments"
+DOWNLOAD_BLOCK_SIZE = 16 * 1024
+DEFAULT_MIN_SEGMENT_SIZE = 64 * 1024 * 1024
+HASH_BLOCK_SIZE = 1024 * 1024
+LOCK_SUFFIX = ".lock"
+DEFAULT_LOCK_STALE_AFTER = 60
+DEFAULT_LOCK_POLL_INTERVAL = 0.5
+DEFAULT_POOL_SIZE = 10
+DEFAULT_POOL_IDLE_TIMEOUT = 60
+DEFAULT_POOL_TIMEOUT = 60
+MAX_REDIRECTS = 10
+DEFAULT_PROBE_TIMEOUT = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+LINK_REFLINK = "reflink"
+LINK_HARDLINK = "hardlink"
+LINK_SYMLINK = "symlink"
+LINK_COPY = "copy"
+LINK_STRATEGIES = (LINK_REFLINK, LINK_HARDLINK, LINK_SYMLINK, LINK_COPY)
+FICLONE = 0x40049409
+
 T = TypeVar("T")
 
 
@@ -222,6 +261,174 @@ def context_dir(
             shutil.rmtree(path)
 
 
+class FileLock:
+    """
+    Lease-based lock on a file that works across threads, processes, and hosts
+    that share a file system. The lock is a file next to the locked file (with the
+    suffix ".lock") that is created exclusively and contains the host name and
+    process ID of the owner. While the lock is held, the owner periodically
+    refreshes the modification time of the lock file. A lock is considered stale,
+    and is broken by the next process that tries to acquire it, if its owner was
+    a process on the same host that no longer exists, or if it has not been
+    refreshed within `stale_after` seconds (e.g. because the owner's host died).
+
+    Args:
+        path: The path of the file to lock.
+        timeout: Maximum time (in seconds) to wait for the lock; if None, waits
+            indefinitely.
+        stale_after: Number of seconds after which an unrefreshed lock is stale.
+        poll_interval: Number of seconds between attempts to acquire the lock.
+
+    Examples:
+        with FileLock(destination):
+            if not destination.exists():
+                download_file(url, destination)
+    """
+    def __init__(
+        self,
+        path: Path,
+        timeout: Optional[float] = None,
+        stale_after: float = DEFAULT_LOCK_STALE_AFTER,
+        poll_interval: float = DEFAULT_LOCK_POLL_INTERVAL
+    ):
+        self.lock_path = path.with_name(f"{path.name}{LOCK_SUFFIX}")
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self._token = None
+        self._stop_refresh = None
+
+    def acquire(self) -> None:
+        """
+        Acquires the lock, waiting for another owner to release it if necessary.
+
+        Raises:
+            TimeoutError: if the lock could not be acquired within `timeout` seconds.
+        """
+        token = lease_token()
+        start = time.time()
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                self._break_if_stale()
+            else:
+                with os.fdopen(fd, "wt") as out:
+                    out.write(token)
+                break
+            if self.timeout is not None and time.time() - start > self.timeout:
+                raise TimeoutError(f"Timed out waiting for lock {self.lock_path}")
+            time.sleep(self.poll_interval)
+
+        self._token = token
+        self._stop_refresh = threading.Event()
+        threading.Thread(
+            target=self._refresh, args=(self._stop_refresh,), daemon=True
+        ).start()
+
+    def release(self) -> None:
+        """
+        Releases the lock.
+        """
+        if self._token is None:
+            return
+        self._stop_refresh.set()
+        if self._read_token(self.lock_path) == self._token:
+            self.lock_path.unlink()
+        else:
+            LOG.warning(f"Lock {self.lock_path} was broken while it was held")
+        self._token = None
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def _refresh(self, stop: threading.Event) -> None:
+        while not stop.wait(self.stale_after / 4):
+            try:
+                os.utime(self.lock_path)
+            except OSError:
+                pass
+
+    def _break_if_stale(self) -> None:
+        token = self._read_token(self.lock_path)
+        if token is None or not self._is_stale(token):
+            return
+        # Move the lock aside before deleting it, and check that it is still the
+        # stale lock, in case another process broke it and acquired a new lock in
+        # the meantime.
+        aside = self.lock_path.with_name(f"{self.lock_path.name}.{uuid.uuid4().hex}")
+        try:
+            os.rename(self.lock_path, aside)
+        except FileNotFoundError:
+            return
+        if self._read_token(aside) == token:
+            LOG.warning(f"Breaking stale lock {self.lock_path} held by {token}")
+            aside.unlink()
+        else:
+            try:
+                os.link(aside, self.lock_path)
+            except FileExistsError:
+                pass
+            aside.unlink()
+
+    def _is_stale(self, token: str) -> bool:
+        try:
+            refreshed = self.lock_path.stat().st_mtime
+        except FileNotFoundError:
+            return False
+        return lease_expired(token, refreshed, self.stale_after)
+
+    @staticmethod
+    def _read_token(path: Path) -> Optional[str]:
+        try:
+            with open(path, "rt") as inp:
+                token = inp.read()
+        except FileNotFoundError:
+            return None
+        # An empty token means the owner has created the file but not yet written it
+        return token or None
+
+
+def lease_token() -> str:
+    """
+    Creates a unique token that identifies the owner of a lease (e.g. a
+    :class:`FileLock`), as '<host> <process ID> <random hex>'.
+    """
+    return f"{socket.gethostname()} {os.getpid()} {uuid.uuid4().hex}"
+
+
+def lease_expired(token: str, refreshed: float, stale_after: float) -> bool:
+    """
+    Determines whether a lease has expired - i.e. its owner was a process on the
+    same host that no longer exists, or it has not been refreshed within
+    `stale_after` seconds.
+
+    Args:
+        token: The token of the owner of the lease (see `lease_token`).
+        refreshed: The time the lease was last refreshed, in seconds since the
+            epoch.
+        stale_after: Number of seconds after which an unrefreshed lease expires.
+    """
+    host, pid = token.split(" ")[:2]
+    if host == socket.gethostname() and not _process_exists(int(pid)):
+        return True
+    return time.time() - refreshed > stale_after
+
+
+def _process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
 def ensure_path(
     path: Union[str, LocalPath, Path], root: Optional[Path] = None,
     canonicalize: bool = True, exists: Optional[bool] = None,
@@ -447,6 +654,127 @@ def find_in_classpath(glob: str) -> Optional[Path]:
                 return path
 
 
+def link_file(source: Path, destination: Path, strategy: str = LINK_SYMLINK) -> str:
+    """
+    Makes the file `source` available at `destination`, using the first strategy
+    that succeeds, starting with `strategy`, in order of preference:
+
+    * reflink: a copy-on-write clone (Linux file systems that support it, e.g.
+      btrfs and XFS), which is independent of the source but shares its disk blocks
+    * hardlink: a hard link, which requires the source and destination to be on
+      the same file system
+    * symlink: a symbolic link
+    * copy: a full copy
+
+    Args:
+        source: The source file.
+        destination: The path to create; must not already exist.
+        strategy: The most preferred strategy to try.
+
+    Returns:
+        The strategy that was used.
+
+    Raises:
+        ValueError: if `strategy` is not a valid strategy.
+    """
+    if strategy not in LINK_STRATEGIES:
+        raise ValueError(
+            f"Invalid localization strategy {strategy}; expected one of "
+            f"{', '.join(LINK_STRATEGIES)}"
+        )
+    for candidate in LINK_STRATEGIES[LINK_STRATEGIES.index(strategy):]:
+        try:
+            _LINK_FUNCTIONS[candidate](source, destination)
+            return candidate
+        except OSError as err:
+            if candidate == LINK_COPY or isinstance(err, FileExistsError):
+                raise
+            LOG.debug(f"Could not {candidate} {source} to {destination}: {err}")
+
+
+def _reflink(source: Path, destination: Path) -> None:
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+    with open(source, "rb") as src, open(destination, "xb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            os.unlink(destination)
+            raise
+
+
+def _hardlink(source: Path, destination: Path) -> None:
+    os.link(source, destination)
+
+
+def _symlink(source: Path, destination: Path) -> None:
+    destination.symlink_to(source)
+
+
+def _copy(source: Path, destination: Path) -> None:
+    temp = destination.with_name(f"{destination.name}{PARTIAL_SUFFIX}")
+    try:
+        shutil.copyfile(source, temp)
+        temp.replace(destination)
+    finally:
+        if temp.exists():
+            temp.unlink()
+
+
+_LINK_FUNCTIONS = {
+    LINK_REFLINK: _reflink,
+    LINK_HARDLINK: _hardlink,
+    LINK_SYMLINK: _symlink,
+    LINK_COPY: _copy
+}
+
+
+_worker_process = False
+
+
+def process_pool(max_workers: int) -> Optional[ProcessPoolExecutor]:
+    """
+    Creates a process pool whose workers are started with the 'forkserver' method
+    (or 'spawn', where 'forkserver' is not available) rather than by forking the
+    current process. The current process may be running other threads (e.g.
+    prefetching files or refreshing locks), and a forked child would inherit
+    their locks in whatever state they happen to be. The workers are marked as
+    such (see :func:`in_worker_process`).
+
+    Args:
+        max_workers: Maximum number of worker processes.
+
+    Returns:
+        The pool, or None in Python 3.6, in which the start method of the
+        workers of a `ProcessPoolExecutor` cannot be selected.
+    """
+    if sys.version_info < (3, 7):
+        return None
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+    else:
+        context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=context,
+        initializer=_init_worker_process
+    )
+
+
+def in_worker_process() -> bool:
+    """
+    Whether the current process is a worker of a pool created by
+    :func:`process_pool` (or a daemonic process, e.g. of a `multiprocessing.Pool`).
+    Code running in a worker should not start a process pool of its own, since
+    each of the workers of the outer pool may do the same.
+    """
+    return _worker_process or multiprocessing.current_process().daemon
+
+
+def _init_worker_process() -> None:
+    global _worker_process
+    _worker_process = True
+
+
 def env_map(d: dict) -> dict:
     """
     Given a mapping of keys to value descriptors, creates a mapping of the keys to
@@ -482,58 +810,778 @@ def resolve_value_descriptor(value_descriptor: Union[str, dict]) -> Optional:
         return value_descriptor.get("value")
 
 
+class ConnectionPool:
+    """
+    Pool of persistent (keep-alive) HTTP(S) connections, so that localizing many
+    files from the same server does not require a new TCP connection (and TLS
+    handshake) for each file. Connections are keyed by scheme, host, port, and
+    proxy. Redirects are followed, and the connection is returned to the pool once
+    the response has been read completely; a connection whose response is closed
+    before the end is discarded. The pool is safe to use from multiple threads.
+
+    If no proxies are configured, the proxies in the environment (e.g.
+    `HTTPS_PROXY` and `NO_PROXY`) are used, as they are by urllib.
+
+    Args:
+        max_size: Maximum number of idle connections to keep; the least recently
+            used connections are closed first.
+        idle_timeout: Number of seconds after which an idle connection is closed
+            rather than reused.
+        timeout: Number of seconds to wait for a connection to be established, or
+            for data to be received.
+    """
+    def __init__(
+        self,
+        max_size: int = DEFAULT_POOL_SIZE,
+        idle_timeout: float = DEFAULT_POOL_IDLE_TIMEOUT,
+        timeout: float = DEFAULT_POOL_TIMEOUT
+    ):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle: Dict[tuple, List[Tuple[http.client.HTTPConnection, float]]] = \
+            defaultdict(list)
+        self._closed = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def supports(url: str, proxies: Optional[dict] = None) -> bool:
+        """
+        Whether requests for `url` can be sent using the pool. Requests that are
+        not for HTTP(S) URLs, or that would be sent through a proxy that requires
+        authentication, are left to urllib.
+        """
+        scheme = parse.urlsplit(url).scheme
+        if scheme not in ("http", "https") or (proxies and scheme not in proxies):
+            return False
+        proxy = _select_proxy(url, proxies)
+        return not (proxy and "@" in proxy)
+
+    def open(
+        self,
+        url: str,
+        http_headers: Optional[dict] = None,
+        proxies: Optional[dict] = None,
+        method: str = "GET"
+    ) -> "PooledResponse":
+        """
+        Sends a request and returns the response. Responses with status 304 or
+        416 are returned; other error responses are raised.
+
+        Args:
+            url: The URL to request.
+            http_headers: Mapping of HTTP header names to values.
+            proxies: Mapping of URL scheme to proxy URL.
+            method: The request method.
+
+        Returns:
+            The response, which should be used as a context manager (or closed)
+            so that the connection can be reused.
+
+        Raises:
+            HTTPError: if the server responds with an error, or redirects too
+                many times.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            rsp = self._request(url, http_headers, proxies, method)
+            location = rsp.headers.get("location")
+            if rsp.status in REDIRECT_STATUSES and location:
+                rsp.close()
+                url = parse.urljoin(url, location)
+                continue
+            if rsp.status >= 400 and rsp.status != 416:
+                rsp.close()
+                raise HTTPError(url, rsp.status, rsp.reason, rsp.headers, None)
+            return rsp
+        raise HTTPError(url, rsp.status, "Too many redirects", rsp.headers, None)
+
+    def close(self) -> None:
+        """
+        Closes all idle connections. Connections that are in use are closed when
+        their responses are closed.
+        """
+        with self._lock:
+            self._closed = True
+            idle = [conn for conns in self._idle.values() for conn, _ in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+    def _request(
+        self, url: str, http_headers: Optional[dict], proxies: Optional[dict],
+        method: str
+    ) -> "PooledResponse":
+        parts = parse.urlsplit(url)
+        proxy = _select_proxy(url, proxies)
+        key = (parts.scheme, parts.hostname, parts.port, proxy)
+        if proxy and parts.scheme == "http":
+            target = parse.urlunsplit(parts[:4] + ("",))
+        else:
+            target = parse.urlunsplit(("", "") + parts[2:4] + ("",)) or "/"
+
+        while True:
+            conn, reused = self._acquire(key)
+            try:
+                conn.request(method, target, headers=http_headers or {})
+                return PooledResponse(self, key, conn, conn.getresponse())
+            except (ConnectionError, http.client.BadStatusLine):
+                conn.close()
+                # The server may have closed an idle connection; retry once with
+                # a new connection
+                if not reused:
+                    raise
+            except Exception:
+                conn.close()
+                raise
+
+    def _acquire(self, key: tuple) -> Tuple[http.client.HTTPConnection, bool]:
+        now = time.time()
+        expired = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        if conn:
+            return conn, True
+        return self._connect(*key), False
+
+    def _connect(
+        self, scheme: str, host: str, port: Optional[int], proxy: Optional[str]
+    ) -> http.client.HTTPConnection:
+        if proxy:
+            if "://" not in proxy:
+                proxy = f"http://{proxy}"
+            proxy_parts = parse.urlsplit(proxy)
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(
+                    proxy_parts.hostname, proxy_parts.port, timeout=self.timeout
+                )
+                conn.set_tunnel(host, port)
+                return conn
+            return http.client.HTTPConnection(
+                proxy_parts.hostname, proxy_parts.port, timeout=self.timeout
+            )
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _release(self, key: tuple, conn: http.client.HTTPConnection) -> None:
+        to_close = []
+        with self._lock:
+            if self._closed or self.max_size <= 0:
+                to_close.append(conn)
+            else:
+                self._idle[key].append((conn, time.time()))
+                entries = [
+                    (last_used, k, c)
+                    for k, conns in self._idle.items()
+                    for c, last_used in conns
+                ]
+                entries.sort(key=lambda entry: entry[0])
+                for last_used, k, c in entries[:max(len(entries) - self.max_size, 0)]:
+                    self._idle[k].remove((c, last_used))
+                    to_close.append(c)
+        for c in to_close:
+            c.close()
+
+
+def _select_proxy(url: str, proxies: Optional[dict]) -> Optional[str]:
+    """
+    Selects the proxy for a URL - from `proxies` if any are configured, otherwise
+    from the environment, unless the host is excluded by `NO_PROXY`.
+    """
+    parts = parse.urlsplit(url)
+    if proxies:
+        return proxies.get(parts.scheme)
+    proxy = request.getproxies().get(parts.scheme)
+    if proxy and request.proxy_bypass(parts.netloc.rpartition("@")[2]):
+        return None
+    return proxy
+
+
+class PooledResponse:
+    """
+    Response to a request sent using a :class:`ConnectionPool`. Has the same
+    `status`, `reason`, `headers`, and `read` members as the response returned by
+    `urllib.request.urlopen`.
+    """
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        key: tuple,
+        conn: http.client.HTTPConnection,
+        rsp: http.client.HTTPResponse
+    ):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._rsp = rsp
+
+    @property
+    def status(self) -> int:
+        return self._rsp.status
+
+    @property
+    def reason(self) -> str:
+        return self._rsp.reason
+
+    @property
+    def headers(self):
+        return self._rsp.headers
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        return self._rsp.read(amt)
+
+    def close(self) -> None:
+        """
+        Closes the response, and returns the connection to the pool if the
+        response has been read completely (short remainders are drained).
+        """
+        if self._conn is None:
+            return
+        rsp = self._rsp
+        try:
+            if not rsp.isclosed() and rsp.length is not None and \
+                    rsp.length <= DOWNLOAD_BLOCK_SIZE:
+                rsp.read()
+        except (OSError, http.client.HTTPException):
+            pass
+        if rsp.isclosed() and not rsp.will_close:
+            self._pool._release(self._key, self._conn)
+        else:
+            rsp.close()
+            self._conn.close()
+        self._conn = None
+
+    def __enter__(self) -> "PooledResponse":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 def download_file(
     url: str,
     destination: Path,
     http_headers: Optional[dict] = None,
     proxies: Optional[dict] = None,
-    show_progress: bool = True
+    show_progress: bool = True,
+    segments: int = 1,
+    min_segment_size: int = DEFAULT_MIN_SEGMENT_SIZE,
+    digests: Optional[Dict[str, str]] = None,
+    reserve_space: Optional[Callable[[int], None]] = None,
+    validators: Optional[Dict[str, str]] = None,
+    connection_pool: Optional["ConnectionPool"] = None
+) -> Optional[dict]:
+    """
+    Downloads a file from a URL. The file is first written to a partial file next
+    to `destination` (with the suffix ".partial"), which is renamed to
+    `destination` only once the download is complete. If a partial file exists
+    from a previous, interrupted download, the download is resumed using an HTTP
+    Range request if the server supports it; otherwise the partial file is
+    discarded and the download starts from the beginning. The ETag (or
+    Last-Modified date) of the file is stored next to the partial file (with the
+    suffix ".partial.validator") and sent in an If-Range header, so that the
+    download starts over if the remote file has changed in the meantime; a
+    partial file without a validator is discarded.
+
+    If `segments` > 1 and there is no partial file to resume, the file size is
+    first determined with a HEAD request, and the file is split into up to
+    `segments` byte ranges (each at least `min_segment_size` bytes) that are
+    downloaded concurrently. If the server does not support range requests, or
+    the file is too small to be split, the file is downloaded as a single stream.
+
+    If `digests` are given, the file is hashed while it is downloaded, and it is
+    only renamed to `destination` if all the digests match.
+
+    If `validators` are given, the request is conditional, and nothing is
+    downloaded if the server responds that the file has not been modified. Any
+    partial file is discarded, and the file is downloaded as a single stream.
+
+    Args:
+        url: The URL to download.
+        destination: The path to which the file is downloaded.
+        http_headers: Mapping of HTTP header names to values.
+        proxies: Mapping of proxy type to proxy URL.
+        show_progress: Whether to show a progress bar (requires tqdm).
+        segments: Maximum number of byte ranges to download concurrently.
+        min_segment_size: Minimum size (in bytes) of each byte range.
+        digests: Mapping of hash algorithm name (e.g. 'md5' or 'sha256') to the
+            expected hex digest of the file.
+        reserve_space: Function that is called with the number of bytes remaining
+            to be downloaded, once it is known and before any data is written,
+            e.g. to make room in the cache.
+        validators: Conditional request headers ('If-None-Match' and/or
+            'If-Modified-Since').
+        connection_pool: Pool of persistent HTTP(S) connections to use for the
+            requests; if None, a new connection is opened for each request.
+
+    Returns:
+        Dict with metadata about the downloaded file, with keys 'etag',
+        'last_modified', and 'content_length' (each value may be None), or None if
+        `validators` were given and the file has not been modified.
+
+    Raises:
+        IOError: if the connection is closed before the whole file is received,
+            in which case the partial file is kept so that the download can be
+            resumed; or if the digest of the downloaded file does not match the
+            expected digest, in which case the downloaded file is deleted.
+    """
+    partial = destination.with_name(f"{destination.name}{PARTIAL_SUFFIX}")
+    if_range = _read_partial_validator(partial) if partial.exists() else None
+    if validators or not if_range:
+        # Without a validator, a partial file cannot be resumed safely, since the
+        # remote file may have changed
+        if partial.exists():
+            partial.unlink()
+        _write_partial_validator(partial, None)
+    offset = partial.stat().st_size if partial.exists() else 0
+
+    if segments > 1 and not offset and not validators:
+        metadata = _download_segments(
+            url, destination, http_headers, proxies, show_progress, segments,
+            min_segment_size, digests, reserve_space, connection_pool
+        )
+        if metadata is not None:
+            return metadata
+
+    headers = dict(http_headers or {})
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = if_range
+    if validators:
+        headers.update(validators)
+
+    rsp = _open_url(url, headers, proxies, connection_pool=connection_pool)
+    with rsp:
+        status = _status(rsp)
+        if status == 304:
+            LOG.debug("Url %s has not been modified", url)
+            return None
+
+        metadata = _response_metadata(rsp)
+
+        if offset:
+            if status == 206:
+                LOG.debug("Resuming download of url %s at byte %d", url, offset)
+            elif status == 416:
+                total_size = _content_range_size(rsp.headers.get("content-range"))
+                if total_size == offset:
+                    # The previous download was complete but was not renamed
+                    _write_partial_validator(partial, None)
+                    if digests:
+                        _verify_digests(
+                            url, partial, file_digests(partial, digests), digests
+                        )
+                    partial.replace(destination)
+                    metadata["content_length"] = total_size
+                    return metadata
+                partial.unlink()
+                return download_file(
+                    url, destination, http_headers, proxies, show_progress,
+                    segments, min_segment_size, digests, reserve_space, validators,
+                    connection_pool
+                )
+            else:
+                # The server ignored the range, or the file has changed
+                offset = 0
+
+        if not offset:
+            _write_partial_validator(partial, _if_range_value(metadata))
+
+        size_str = rsp.headers.get("content-length")
+        total_size = offset + int(size_str) if size_str else None
+        if size_str and reserve_space:
+            reserve_space(int(size_str))
+
+        LOG.debug("Downloading url %s to %s", url, str(destination))
+
+        progress_bar = _progress_bar(
+            show_progress, total_size, offset, destination.name
+        )
+
+        hashers = dict(
+            (algorithm, hashlib.new(algorithm)) for algorithm in (digests or {})
+        )
+        if offset and hashers:
+            _update_hashers(partial, hashers.values())
+
+        size = offset
+        try:
+            with open(partial, "ab" if offset else "wb") as out:
+                while True:
+                    buf = rsp.read(DOWNLOAD_BLOCK_SIZE)
+                    if not buf:
+                        break
+                    out.write(buf)
+                    for hasher in hashers.values():
+                        hasher.update(buf)
+                    size += len(buf)
+                    if progress_bar:
+                        progress_bar.update(len(buf))
+        finally:
+            if progress_bar:
+                progress_bar.close()
+
+    if total_size is not None and size != total_size:
+        raise IOError(
+            f"Download of url {url} is incomplete: received {size} of "
+            f"{total_size} bytes"
+        )
+
+    _write_partial_validator(partial, None)
+
+    if hashers:
+        _verify_digests(url, partial, _hexdigests(hashers), digests)
+
+    partial.replace(destination)
+
+    return metadata
+
+
+def _download_segments(
+    url: str,
+    destination: Path,
+    http_headers: Optional[dict],
+    proxies: Optional[dict],
+    show_progress: bool,
+    segments: int,
+    min_segment_size: int,
+    digests: Optional[Dict[str, str]] = None,
+    reserve_space: Optional[Callable[[int], None]] = None,
+    connection_pool: Optional["ConnectionPool"] = None
+) -> Optional[dict]:
+    """
+    Downloads a file as concurrent byte ranges into a preallocated file. The
+    file is written to a separate temporary file (with the suffix ".segments")
+    rather than to the partial file used by single-stream downloads, since a
+    preallocated file cannot be resumed. Since the segments arrive out of order,
+    digests are computed after the download is complete.
+
+    Returns:
+        The file metadata (see `download_file`) if the file was downloaded, or
+        None if the server does not support range requests or the file is too
+        small to be split, in which case nothing has been written.
+    """
+    try:
+        rsp = _open_url(
+            url, http_headers, proxies, method="HEAD", connection_pool=connection_pool
+        )
+    except HTTPError as err:
+        LOG.debug("HEAD request failed for url %s: %s", url, err)
+        return None
+    with rsp:
+        metadata = _response_metadata(rsp)
+        accept_ranges = rsp.headers.get("accept-ranges", "none").lower()
+    if metadata["content_length"] is None or accept_ranges != "bytes":
+        return None
+
+    total_size = metadata["content_length"]
+    num_segments = min(segments, total_size // max(min_segment_size, 1))
+    if num_segments < 2:
+        return None
+
+    segment_size = -(-total_size // num_segments)
+    ranges = [
+        (start, min(start + segment_size, total_size) - 1)
+        for start in range(0, total_size, segment_size)
+    ]
+
+    if reserve_space:
+        reserve_space(total_size)
+
+    temp = destination.with_name(f"{destination.name}{SEGMENTS_SUFFIX}")
+    with open(temp, "wb") as out:
+        out.truncate(total_size)
+
+    LOG.debug(
+        "Downloading url %s to %s in %d segments", url, str(destination), len(ranges)
+    )
+
+    progress_bar = _progress_bar(show_progress, total_size, 0, destination.name)
+    progress_lock = threading.Lock()
+
+    def download_segment(start: int, end: int) -> bool:
+        headers = dict(http_headers or {})
+        headers["Range"] = f"bytes={start}-{end}"
+        with _open_url(
+            url, headers, proxies, connection_pool=connection_pool
+        ) as segment_rsp:
+            if _status(segment_rsp) != 206:
+                return False
+            fd = os.open(temp, os.O_WRONLY)
+            try:
+                pos = start
+                while True:
+                    buf = segment_rsp.read(DOWNLOAD_BLOCK_SIZE)
+                    if not buf:
+                        break
+                    _pwrite(fd, buf, pos)
+                    pos += len(buf)
+                    if progress_bar:
+                        with progress_lock:
+                            progress_bar.update(len(buf))
+            finally:
+                os.close(fd)
+        if pos != end + 1:
+            raise IOError(
+                f"Download of url {url} is incomplete: received {pos - start} of "
+                f"{end + 1 - start} bytes for range {start}-{end}"
+            )
+        return True
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [
+                executor.submit(download_segment, start, end)
+                for start, end in ranges
+            ]
+            complete = all([future.result() for future in futures])
+    except BaseException:
+        temp.unlink()
+        raise
+    finally:
+        if progress_bar:
+            progress_bar.close()
+
+    if not complete:
+        # The server ignored the range requests
+        temp.unlink()
+        return None
+
+    if digests:
+        _verify_digests(url, temp, file_digests(temp, digests), digests)
+
+    temp.replace(destination)
+    return metadata
+
+
+def probe_url(
+    url: str,
+    http_headers: Optional[dict] = None,
+    proxies: Optional[dict] = None,
+    timeout: float = DEFAULT_PROBE_TIMEOUT
+) -> Optional[float]:
+    """
+    Measures how quickly a server responds to a HEAD request for a URL.
+
+    Args:
+        url: The URL to probe.
+        http_headers: Mapping of HTTP header names to values.
+        proxies: Mapping of proxy type to proxy URL.
+        timeout: Number of seconds to wait for the response.
+
+    Returns:
+        The number of seconds until the response was received, or None if the
+        request failed.
+    """
+    start = time.time()
+    try:
+        with _open_url(url, http_headers, proxies, method="HEAD", timeout=timeout):
+            pass
+    except Exception as err:
+        LOG.debug(f"Probe of url {url} failed: {err}")
+        return None
+    return time.time() - start
+
+
+def file_digests(
+    path: Path, algorithms: Iterable[str], block_size: int = HASH_BLOCK_SIZE
+) -> Dict[str, str]:
+    """
+    Computes one or more digests of a file in a single pass, reading the file in
+    blocks of `block_size` bytes.
+
+    Args:
+        path: The file to hash.
+        algorithms: Names of hash algorithms supported by `hashlib`.
+        block_size: Number of bytes to read at a time.
+
+    Returns:
+        Dict mapping algorithm name to hex digest.
+    """
+    hashers = dict((algorithm, hashlib.new(algorithm)) for algorithm in algorithms)
+    _update_hashers(path, hashers.values(), block_size)
+    return _hexdigests(hashers)
+
+
+def _hexdigests(hashers: dict) -> Dict[str, str]:
+    return dict(
+        (algorithm, hasher.hexdigest()) for algorithm, hasher in hashers.items()
+    )
+
+
+def _update_hashers(path: Path, hashers: Iterable, block_size: int = HASH_BLOCK_SIZE):
+    with open(path, "rb") as inp:
+        while True:
+            buf = inp.read(block_size)
+            if not buf:
+                break
+            for hasher in hashers:
+                hasher.update(buf)
+
+
+def _verify_digests(
+    url: str, path: Path, actual: Dict[str, str], expected: Dict[str, str]
+) -> None:
+    mismatches = [
+        f"{algorithm} (expected {expected[algorithm]}, got {actual[algorithm]})"
+        for algorithm in expected
+        if actual[algorithm] != expected[algorithm].lower()
+    ]
+    if mismatches:
+        path.unlink()
+        raise IOError(
+            f"Digest mismatch for file downloaded from url {url}: "
+            f"{', '.join(mismatches)}"
+        )
+
+
+def _pwrite(fd: int, buf: bytes, pos: int) -> None:
+    """
+    Writes `buf` to file descriptor `fd` at offset `pos`. Falls back to seek+write
+    on platforms without `os.pwrite`, which is safe as long as each thread uses
+    its own file descriptor.
+    """
+    view = memoryview(buf)
+    while view:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, view, pos)
+        else:
+            os.lseek(fd, pos, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        pos += written
+
+
+def _progress_bar(show_progress: bool, total: Optional[int], initial: int, name: str):
+    if show_progress and progress:
+        return progress(
+            total=total,
+            initial=initial,
+            unit="b",
+            unit_scale=True,
+            unit_divisor=1024,
+            desc=f"Localizing {name}"
+        )
+    return None
+
+
+def _open_url(
+    url: str,
+    http_headers: Optional[dict] = None,
+    proxies: Optional[dict] = None,
+    method: str = "GET",
+    connection_pool: Optional[ConnectionPool] = None,
+    timeout: Optional[float] = None
 ):
-    req = request.Request(url)
-    if http_headers:
-        for name, value in http_headers.items():
-            req.add_header(name, value)
+    """
+    Opens a URL and returns the response. Unlike `urllib.request.urlopen`, a
+    response with status 304 (not modified) or 416 (range not satisfiable) is
+    returned rather than raised, since these are expected responses to
+    conditional and range requests.
+
+    HTTP(S) requests are sent using `connection_pool`, if given, unless the pool
+    does not support the request (see :meth:`ConnectionPool.supports`), in which
+    case the request is handed to urllib as before. `timeout` (in seconds) only
+    applies to requests that are not pooled; pooled connections use the timeout
+    of the pool.
+    """
+    if connection_pool and connection_pool.supports(url, proxies):
+        return connection_pool.open(url, http_headers, proxies, method)
+    req = request.Request(url, headers=http_headers or {}, method=method)
     if proxies:
         # TODO: Should we only set the proxy associated with the URL scheme?
         #  Should we raise an exception if there is not a proxy defined for
         #  the URL scheme?
         # parsed = parse.urlparse(url)
-        for proxy_type, url in proxies.items():
-            req.set_proxy(url, proxy_type)
-    rsp = request.urlopen(req)
+        for proxy_type, proxy_url in proxies.items():
+            req.set_proxy(proxy_url, proxy_type)
+    try:
+        if timeout is None:
+            return request.urlopen(req)
+        return request.urlopen(req, timeout=timeout)
+    except HTTPError as err:
+        if err.code in (304, 416):
+            return err
+        raise
+
 
-    size_str = rsp.getheader("content-length")
-    total_size = int(size_str) if size_str else None
-    block_size = 16 * 1024
-    if total_size and total_size < block_size:
-        block_size = total_size
+def _status(rsp) -> int:
+    """
+    Gets the status code of a response returned by `_open_url`. An `HTTPError`
+    only has a `status` attribute in Python 3.9+.
+    """
+    if isinstance(rsp, HTTPError):
+        return rsp.code
+    return rsp.status
 
-    LOG.debug("Downloading url %s to %s", url, str(destination))
 
-    if show_progress and progress:
-        progress_bar = progress(
-            total=total_size,
-            unit="b",
-            unit_scale=True,
-            unit_divisor=1024,
-            desc=f"Localizing {destination.name}"
-        )
+def _if_range_value(metadata: dict) -> Optional[str]:
+    """
+    Selects the validator to send in an If-Range header - the ETag, unless it is
+    weak (weak ETags may not be used with If-Range), otherwise the Last-Modified
+    date.
+    """
+    etag = metadata.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return metadata.get("last_modified")
 
-        def progress_reader():
-            buf = rsp.read(block_size)
-            if buf:
-                progress_bar.update(block_size)
-            else:
-                progress_bar.close()
-            return buf
 
-        reader = progress_reader
+def _partial_validator_path(partial: Path) -> Path:
+    return partial.with_name(f"{partial.name}{VALIDATOR_SUFFIX}")
+
+
+def _read_partial_validator(partial: Path) -> Optional[str]:
+    validator_path = _partial_validator_path(partial)
+    if validator_path.exists():
+        return validator_path.read_text().strip() or None
+    return None
+
+
+def _write_partial_validator(partial: Path, value: Optional[str]) -> None:
+    """
+    Stores the If-Range validator of a partial file, or removes it if `value` is
+    None.
+    """
+    validator_path = _partial_validator_path(partial)
+    if value:
+        validator_path.write_text(value)
+    elif validator_path.exists():
+        validator_path.unlink()
+
+
+def _response_metadata(rsp) -> dict:
+    """
+    Extracts the headers used to identify the version of a remote file.
+    """
+    size_str = rsp.headers.get("content-length")
+    if _status(rsp) == 206:
+        size = _content_range_size(rsp.headers.get("content-range"))
     else:
-        reader = functools.partial(rsp.read, block_size)
+        size = int(size_str) if size_str else None
+    return {
+        "etag": rsp.headers.get("etag"),
+        "last_modified": rsp.headers.get("last-modified"),
+        "content_length": size
+    }
 
-    with open(destination, "wb") as out:
-        while True:
-            buf = reader()
-            if not buf:
-                break
-            out.write(buf)
+
+def _content_range_size(content_range: Optional[str]) -> Optional[int]:
+    """
+    Parses the total size from a Content-Range header value, e.g.
+    "bytes 0-99/1000" or "bytes */1000".
+    """
+    if content_range:
+        total = content_range.rsplit("/", 1)[-1].strip()
+        if total.isdigit():
+            return int(total)
+    return None
@@ -5,7 +5,10 @@ from setuptools import setup, find_packages
 
 extras_require = {
     "bam": ["pysam"],
-    "progress": ["tqdm"]
+    "csv": ["numpy"],
+    "progress": ["tqdm"],
+    "tsv": ["numpy"],
+    "vcf": ["numpy"]
 }
 extras_require["all"] = [
     lib
@@ -34,6 +37,8 @@ setup(
         ],
         "pytest_wdl.data_types": [
             "bam = pytest_wdl.data_types.bam:BamDataFile",
+            "csv = pytest_wdl.data_types.tsv:CsvDataFile",
+            "tsv = pytest_wdl.data_types.tsv:TsvDataFile",
             "vcf = pytest_wdl.data_types.vcf:VcfDataFile",
         ],
         "pytest_wdl.executors": [
@@ -13,10 +13,15 @@
 #    limitations under the License.
 
 import contextlib
+from http.server import HTTPServer, SimpleHTTPRequestHandler
 import os
+import re
 import socket
+import socketserver
 from pathlib import Path
 import stat
+import threading
+from typing import Optional
 
 
 try:
@@ -53,3 +58,118 @@ def setenv(envvars: dict):
 def make_executable(path: Path):
     current_permissions = stat.S_IMODE(os.lstat(path).st_mode)
     os.chmod(path, current_permissions | stat.S_IXUSR)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves files from the server's `directory`, with support for single byte-range
+    requests (including If-Range, which is compared to the Last-Modified date).
+    All requests are recorded in the server's `requests` list, and the address of
+    each client connection in its `clients` set. If the server's `truncate_after`
+    is set, full (non-range) responses are cut off after that many bytes. GET
+    requests for a path in the server's `hold` dict are not answered until the
+    corresponding event is set.
+    """
+    def log_message(self, *args):
+        pass
+
+    def translate_path(self, path):
+        # SimpleHTTPRequestHandler only accepts a directory in Python 3.7+
+        path = super().translate_path(path)
+        base = getattr(self, "directory", None) or os.getcwd()
+        return os.path.join(self.server.directory, os.path.relpath(path, base))
+
+    def end_headers(self):
+        if self.server.support_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+    def copyfile(self, source, outputfile):
+        if self.server.truncate_after is None:
+            super().copyfile(source, outputfile)
+        else:
+            outputfile.write(source.read(self.server.truncate_after))
+            self.close_connection = True
+
+    def do_HEAD(self):
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        self.server.clients.add(self.client_address)
+        super().do_HEAD()
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        self.server.clients.add(self.client_address)
+        if self.path in self.server.hold:
+            self.server.hold[self.path].wait()
+        path = Path(self.translate_path(self.path))
+        range_match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if not (range_match and self.server.support_ranges and path.is_file()):
+            super().do_GET()
+            return
+
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range != self.date_time_string(path.stat().st_mtime):
+            # The file has changed, so the whole file is sent
+            super().do_GET()
+            return
+
+        size = path.stat().st_size
+        start = int(range_match.group(1))
+        end = int(range_match.group(2)) if range_match.group(2) else size - 1
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        end = min(end, size - 1)
+        with open(path, "rb") as inp:
+            inp.seek(start)
+            data = inp.read(end - start + 1)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(str(path)))
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@contextlib.contextmanager
+def http_server(
+    directory: Path,
+    support_ranges: bool = True,
+    keep_alive: bool = False,
+    truncate_after: Optional[int] = None
+):
+    """
+    Context manager that serves files from `directory` over HTTP on localhost.
+    If `keep_alive` is True, HTTP/1.1 persistent connections are supported.
+
+    Yields:
+        A tuple (base_url, server).
+    """
+    handler_class = RangeRequestHandler
+    if keep_alive:
+        handler_class = type(
+            "KeepAliveRangeRequestHandler", (RangeRequestHandler,),
+            {"protocol_version": "HTTP/1.1"}
+        )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.directory = str(directory)
+    server.support_ranges = support_ranges
+    server.requests = []
+    server.clients = set()
+    server.truncate_after = truncate_after
+    server.hold = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}", server
+    finally:
+        server.shutdown()
+        server.server_close()
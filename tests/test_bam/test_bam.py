@@ -17,10 +17,17 @@
 """
 Test that bam data_type works.
 """
-from pytest_wdl.utils import find_project_path
+from pathlib import Path
+
+from pytest_wdl.utils import find_project_path, tempdir
 from .. import no_internet
 import pytest
 
+pysam = pytest.importorskip("pysam")
+
+from pytest_wdl.data_types import bam  # noqa: E402
+from pytest_wdl.data_types.bam import BamDataFile  # noqa: E402
+
 
 @pytest.fixture(scope="module")
 def workflow_data_descriptor_file(project_root):
@@ -55,3 +62,91 @@ def test_bam_removing_randomness(workflow_data, workflow_runner):
             "output_bam": workflow_data["random_id_bam_output"]
         }
     )
+
+
+BAM_DIR = Path(__file__).parent / "test_bam"
+BAM1 = BAM_DIR / "samtools_random_ids_UNSET-4F784850.bam"
+BAM2 = BAM_DIR / "samtools_random_ids_UNSET-different.bam"
+
+
+def _write_changed_bam(source: Path, dest: Path, records: set):
+    """Copy a BAM file, replacing the sequence of the given records with Ns."""
+    with pysam.AlignmentFile(str(source), "rb") as inp, \
+            pysam.AlignmentFile(str(dest), "wb", template=inp) as out:
+        for i, record in enumerate(inp):
+            if i in records:
+                qualities = record.query_qualities
+                record.query_sequence = "N" * record.query_length
+                record.query_qualities = qualities
+            out.write(record)
+
+
+def test_bam_data_file():
+    BamDataFile(BAM1).assert_contents_equal(BAM2)
+
+    with tempdir() as d:
+        bam3 = d / "changed.bam"
+        _write_changed_bam(BAM2, bam3, {0})
+        with pytest.raises(AssertionError) as excinfo:
+            BamDataFile(BAM1).assert_contents_equal(bam3)
+        assert "More than 0 lines" in str(excinfo.value)
+        BamDataFile(BAM1, allowed_diff_lines=1).assert_contents_equal(bam3)
+
+
+def test_bam_data_file_sharded(monkeypatch):
+    monkeypatch.setattr(bam, "MIN_SHARDED_SIZE", 0)
+    monkeypatch.setattr(bam, "SHARD_SIZE", 50000)
+
+    with tempdir() as d:
+        bam1 = d / "bam1.bam"
+        bam2 = d / "bam2.bam"
+        bam3 = d / "bam3.bam"
+        bam1.write_bytes(BAM1.read_bytes())
+        bam2.write_bytes(BAM2.read_bytes())
+        # Change one record placed on a contig, and one unplaced record
+        _write_changed_bam(BAM2, bam3, {0, 23})
+        for path in (bam1, bam2, bam3):
+            pysam.index(str(path))
+
+        data_file = BamDataFile(bam1, processes=2)
+        with pysam.AlignmentFile(str(bam1), "rb") as bam1_file, \
+                pysam.AlignmentFile(str(bam3), "rb") as bam3_file:
+            shards = data_file._shards(bam1, bam3, bam1_file, bam3_file)
+            assert len(shards) > len(bam1_file.references) + 1
+
+        data_file.assert_contents_equal(bam2)
+        result = data_file._diff(bam1, bam3)
+        assert result.complete
+        assert result.count == 2
+        assert result.count == BamDataFile(bam1, processes=1)._diff(bam1, bam3).count
+        with pytest.raises(AssertionError):
+            BamDataFile(bam1, processes=2, allowed_diff_lines=1).assert_contents_equal(
+                bam3
+            )
+        BamDataFile(bam1, processes=2, allowed_diff_lines=2).assert_contents_equal(bam3)
+
+        # Files are not sharded in a worker of another process pool
+        monkeypatch.setattr(bam, "in_worker_process", lambda: True)
+        with pysam.AlignmentFile(str(bam1), "rb") as bam1_file, \
+                pysam.AlignmentFile(str(bam3), "rb") as bam3_file:
+            assert data_file._shards(bam1, bam3, bam1_file, bam3_file) is None
+
+
+def test_bam_data_file_unordered():
+    with tempdir() as d:
+        shuffled = d / "shuffled.bam"
+        with pysam.AlignmentFile(str(BAM2), "rb") as inp, \
+                pysam.AlignmentFile(str(shuffled), "wb", template=inp) as out:
+            for record in reversed(list(inp)):
+                out.write(record)
+        with pytest.raises(AssertionError):
+            BamDataFile(BAM1).assert_contents_equal(shuffled)
+        BamDataFile(BAM1, unordered=True).assert_contents_equal(shuffled)
+
+        changed = d / "changed.bam"
+        _write_changed_bam(shuffled, changed, {5})
+        with pytest.raises(AssertionError):
+            BamDataFile(BAM1, unordered=True).assert_contents_equal(changed)
+        BamDataFile(
+            BAM1, unordered=True, allowed_diff_lines=1
+        ).assert_contents_equal(changed)
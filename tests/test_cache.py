@@ -0,0 +1,312 @@
+#    Copyright 2019 Eli Lilly and Company
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import hashlib
+import os
+from pathlib import Path
+import threading
+import time
+
+import pytest
+from pytest_wdl.cache import Cache, Catalog, select_digest
+from pytest_wdl.utils import tempdir
+
+
+def test_select_digest():
+    assert select_digest({"md5": "ABC", "sha256": "DEF"}) == ("sha256", "def")
+    assert select_digest({"md5": "abc"}) == ("md5", "abc")
+    assert select_digest({"sha384": "abc", "sha224": "def"}) == ("sha224", "def")
+    with pytest.raises(ValueError):
+        select_digest({})
+    with pytest.raises(ValueError):
+        select_digest({"foo": "abc"})
+
+
+def test_cache_object_link():
+    with tempdir() as d:
+        cache = Cache(d)
+        object_path = cache.object_path({"md5": "abcdef"})
+        assert object_path == d / ".objects" / "md5" / "ab" / "abcdef"
+        object_path.parent.mkdir(parents=True)
+        with open(object_path, "wt") as out:
+            out.write("foo")
+        foo = d / "sub" / "foo.txt"
+        cache.link(foo, object_path)
+        assert foo.is_symlink()
+        with open(foo, "rt") as inp:
+            assert inp.read() == "foo"
+        # Replaces a dangling link
+        object_path.unlink()
+        cache.link(foo, cache.object_path({"md5": "123456"}))
+        assert foo.is_symlink()
+        assert not foo.exists()
+
+
+def _write(path, size, age_days=0):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as out:
+        out.write(b"x" * size)
+    t = time.time() - (age_days * 24 * 60 * 60)
+    os.utime(path, (t, t))
+
+
+def test_cache_evict_lru():
+    with tempdir() as d:
+        cache = Cache(d, max_size=250)
+        _write(d / "a", 100, age_days=3)
+        _write(d / "b", 100, age_days=2)
+        _write(d / "c", 100, age_days=1)
+        assert cache.size() == 300
+        # Accessing 'a' makes it the most recently used
+        cache.touch(d / "a")
+        assert cache.evict() == [d / "b"]
+        assert cache.size() == 200
+        cache.close()
+
+        # Files in use are never evicted
+        cache = Cache(d, max_size=0)
+        cache.touch(d / "c")
+        assert cache.evict() == [d / "a"]
+        assert (d / "c").exists()
+
+
+def test_cache_evict_other_sessions():
+    with tempdir() as d:
+        _write(d / "a", 100, age_days=2)
+        _write(d / "b", 100, age_days=1)
+        _write(d / "c", 100, age_days=3)
+        # Another session has resolved 'a', and may be about to open it
+        other = Cache(d, max_size=0)
+        other.touch(d / "a")
+        cache = Cache(d, max_size=0)
+        assert cache.evict() == [d / "c", d / "b"]
+        assert (d / "a").exists()
+        other.close()
+        assert cache.evict() == [d / "a"]
+
+        # Sessions whose lease has expired (e.g. because they crashed) are ignored
+        _write(d / "d", 100, age_days=1)
+        other = Cache(d, max_size=0)
+        other.touch(d / "d")
+        other._stop_refresh.set()
+        other.catalog._conn.execute(
+            "UPDATE sessions SET refreshed = ?", (time.time() - 3600,)
+        )
+        other.catalog._conn.commit()
+        assert cache.evict() == [d / "d"]
+        assert [token for token, _, _ in cache.catalog.sessions()] == [cache._session]
+        cache.close()
+
+
+def test_cache_evict_max_age():
+    with tempdir() as d:
+        cache = Cache(d, max_age=2)
+        _write(d / "a", 10, age_days=3)
+        _write(d / "b", 10, age_days=1)
+        assert cache.evict() == [d / "a"]
+        assert (d / "b").exists()
+
+
+def test_cache_evict_objects():
+    with tempdir() as d:
+        cache = Cache(d, max_size=50)
+        object_path = cache.object_path({"md5": "abcdef"})
+        _write(object_path, 100, age_days=1)
+        cache.link(d / "foo.txt", object_path)
+        cache.record_download(d / "bar.txt")
+        _write(d / "bar.txt.partial", 10, age_days=1)
+        cache.touch(d / "bar.txt")
+        assert cache.evict() == [object_path]
+        assert not (d / "foo.txt").is_symlink()
+        assert not object_path.parent.exists()
+        assert cache.catalog.links_to(object_path) == []
+        # The partial file of a download in progress is not evicted
+        assert (d / "bar.txt.partial").exists()
+
+
+def test_cache_evict_hardlinked_objects():
+    with tempdir() as d:
+        cache = Cache(d, max_size=50, link_strategy="hardlink")
+        object_path = cache.object_path({"md5": "abcdef"})
+        _write(object_path, 100, age_days=1)
+        cache.link(d / "foo.txt", object_path)
+        assert not (d / "foo.txt").is_symlink()
+        assert cache.size() == 100
+        assert set(cache.evict()) == {object_path, d / "foo.txt"}
+        assert not (d / "foo.txt").exists()
+        assert not object_path.parent.exists()
+        assert cache.catalog.links_to(object_path) == []
+
+
+def test_cache_link_concurrent():
+    with tempdir() as d:
+        cache = Cache(d, link_strategy="hardlink")
+        object_path = cache.object_path({"md5": "abcdef"})
+        _write(object_path, 100)
+        foo = d / "foo.txt"
+        errors = []
+
+        def link():
+            try:
+                cache.link(foo, object_path)
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=link) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert foo.stat().st_ino == object_path.stat().st_ino
+        assert not (d / "foo.txt.lock").exists()
+        assert not (d / "foo.txt.partial").exists()
+        cache.close()
+
+
+def test_cache_reserve():
+    with tempdir() as d:
+        cache = Cache(d, max_size=250)
+        _write(d / "a", 100, age_days=2)
+        _write(d / "b", 100, age_days=1)
+        cache.reserve(50)
+        assert (d / "a").exists()
+        cache.reserve(100)
+        assert not (d / "a").exists()
+        assert (d / "b").exists()
+
+
+def test_cache_reserve_concurrent():
+    with tempdir() as d:
+        for i in range(20):
+            _write(d / f"file{i}", 1000, age_days=20 - i)
+        caches = [Cache(d, max_size=20000) for _ in range(4)]
+        errors = []
+
+        def reserve(cache):
+            try:
+                cache.reserve(5000)
+            except Exception as err:
+                errors.append(err)
+
+        threads = [
+            threading.Thread(target=reserve, args=(cache,))
+            for cache in caches for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert not (d / "file4").exists()
+        assert (d / "file5").exists()
+        assert not (d / ".evict.lock").exists()
+        for cache in caches:
+            cache.close()
+
+
+def test_catalog_digest():
+    with tempdir() as d:
+        catalog = Catalog(d / "catalog.sqlite")
+        foo = d / "foo.txt"
+        with open(foo, "wt") as out:
+            out.write("foo")
+        assert catalog.digest(foo) == hashlib.md5(b"foo").hexdigest()
+        # The memoized digest is used while the file is unchanged
+        catalog.store_digest(foo, "md5", "ABC")
+        assert catalog.digest(foo) == "abc"
+        stat = foo.stat()
+        os.utime(foo, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        assert catalog.digest(foo) == hashlib.md5(b"foo").hexdigest()
+        catalog.close()
+
+
+def test_cache_catalog():
+    with tempdir() as d:
+        _write(d / "a", 100, age_days=1)
+        cache = Cache(d)
+        _write(d / "b", 50)
+        cache.record(
+            d / "b", source="http://foo.com/b", digests={"md5": "ABC"},
+            download_seconds=2.0
+        )
+        # Files that existed before the catalog was created are added to it
+        assert cache.stats() == {"files": 2, "size": 150, "download_seconds": 2.0}
+        entry = cache.catalog.get(d / "b")
+        assert entry.source == "http://foo.com/b"
+        assert entry.digest == "md5:abc"
+        assert entry.size == 50
+        assert entry.inode == (d / "b").stat().st_ino
+        assert cache.catalog.digest(d / "b") == "abc"
+        last_access = cache.catalog.get(d / "a").last_access
+        cache.touch(d / "a")
+        assert cache.catalog.get(d / "a").last_access > last_access
+        cache.close()
+
+
+def test_cache_without_catalog():
+    with tempdir() as d:
+        _write(d / "a", 100, age_days=2)
+        _write(d / "b", 50, age_days=1)
+        # A cache that is neither persistent nor bounded has no catalog
+        cache = Cache(d, persistent=False)
+        cache.touch(d / "a")
+        assert cache.catalog is None
+        assert not (d / ".catalog.sqlite").exists()
+        assert cache.stats() == {"files": 2, "size": 150, "download_seconds": 0.0}
+        cache.close()
+
+        # A catalog that cannot be opened is skipped; eviction walks the directory
+        (d / ".catalog.sqlite").mkdir()
+        cache = Cache(d, max_size=100)
+        assert cache.catalog is None
+        assert cache.evict() == [d / "b"]
+        cache.close()
+
+
+def test_catalog_digest_outside_cache():
+    with tempdir() as d, tempdir() as outside:
+        catalog = Catalog(d / "catalog.sqlite")
+        foo = outside / "foo.txt"
+        with open(foo, "wt") as out:
+            out.write("foo")
+        assert catalog.digest(foo) == hashlib.md5(b"foo").hexdigest()
+        count, = catalog._conn.execute("SELECT COUNT(*) FROM digests").fetchone()
+        assert count == 0
+        catalog.close()
+
+
+def test_cache_evict_temp_files(monkeypatch):
+    with tempdir() as d:
+        _write(d / "a", 100, age_days=1)
+        cache = Cache(d, max_size=200)
+        assert cache.size() == 100
+        for name in ("b", "c", "d"):
+            cache.record_download(d / name)
+        cache.close()
+        # Temporary files left by downloads in other sessions are evicted, and
+        # the records of finished downloads are removed
+        _write(d / "b.partial", 150, age_days=2)
+        (d / "b.partial.validator").write_text('"etag"')
+        _write(d / "c.segments", 10)
+        cache = Cache(d, max_size=200)
+        # The cache directory is not walked once it is cataloged
+        monkeypatch.setattr(Path, "glob", None)
+        assert cache.evict() == [d / "b.partial"]
+        assert cache.catalog.temp_files() == [d / "c.segments"]
+        assert not (d / "b.partial.validator").exists()
+        # Recently modified temp files may still be downloading
+        assert (d / "c.segments").exists()
+        assert cache.size() == 100
+        cache.close()
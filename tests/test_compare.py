@@ -0,0 +1,219 @@
+#    Copyright 2019 Eli Lilly and Company
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import gzip
+from pathlib import Path
+import struct
+import zlib
+
+import pytest
+
+from pytest_wdl.compare import (
+    BgzfReader, DiffLine, diff_files, diff_lines, diff_unordered, fingerprint,
+    is_bgzf, is_gzip, open_file
+)
+from pytest_wdl.utils import tempdir
+
+
+def test_diff_lines():
+    assert diff_lines(["foo", "bar"], ["foo", "bar"]) == (0, [], True)
+    result = diff_lines(["foo", "bar"], ["foo", "blorf", "bork"])
+    assert result.count == 2
+    assert result.sample == [
+        DiffLine(2, "bar", 2, "blorf"),
+        DiffLine(None, None, 3, "bork")
+    ]
+    assert str(result) == "2: bar | 2: blorf\n- | 3: bork"
+    # Differing sections are aligned, and the inputs resynchronized afterwards
+    lines1 = [str(i) for i in range(100)]
+    lines2 = lines1[:10] + ["x", "y"] + lines1[11:50] + lines1[51:]
+    assert diff_lines(lines1, lines2).count == 3
+    # Sections that cannot be aligned within the window count as all different
+    assert diff_lines(lines1, lines2, window=1).count == 41
+    assert diff_lines(["a"], []).count == 1
+    assert diff_lines([], ["a", "b"]).count == 2
+
+
+def test_diff_lines_limit():
+    lines1 = [str(i) for i in range(1000)]
+    lines2 = [str(i) if i % 10 else "x" for i in range(1000)]
+    result = diff_lines(lines1, lines2)
+    assert result.count == 100
+    assert result.complete
+    assert len(result.sample) == 10
+    result = diff_lines(iter(lines1), iter(lines2), limit=5, max_sample=3)
+    assert result.count == 6
+    assert not result.complete
+    assert len(result.sample) == 3
+
+
+def test_diff_lines_repeated():
+    # Counts are the same as the number of lines shown by
+    # diff -y --suppress-common-lines, also when lines are repeated
+    for lines1, lines2, count in (
+        ("ABBA", "BABBA", 1),
+        ("AABBABAABB", "AABBBABAABBZ", 2),
+        ("ABABAB", "BABABA", 2),
+        ("AAAAB", "AAB", 2),
+        ("ABCABBA", "CBABAC", 5),
+        ("BBBABAAAAABBBBB", "BBBAABAAAAABBBBBB", 2)
+    ):
+        assert diff_lines(list(lines1), list(lines2)).count == count
+    lines1 = [str(i * i % 7 % 3) for i in range(2000)]
+    lines2 = list(lines1)
+    for i in range(1900, 0, -97):
+        if i % 2:
+            lines2.insert(i, "1")
+        else:
+            del lines2[i]
+    assert diff_lines(lines1, lines2).count == 20
+    assert diff_lines(lines1, lines2, window=100).count == 20
+
+
+def test_diff_lines_scattered():
+    # Many scattered differences are each resynchronized without aligning the
+    # whole window
+    lines1 = [f"{i}\t{i * 0.5}" for i in range(30000)]
+    lines2 = [
+        f"{i}\t{i * 0.5 + 1e-9}" if i % 3 == 0 else line
+        for i, line in enumerate(lines1)
+    ]
+    lines2.insert(15000, "extra")
+    result = diff_lines(lines1, lines2)
+    assert result.count == 10001
+    assert result.complete
+
+
+def test_diff_files():
+    with tempdir() as d:
+        file1 = d / "file1.txt"
+        file2 = d / "file2.txt"
+        with open(file1, "wt") as out:
+            out.write("foo\nbar\nbaz\n")
+        with open(file2, "wt") as out:
+            out.write("foo\nbar\nblorf")
+        result = diff_files(file1, file2)
+        assert result.count == 1
+        assert str(result) == "3: baz | 3: blorf"
+
+
+def test_diff_files_gzip():
+    with tempdir() as d:
+        plain = d / "plain.txt"
+        with open(plain, "wt") as out:
+            out.write("foo\nbar\nbaz\n")
+        # Compressed files are detected by content, not by suffix
+        compressed = d / "compressed.data"
+        with gzip.open(compressed, "wt") as out:
+            out.write("foo\nbar\nbaz\n")
+        different = d / "different.txt.gz"
+        with gzip.open(different, "wt") as out:
+            out.write("foo\nblorf\nbaz\n")
+        assert is_gzip(compressed)
+        assert not is_gzip(plain)
+        assert diff_files(plain, compressed).count == 0
+        assert diff_files(compressed, plain).count == 0
+        result = diff_files(plain, different)
+        assert result.count == 1
+        assert str(result) == "2: bar | 2: blorf"
+
+
+def test_fingerprint():
+    lines = [f"line{i}\n" for i in range(100)]
+    assert fingerprint(lines) == fingerprint(reversed(lines))
+    assert fingerprint(lines) == fingerprint(line.encode() for line in lines)
+    assert fingerprint(lines).count == 100
+    # Duplicated lines do not cancel out
+    assert fingerprint(["a", "a", "b"]) != fingerprint(["b"])
+    assert fingerprint(lines) != fingerprint(lines[:-1] + ["line0\n"])
+
+
+def test_diff_unordered():
+    lines1 = [f"line{i}" for i in range(1000)]
+    lines2 = list(reversed(lines1))
+    result = diff_unordered(lambda: lines1, lambda: lines2)
+    assert result.count == 0
+    assert result.complete
+
+    # Two lines removed, three added
+    lines2 = lines2[2:] + ["foo", "bar", "line5"]
+    result = diff_unordered(lambda: lines1, lambda: lines2, buckets=16)
+    assert result.count == 3
+    assert result.complete
+    assert len(result.sample) == 5
+    assert set(str(line) for line in result.sample) == {
+        "line999 | -", "line998 | -", "- | foo", "- | bar", "- | line5"
+    }
+
+    result = diff_unordered(lambda: lines1, lambda: lines2, limit=3)
+    assert result.count == 3
+    result = diff_unordered(lambda: lines1, lambda: lines2, limit=1, buckets=1)
+    assert result.count == 3
+    assert not result.complete
+
+
+def _write_bgzf(path: Path, data: bytes, block_size: int = 100):
+    """Write data as BGZF blocks of `block_size` uncompressed bytes."""
+    with open(path, "wb") as out:
+        for start in range(0, len(data) + 1, block_size):
+            # The last block is the empty EOF block
+            chunk = data[start:start + block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            compressed = compressor.compress(chunk) + compressor.flush()
+            out.write(struct.pack(
+                "<4BI2BH2sHH", 0x1F, 0x8B, 8, 4, 0, 0, 255, 6, b"BC", 2,
+                len(compressed) + 25
+            ))
+            out.write(compressed)
+            out.write(struct.pack("<2I", zlib.crc32(chunk), len(chunk)))
+            if not chunk:
+                break
+
+
+def test_bgzf():
+    data = "".join(f"line{i}\n" for i in range(1000)).encode()
+    with tempdir() as d:
+        bgzf = d / "test.txt.gz"
+        _write_bgzf(bgzf, data)
+        assert is_bgzf(bgzf)
+        assert is_gzip(bgzf)
+        with gzip.open(bgzf, "rb") as inp:
+            assert inp.read() == data
+
+        with BgzfReader(bgzf, threads=3, read_ahead=2) as inp:
+            assert inp.readall() == data
+        with open_file(bgzf, threads=4) as inp:
+            assert list(inp) == data.splitlines(keepends=True)
+
+        plain = d / "test.txt"
+        with open(plain, "wb") as out:
+            out.write(data.replace(b"line500\n", b"foo\n"))
+        assert not is_bgzf(plain)
+        result = diff_files(plain, bgzf)
+        assert result.count == 1
+        assert str(result) == "501: foo | 501: line500"
+
+        # Plain gzip files are not BGZF
+        compressed = d / "compressed.gz"
+        with gzip.open(compressed, "wb") as out:
+            out.write(data)
+        assert not is_bgzf(compressed)
+
+        corrupt = d / "corrupt.gz"
+        raw = bytearray(bgzf.read_bytes())
+        raw[30] ^= 0xFF
+        corrupt.write_bytes(bytes(raw))
+        with pytest.raises((OSError, zlib.error)):
+            with open_file(corrupt) as inp:
+                inp.read()
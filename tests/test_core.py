@@ -13,17 +13,22 @@
 #    limitations under the License.
 
 import gzip
+import hashlib
 import json
+import os
+import threading
 import re
+import time
 from typing import cast
 from unittest.mock import Mock
 import pytest
+from pytest_wdl import core
 from pytest_wdl.core import (
     LinkLocalizer, StringLocalizer, UrlLocalizer, DataFile, DataDirs, DataResolver,
     UserConfiguration
 )
 from pytest_wdl.utils import tempdir
-from . import no_internet, setenv
+from . import no_internet, setenv, http_server
 
 
 # TODO: switch after repo is made public
@@ -102,6 +107,33 @@ def test_link_localizer():
         assert bar.exists()
         assert bar.is_symlink()
 
+        baz = d / "baz"
+        localizer = LinkLocalizer(foo, "hardlink")
+        localizer.localize(baz)
+        assert not baz.is_symlink()
+        assert baz.stat().st_ino == foo.stat().st_ino
+
+        # A hard link goes stale if the source is replaced by renaming
+        new_foo = d / "foo.new"
+        with open(new_foo, "wt") as out:
+            out.write("foo2")
+        new_foo.replace(foo)
+        localizer.revalidate(baz)
+        assert baz.stat().st_ino == foo.stat().st_ino
+        assert baz.read_text() == "foo2"
+
+        # A copy goes stale if the source is modified
+        qux = d / "qux"
+        localizer = LinkLocalizer(foo, "copy")
+        localizer.localize(qux)
+        assert qux.stat().st_ino != foo.stat().st_ino
+        localizer.revalidate(qux)
+        with open(foo, "at") as out:
+            out.write("3")
+        localizer.revalidate(qux)
+        assert qux.read_text() == "foo23"
+        assert not (d / "qux.partial").exists()
+
 
 def test_data_file():
     with tempdir() as d:
@@ -133,6 +165,43 @@ def test_data_file():
         df.assert_contents_equal(blorf)
 
 
+def test_data_file_legacy_diff():
+    class LegacyDataFile(DataFile):
+        @classmethod
+        def _diff(cls, file1, file2):
+            return 2
+
+    with tempdir() as d:
+        foo = d / "foo.txt"
+        with open(foo, "wt") as out:
+            out.write("foo\nbar")
+        with pytest.raises(AssertionError, match="^2 lines"):
+            LegacyDataFile(foo, allowed_diff_lines=1).assert_contents_equal(foo)
+        LegacyDataFile(foo, allowed_diff_lines=2).assert_contents_equal(foo)
+
+
+def test_data_file_hash_algorithm():
+    with tempdir() as d:
+        foo = d / "foo.txt"
+        with open(foo, "wt") as out:
+            out.write("foo\nbar")
+        with pytest.raises(ValueError):
+            DataFile(foo, hash_algorithm="foo")
+        df = DataFile(foo, hash_algorithm="blake2b")
+        bar = d / "bar.txt"
+        with open(bar, "wt") as out:
+            out.write("foo\nbar")
+        df.assert_contents_equal(bar)
+        with open(bar, "wt") as out:
+            out.write("foo\nbaz")
+        with pytest.raises(AssertionError, match="BLAKE2B hashes differ"):
+            df.assert_contents_equal(bar)
+        with open(bar, "wt") as out:
+            out.write("foo\nbar\n")
+        with pytest.raises(AssertionError, match="Sizes differ"):
+            df.assert_contents_equal(bar)
+
+
 def test_data_file_gz():
     with tempdir() as d:
         foo = d / "foo.txt.gz"
@@ -148,6 +217,56 @@ def test_data_file_gz():
         df.assert_contents_equal(str(bar))
         df.assert_contents_equal(DataFile(bar))
 
+        # Compression is detected independently for each file, and compressed
+        # files are compared by their decompressed contents
+        plain = d / "plain.txt"
+        with open(plain, "wt") as out:
+            out.write("foo\nbar")
+        DataFile(foo).assert_contents_equal(plain)
+        DataFile(plain).assert_contents_equal(foo)
+        with pytest.raises(AssertionError):
+            DataFile(plain).assert_contents_equal(bar)
+
+        # Exact comparison of decompressed contents is byte for byte, like that
+        # of uncompressed files
+        crlf = d / "crlf.txt.gz"
+        with gzip.open(crlf, "wb") as out:
+            out.write(b"foo\r\nbar\n")
+        with pytest.raises(AssertionError) as excinfo:
+            DataFile(crlf).assert_contents_equal(plain)
+        assert "decompressed contents" in str(excinfo.value)
+        with pytest.raises(AssertionError):
+            DataFile(plain).assert_contents_equal(crlf)
+        DataFile(crlf, allowed_diff_lines=1).assert_contents_equal(plain)
+
+
+def test_data_file_unordered():
+    lines = [f"line{i}\n" for i in range(100)]
+    with tempdir() as d:
+        foo = d / "foo.txt"
+        with open(foo, "wt") as out:
+            out.writelines(lines)
+        bar = d / "bar.txt.gz"
+        with gzip.open(bar, "wt") as out:
+            out.writelines(reversed(lines))
+
+        with pytest.raises(AssertionError):
+            DataFile(foo).assert_contents_equal(bar)
+        DataFile(foo, unordered=True).assert_contents_equal(bar)
+
+        baz = d / "baz.txt"
+        with open(baz, "wt") as out:
+            out.writelines(lines[1:] + ["line1\n", "foo\n"])
+        with pytest.raises(AssertionError) as excinfo:
+            DataFile(foo, unordered=True).assert_contents_equal(baz)
+        assert str(excinfo.value).startswith("More than 0 lines")
+        with pytest.raises(AssertionError) as excinfo:
+            DataFile(
+                foo, unordered=True, allowed_diff_lines=1
+            ).assert_contents_equal(baz)
+        assert str(excinfo.value).startswith("More than 1 lines")
+        DataFile(foo, unordered=True, allowed_diff_lines=2).assert_contents_equal(baz)
+
 
 def test_string_localizer():
     with tempdir() as d:
@@ -298,6 +417,29 @@ def test_data_resolver_env():
             }, UserConfiguration(None, cache_dir=d))
             assert resolver.resolve("foo").path == bar
 
+    # Copies of the source made in a previous session are revalidated
+    with tempdir() as d:
+        path = d / "foo.txt"
+        with open(path, "wt") as out:
+            out.write("v1")
+        copy = d / "cache" / "copy.txt"
+        with setenv({"FOO": str(path)}):
+            for contents in ("v1", "v2 (edited)"):
+                with open(path, "wt") as out:
+                    out.write(contents)
+                resolver = DataResolver({
+                    "foo": {
+                        "env": "FOO",
+                        "path": "copy.txt"
+                    }
+                }, UserConfiguration(
+                    None, cache_dir=d / "cache", localization_strategy="copy"
+                ))
+                foo = resolver.resolve("foo")
+                assert foo.path == copy
+                assert not copy.is_symlink()
+                assert copy.read_text() == contents
+
 
 def test_data_resolver_local_path():
     with tempdir() as d:
@@ -358,6 +500,28 @@ def test_data_resolver_create_from_contents():
             assert inp.read() == "foo"
 
 
+def test_data_resolver_plugin_without_catalog(monkeypatch):
+    class PluginDataFile(DataFile):
+        def __init__(self, local_path, localizer=None, allowed_diff_lines=None):
+            super().__init__(local_path, localizer, allowed_diff_lines)
+
+    monkeypatch.setitem(core.DATA_TYPES, "plugin", PluginDataFile)
+    with tempdir() as d:
+        config = UserConfiguration(None, cache_dir=d)
+        resolver = DataResolver({
+            "foo": {
+                "name": "foo.txt",
+                "contents": "foo",
+                "type": "plugin"
+            }
+        }, config)
+        foo = resolver.resolve("foo")
+        assert isinstance(foo, PluginDataFile)
+        assert foo.catalog is not None
+        assert foo.catalog is config.cache.catalog
+        config.cache.close()
+
+
 def test_data_resolver_create_from_url():
     with tempdir() as d:
         resolver = DataResolver({
@@ -395,6 +559,298 @@ def test_data_resolver_create_from_url():
             assert inp.read() == "foo"
 
 
+def test_data_resolver_prefetch():
+    with tempdir() as d:
+        source = d / "source" / "foo.txt"
+        source.parent.mkdir()
+        with open(source, "wt") as out:
+            out.write("foo")
+        url = source.as_uri()
+        cache_dir = d / "cache"
+        config = UserConfiguration(None, cache_dir=cache_dir, prefetch_threads=2)
+        resolver = DataResolver({
+            "foo": {
+                "url": url,
+                "name": "foo.txt"
+            },
+            "bar": {
+                "url": url,
+                "name": "bar.txt"
+            },
+            "baz": 1
+        }, config)
+        resolver.prefetch()
+        foo = resolver.resolve("foo")
+        assert foo.path == cache_dir / "foo.txt"
+        bar = resolver.resolve("bar")
+        assert bar.path == cache_dir / "bar.txt"
+        for data_file in (foo, bar):
+            with open(data_file.path, "rt") as inp:
+                assert inp.read() == "foo"
+        assert not (cache_dir / "foo.txt.partial").exists()
+        config.cleanup()
+
+
+def test_data_resolver_prefetch_independent():
+    with tempdir() as d:
+        source = d / "source"
+        source.mkdir()
+        for name in ("slow.txt", "fast.txt"):
+            with open(source / name, "wt") as out:
+                out.write(name)
+        cache_dir = d / "cache"
+        config = UserConfiguration(None, cache_dir=cache_dir, prefetch_threads=2)
+        with http_server(source) as (url, server):
+            release = threading.Event()
+            server.hold["/slow.txt"] = release
+            # Releases the slow download in case the fast file waits for it
+            timer = threading.Timer(10, release.set)
+            timer.start()
+            try:
+                resolver = DataResolver({
+                    "slow": {"url": f"{url}/slow.txt"},
+                    "fast": {"url": f"{url}/fast.txt"}
+                }, config)
+                resolver.prefetch()
+                # Resolving a file only waits for its own download
+                start = time.time()
+                fast = resolver.resolve("fast")
+                assert fast.path == cache_dir / "fast.txt"
+                with open(fast.path, "rt") as inp:
+                    assert inp.read() == "fast.txt"
+                assert time.time() - start < 5
+                assert not release.is_set()
+                assert not (cache_dir / "slow.txt").exists()
+                release.set()
+                with open(resolver.resolve("slow").path, "rt") as inp:
+                    assert inp.read() == "slow.txt"
+            finally:
+                release.set()
+                timer.cancel()
+            config.cleanup()
+        assert [path for _, path, _ in server.requests].count("/slow.txt") == 1
+
+
+def test_data_resolver_prefetch_disabled():
+    with tempdir() as d:
+        config = UserConfiguration(None, cache_dir=d)
+        assert config.prefetcher is None
+        resolver = DataResolver({
+            "foo": {
+                "url": "http://foo.com/foo.txt"
+            }
+        }, config)
+        resolver.prefetch()
+        assert not (d / "foo.txt").exists()
+
+
+def test_data_resolver_offline():
+    with tempdir() as d:
+        with open(d / "cached.txt", "wt") as out:
+            out.write("foo")
+        config = UserConfiguration(None, cache_dir=d, offline=True, prefetch_threads=2)
+        assert config.prefetcher is None
+        resolver = DataResolver({
+            "cached": {
+                "url": "http://foo.com/cached.txt"
+            },
+            "missing": {
+                "url": "http://foo.com/missing.txt"
+            },
+            "missing_object": {
+                "url": "http://foo.com/bar.txt",
+                "digests": {
+                    "md5": hashlib.md5(b"bar").hexdigest()
+                }
+            }
+        }, config)
+        assert resolver.find_uncached() == [
+            ("missing", "http://foo.com/missing.txt"),
+            ("missing_object", "http://foo.com/bar.txt")
+        ]
+        assert resolver.resolve("cached").path.read_text() == "foo"
+        with pytest.raises(FileNotFoundError):
+            resolver.resolve("missing").path
+
+    for value, expected in (("true", True), ("0", False)):
+        with setenv({"PYTEST_WDL_OFFLINE": value}):
+            config = UserConfiguration(None)
+            assert config.offline is expected
+            config.cleanup()
+
+
+def test_url_localizer_mirrors():
+    with tempdir() as d:
+        served = d / "served"
+        served.mkdir()
+        data = os.urandom(100000)
+        with open(served / "foo.txt", "wb") as out:
+            out.write(data)
+        empty = d / "empty"
+        empty.mkdir()
+        cache_dir = d / "cache"
+        config = UserConfiguration(None, cache_dir=cache_dir, show_progress=False)
+        with http_server(empty) as (missing_url, missing_server), \
+                http_server(served, truncate_after=40000) as (bad_url, bad_server), \
+                http_server(served) as (good_url, good_server):
+            # Mirrors that do not respond to the probe are tried last
+            urls = [f"{missing_url}/foo.txt", f"{good_url}/foo.txt"]
+            assert config.mirrors.order(urls, lambda url: {}) == urls[::-1]
+            assert [req[0] for req in missing_server.requests] == ["HEAD"]
+            assert config.mirrors.order(urls, lambda url: {}) == urls[::-1]
+            assert len(missing_server.requests) == 1
+
+            # A download that fails partway through is resumed from the next mirror
+            config.mirrors._latencies[bad_url] = 0
+            localizer = UrlLocalizer(
+                [f"{good_url}/foo.txt", f"{bad_url}/foo.txt"], config
+            )
+            localizer.localize(cache_dir / "foo.txt")
+            assert good_server.requests[-1][2]["Range"] == "bytes=40000-"
+            assert config.mirrors.order(
+                localizer.urls, lambda url: {}
+            )[-1] == f"{bad_url}/foo.txt"
+        assert (cache_dir / "foo.txt").read_bytes() == data
+
+
+def test_url_localizer_concurrent():
+    with tempdir() as d:
+        served = d / "served"
+        served.mkdir()
+        with open(served / "foo.txt", "wb") as out:
+            out.write(os.urandom(100000))
+        cache_dir = d / "cache"
+        dest = cache_dir / "foo.txt"
+        config = UserConfiguration(None, cache_dir=cache_dir, show_progress=False)
+        with http_server(served) as (url, server):
+            localizers = [
+                UrlLocalizer(f"{url}/foo.txt", config) for _ in range(4)
+            ]
+            threads = [
+                threading.Thread(target=localizer.download, args=(dest,))
+                for localizer in localizers
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert [req[0] for req in server.requests] == ["GET"]
+        assert dest.read_bytes() == (served / "foo.txt").read_bytes()
+        assert not (cache_dir / "foo.txt.lock").exists()
+
+
+def test_data_resolver_create_from_url_with_digests():
+    with tempdir() as d:
+        source = d / "source" / "foo.txt"
+        source.parent.mkdir()
+        with open(source, "wt") as out:
+            out.write("foo")
+        url = source.as_uri()
+        sha256 = hashlib.sha256(b"foo").hexdigest()
+        cache_dir = d / "cache"
+        config = UserConfiguration(None, cache_dir=cache_dir)
+        resolver = DataResolver({
+            "foo": {
+                "url": url,
+                "name": "foo.txt",
+                "digests": {
+                    "sha256": sha256
+                }
+            },
+            "bar": {
+                "url": url,
+                "name": "bar.txt",
+                "digests": {
+                    "md5": hashlib.md5(b"foo").hexdigest(),
+                    "sha256": sha256.upper()
+                }
+            },
+            "baz": {
+                "url": url,
+                "name": "baz.txt",
+                "digests": {
+                    "md5": hashlib.md5(b"bar").hexdigest()
+                }
+            }
+        }, config)
+        object_path = cache_dir / ".objects" / "sha256" / sha256[:2] / sha256
+        foo = resolver.resolve("foo")
+        assert foo.path == cache_dir / "foo.txt"
+        assert foo.path.is_symlink()
+        assert foo.path.resolve() == object_path
+        bar = resolver.resolve("bar")
+        assert bar.path.resolve() == object_path
+        with open(bar.path, "rt") as inp:
+            assert inp.read() == "foo"
+        assert len(list((cache_dir / ".objects").glob("**/*"))) == 3
+
+        with pytest.raises(RuntimeError):
+            resolver.resolve("baz").path
+        assert not (cache_dir / "baz.txt").exists()
+        assert not any(
+            path.is_file() for path in (cache_dir / ".objects").glob("md5/**/*")
+        )
+
+
+def test_data_resolver_revalidate():
+    with tempdir() as d:
+        served = d / "served"
+        served.mkdir()
+        source = served / "foo.txt"
+        with open(source, "wt") as out:
+            out.write("foo")
+        mtime = time.time() - 100
+        os.utime(source, (mtime, mtime))
+        cache_dir = d / "cache"
+
+        def resolve(url, revalidate):
+            config = UserConfiguration(None, cache_dir=cache_dir, revalidate=revalidate)
+            return DataResolver({
+                "foo": {
+                    "url": f"{url}/foo.txt"
+                }
+            }, config).resolve("foo")
+
+        with http_server(served) as (url, server):
+            foo = resolve(url, "session")
+            assert foo.path == cache_dir / "foo.txt"
+            assert (cache_dir / "foo.txt.meta.json").exists()
+            assert len(server.requests) == 1
+            # Already validated in this session
+            assert foo.path.read_text() == "foo"
+            assert len(server.requests) == 1
+
+            # New session; the file has not changed
+            foo = resolve(url, "session")
+            assert foo.path.read_text() == "foo"
+            assert len(server.requests) == 2
+            assert "If-Modified-Since" in server.requests[-1][2]
+
+            # Never revalidate
+            with open(source, "wt") as out:
+                out.write("bar")
+            foo = resolve(url, "never")
+            assert foo.path.read_text() == "foo"
+            assert len(server.requests) == 2
+
+            # Not expired
+            foo = resolve(url, 3600)
+            assert foo.path.read_text() == "foo"
+            assert len(server.requests) == 2
+
+            # New session; the file has changed
+            foo = resolve(url, "session")
+            assert foo.path.read_text() == "bar"
+            assert len(server.requests) == 3
+
+        # The cached file is used if the URL cannot be reached
+        foo = resolve(url, "session")
+        assert foo.path.read_text() == "bar"
+
+    with pytest.raises(ValueError):
+        UserConfiguration(revalidate="always")
+
+
 def test_data_resolver_create_from_datadir():
     with tempdir() as d, tempdir() as d1:
         mod = Mock()
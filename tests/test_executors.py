@@ -18,8 +18,11 @@ import zipfile
 from pytest_wdl.utils import tempdir
 import pytest
 
+from pytest_wdl.core import DataFile, StringLocalizer
 from pytest_wdl.utils import ENV_PATH, ENV_CLASSPATH
-from pytest_wdl.executors import get_workflow, get_workflow_imports, get_workflow_inputs
+from pytest_wdl.executors import (
+    check_outputs, get_workflow, get_workflow_imports, get_workflow_inputs
+)
 from pytest_wdl.executors.cromwell import (
     ENV_CROMWELL_CONFIG, ENV_JAVA_HOME, ENV_CROMWELL_ARGS, ENV_CROMWELL_JAR,
     CromwellExecutor
@@ -209,3 +212,42 @@ def test_get_workflow_imports():
         zip_path = get_workflow_imports(imports_file=imports_file)
         assert zip_path.exists()
         assert zip_path == imports_file
+
+
+class CpuBoundDataFile(DataFile):
+    cpu_bound = True
+
+
+def test_check_outputs():
+    with tempdir() as d:
+        actual = {}
+        expected = {}
+        for name, cls in (
+            ("a", DataFile), ("b", CpuBoundDataFile), ("c", CpuBoundDataFile)
+        ):
+            actual_file = d / f"{name}.actual"
+            with open(actual_file, "wt") as out:
+                out.write(f"{name}\n")
+            actual[f"wf.{name}"] = str(actual_file)
+            expected[name] = cls(
+                d / f"{name}.expected", StringLocalizer(f"{name}\n")
+            )
+        actual["wf.d"] = 1
+        expected["d"] = 1
+
+        for max_workers in (1, 4):
+            check_outputs("wf", actual, expected, max_workers)
+
+        # All mismatches are reported together
+        expected["b"] = CpuBoundDataFile(d / "b2.expected", StringLocalizer("x\n"))
+        expected["c"] = CpuBoundDataFile(d / "c2.expected", StringLocalizer("y\n"))
+        expected["d"] = 2
+        expected["e"] = "missing"
+        for max_workers in (1, 4):
+            with pytest.raises(AssertionError) as excinfo:
+                check_outputs("wf", actual, expected, max_workers)
+            message = str(excinfo.value)
+            assert message.startswith("4 of 5 expected outputs did not match")
+            for key in ("wf.b", "wf.c", "wf.d", "wf.e"):
+                assert f"\n{key}: " in message
+            assert "wf.a:" not in message
@@ -12,13 +12,21 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import json
 from pathlib import Path
+import textwrap
+from unittest.mock import Mock
+from pytest_wdl.core import UserConfiguration
 from pytest_wdl.fixtures import (
-    ENV_USER_CONFIG, DEFAULT_USER_CONFIG_FILE, import_dirs, user_config_file
+    ENV_USER_CONFIG, DEFAULT_USER_CONFIG_FILE, import_dirs, user_config_file,
+    workflow_data_resolver
 )
 from pytest_wdl.utils import tempdir
 import pytest
-from . import setenv
+from . import http_server, setenv
+
+
+pytest_plugins = ["pytester"]
 
 
 def test_user_config_file():
@@ -38,6 +46,87 @@ def test_user_config_file():
         assert user_config_file() == config
 
 
+def test_workflow_data_resolver_offline():
+    descriptors = {
+        "foo": {
+            "url": "http://foo.com/foo.txt",
+            "name": "foo.txt"
+        }
+    }
+    request = Mock()
+    request.node.nodeid = "tests/test_foo.py"
+    with tempdir() as d:
+        config = UserConfiguration(None, cache_dir=d, offline=True)
+        # Descriptors that the session-level check may not have found are checked
+        # when the module's resolver is created
+        with pytest.raises(pytest.exit.Exception) as excinfo:
+            workflow_data_resolver(request, descriptors, config)
+        assert "foo (http://foo.com/foo.txt) in tests/test_foo.py" in str(
+            excinfo.value
+        )
+        with open(d / "foo.txt", "wt") as out:
+            out.write("foo")
+        resolver = workflow_data_resolver(request, descriptors, config)
+        assert resolver.resolve("foo").path.read_text() == "foo"
+        config.cleanup()
+
+
+def test_workflow_data_prefetch(pytester, monkeypatch):
+    with tempdir() as d:
+        source = d / "source"
+        source.mkdir()
+        with open(source / "bar.txt", "wt") as out:
+            out.write("bar")
+        cache_dir = d / "cache"
+        config = d / "config.json"
+        with open(config, "wt") as out:
+            json.dump({"cache_dir": str(cache_dir), "prefetch_threads": 2}, out)
+        monkeypatch.setenv(ENV_USER_CONFIG, str(config))
+
+        with http_server(source) as (url, server):
+            # The tests of module 'a' run before those of module 'b', whose data
+            # descriptor file is only used by 'b', next to it
+            pytester.makefile(".json", **{"a/test_data": "{}"})
+            pytester.makefile(
+                ".json",
+                **{"b/test_data": json.dumps({"bar": {"url": f"{url}/bar.txt"}})}
+            )
+            pytester.makepyfile(**{
+                "a/test_a": textwrap.dedent("""
+                    from pathlib import Path
+                    import time
+
+                    import pytest
+
+                    @pytest.fixture(scope="module")
+                    def workflow_data_descriptor_file():
+                        return Path(__file__).parent / "test_data.json"
+
+                    def test_a(workflow_data, user_config):
+                        path = user_config.cache_dir / "bar.txt"
+                        deadline = time.time() + 10
+                        while not path.exists() and time.time() < deadline:
+                            time.sleep(0.1)
+                        assert path.read_text() == "bar"
+                """),
+                "b/test_b": textwrap.dedent("""
+                    from pathlib import Path
+
+                    import pytest
+
+                    @pytest.fixture(scope="module")
+                    def workflow_data_descriptor_file():
+                        return Path(__file__).parent / "test_data.json"
+
+                    def test_b(workflow_data):
+                        assert workflow_data["bar"].path.read_text() == "bar"
+                """)
+            })
+            result = pytester.runpytest("a", "b")
+            result.assert_outcomes(passed=2)
+        assert [path for _, path, _ in server.requests] == ["/bar.txt"]
+
+
 def test_fixtures(workflow_data, workflow_runner):
     inputs = {
         "in_txt": workflow_data["in_txt"],
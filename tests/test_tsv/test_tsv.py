@@ -0,0 +1,190 @@
+#    Copyright 2019 Eli Lilly and Company
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import gzip
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from pytest_wdl.data_types import tsv  # noqa: E402
+from pytest_wdl.data_types.tsv import CsvDataFile, TsvDataFile  # noqa: E402
+from pytest_wdl.utils import tempdir  # noqa: E402
+
+
+def _write(path, rows, delimiter="\t", compress=False):
+    opener = gzip.open if compress else open
+    with opener(path, "wt") as out:
+        for row in rows:
+            out.write(delimiter.join(str(value) for value in row) + "\n")
+
+
+def test_tsv_data_file():
+    rows = [["sample", "coverage", "status"]] + [
+        [f"S{i}", 30.0 + i / 7, "PASS"] for i in range(25)
+    ]
+    with tempdir() as d:
+        tsv1 = d / "metrics1.tsv"
+        _write(tsv1, rows)
+        tsv2 = d / "metrics2.tsv.gz"
+        noisy = [rows[0]] + [[s, f"{c + 1e-7:.9f}", st] for s, c, st in rows[1:]]
+        _write(tsv2, noisy, compress=True)
+
+        with pytest.raises(AssertionError):
+            TsvDataFile(tsv1).assert_contents_equal(tsv2)
+        TsvDataFile(tsv1, abs_tolerance=1e-6).assert_contents_equal(tsv2)
+        TsvDataFile(tsv1, rel_tolerance=1e-6).assert_contents_equal(tsv2)
+
+        # A string value and a missing row differ
+        changed = [row[:] for row in noisy[:-1]]
+        changed[3][2] = "FAIL"
+        tsv3 = d / "metrics3.tsv"
+        _write(tsv3, changed)
+        with pytest.raises(AssertionError) as excinfo:
+            TsvDataFile(tsv1, abs_tolerance=1e-6).assert_contents_equal(tsv3)
+        message = str(excinfo.value)
+        assert message.startswith("More than 0 rows")
+        assert "row 3: column status: PASS != FAIL" in message
+        TsvDataFile(
+            tsv1, abs_tolerance=1e-6, allowed_diff_lines=2
+        ).assert_contents_equal(tsv3)
+        with pytest.raises(AssertionError) as excinfo:
+            TsvDataFile(
+                tsv1, abs_tolerance=1e-6, allowed_diff_lines=1
+            ).assert_contents_equal(tsv3)
+        assert "row 25: only in the first file" in str(excinfo.value)
+
+        # Different column names
+        tsv4 = d / "metrics4.tsv"
+        _write(tsv4, [["sample", "depth", "status"]] + rows[1:])
+        with pytest.raises(AssertionError) as excinfo:
+            TsvDataFile(tsv1).assert_contents_equal(tsv4)
+        assert "Column names differ" in str(excinfo.value)
+        # Differing column names fail regardless of allowed_diff_lines, even if
+        # the rows differ too
+        tsv5 = d / "metrics5.tsv"
+        _write(tsv5, [["sample", "depth", "status"]] + changed[1:])
+        with pytest.raises(AssertionError) as excinfo:
+            TsvDataFile(
+                tsv1, abs_tolerance=1e-6, allowed_diff_lines=1
+            ).assert_contents_equal(tsv4)
+        assert "Column names differ" in str(excinfo.value)
+        with pytest.raises(AssertionError) as excinfo:
+            TsvDataFile(tsv1, allowed_diff_lines=100).assert_contents_equal(tsv5)
+        assert "Column names differ" in str(excinfo.value)
+
+
+def test_tsv_data_file_keys(monkeypatch):
+    monkeypatch.setattr(tsv, "CHUNK_SIZE", 4)
+    rows = [["sample", "lane", "reads"]] + [
+        [f"S{i}", lane, i * 1000 + lane] for i in range(10) for lane in (1, 2)
+    ]
+    with tempdir() as d:
+        csv1 = d / "reads1.csv"
+        _write(csv1, rows, ",")
+        csv2 = d / "reads2.csv"
+        _write(csv2, [rows[0]] + list(reversed(rows[1:])), ",")
+
+        with pytest.raises(AssertionError):
+            CsvDataFile(csv1).assert_contents_equal(csv2)
+        CsvDataFile(csv1, key_columns=["sample", "lane"]).assert_contents_equal(csv2)
+        # Unknown key columns are reported with the available columns
+        with pytest.raises(ValueError) as excinfo:
+            CsvDataFile(csv1, key_columns=["sample", "flowcell", 5]).assert_contents_equal(
+                csv2
+            )
+        assert str(excinfo.value) == (
+            f"Key columns ['flowcell', 5] are not in the header of {csv1}; the "
+            f"available columns are {rows[0]}"
+        )
+
+        csv3 = d / "reads3.csv"
+        _write(csv3, [rows[0]] + rows[2:] + [["S10", 1, 1]], ",")
+        for partitions in (1, 3):
+            monkeypatch.setattr(tsv, "PARTITION_SIZE", 1 if partitions > 1 else 2 ** 30)
+            monkeypatch.setattr(tsv, "MAX_PARTITIONS", partitions)
+            data_file = CsvDataFile(csv1, key_columns=["sample", "lane"])
+            result = data_file._diff_tables(csv1, csv3)
+            assert result.count == 2
+            assert sorted(result.sample) == [
+                "key ('S0', '1'): only in the first file",
+                "key ('S10', '1'): only in the second file"
+            ]
+
+        # Key columns by index
+        csv4 = d / "reads4.csv"
+        _write(csv4, list(reversed(rows[1:])), ",")
+        csv5 = d / "reads5.csv"
+        _write(csv5, rows[1:], ",")
+        CsvDataFile(
+            csv4, header=False, key_columns=[0, 1]
+        ).assert_contents_equal(csv5)
+        with pytest.raises(ValueError):
+            CsvDataFile(csv4, header=False, key_columns=["sample"])
+
+
+def test_tsv_data_file_column_types(monkeypatch):
+    monkeypatch.setattr(tsv, "CHUNK_SIZE", 3)
+    rows = [["id", "name", "reads", "ratio"]] + [
+        [f"00{i}", f"S{i}", 1000 * (i + 1), 0.5] for i in range(6)
+    ]
+    rows[5][3] = "NA"
+    with tempdir() as d:
+        tsv1 = d / "ids1.tsv"
+        _write(tsv1, rows)
+        # Zero-padded and non-numeric columns are compared as strings, even if
+        # their values parse as equal numbers
+        changed = [row[:] for row in rows]
+        changed[2][0] = "1"
+        changed[3][1] = "S2.0"
+        tsv2 = d / "ids2.tsv"
+        _write(tsv2, changed)
+        result = TsvDataFile(tsv1, abs_tolerance=1e-6)._diff_tables(tsv1, tsv2)
+        assert result.count == 2
+        assert result.sample == [
+            "row 2: column id: 001 != 1", "row 3: column name: S2 != S2.0"
+        ]
+
+        # Numeric columns are compared as numbers, and other values in them as
+        # strings
+        changed = [row[:] for row in rows]
+        changed[1][2] = "1e3"
+        changed[2][3] = "0.50"
+        tsv3 = d / "ids3.tsv"
+        _write(tsv3, changed)
+        TsvDataFile(tsv1).assert_contents_equal(tsv3)
+        changed[5][3] = "0.5"
+        _write(tsv3, changed)
+        with pytest.raises(AssertionError) as excinfo:
+            TsvDataFile(tsv1).assert_contents_equal(tsv3)
+        assert "row 5: column ratio: NA != 0.5" in str(excinfo.value)
+
+        # The numeric columns can be given explicitly
+        changed = [row[:] for row in rows]
+        changed[4][0] = "3"
+        changed[4][2] = "4000.0"
+        tsv4 = d / "ids4.tsv"
+        _write(tsv4, changed)
+        with pytest.raises(AssertionError):
+            TsvDataFile(tsv1).assert_contents_equal(tsv4)
+        TsvDataFile(
+            tsv1, numeric_columns=["id", "reads"]
+        ).assert_contents_equal(tsv4)
+        result = TsvDataFile(tsv1, numeric_columns=[0])._diff_tables(tsv1, tsv4)
+        assert result.sample == ["row 4: column reads: 4000 != 4000.0"]
+        with pytest.raises(ValueError) as excinfo:
+            TsvDataFile(tsv1, numeric_columns=["count"]).assert_contents_equal(tsv4)
+        assert str(excinfo.value).startswith("Numeric columns ['count'] are not")
+        with pytest.raises(ValueError):
+            TsvDataFile(tsv1, header=False, numeric_columns=["reads"])
@@ -12,17 +12,26 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import multiprocessing
 import os
+import socket
 import stat
+import subprocess
+import sys
+import threading
+import time
 from pathlib import Path
 
 import pytest
 from pytest_wdl.utils import (
     tempdir, chdir, context_dir, ensure_path, resolve_file,
-    find_executable_path, find_project_path, env_map, plugin_factory_map
+    find_executable_path, find_project_path, env_map, plugin_factory_map,
+    download_file, FileLock, ConnectionPool, link_file, process_pool,
+    in_worker_process
 )
 from unittest.mock import Mock
-from . import setenv, make_executable
+from urllib.error import HTTPError
+from . import setenv, make_executable, http_server
 
 
 def test_tempdir():
@@ -201,3 +210,277 @@ def test_plugin_factory_map():
     entry_points.append(ep3)
     with pytest.raises(RuntimeError):
         plugin_factory_map(None, entry_points=entry_points)
+
+
+def test_link_file():
+    with tempdir() as d:
+        source = d / "source.txt"
+        with open(source, "wt") as out:
+            out.write("foo")
+        with pytest.raises(ValueError):
+            link_file(source, d / "foo.txt", "foo")
+
+        assert link_file(source, d / "symlink.txt") == "symlink"
+        assert (d / "symlink.txt").is_symlink()
+
+        assert link_file(source, d / "hardlink.txt", "hardlink") == "hardlink"
+        assert (d / "hardlink.txt").stat().st_ino == source.stat().st_ino
+
+        assert link_file(source, d / "copy.txt", "copy") == "copy"
+        assert not (d / "copy.txt").is_symlink()
+        assert (d / "copy.txt").stat().st_ino != source.stat().st_ino
+
+        # Falls back to a hard link if the file system doesn't support reflinks
+        assert link_file(source, d / "reflink.txt", "reflink") in (
+            "reflink", "hardlink"
+        )
+        assert (d / "reflink.txt").read_text() == "foo"
+        assert not (d / "reflink.txt.partial").exists()
+
+        with pytest.raises(FileExistsError):
+            link_file(source, d / "copy.txt", "hardlink")
+
+
+def test_download_file():
+    with tempdir() as d:
+        served = d / "served"
+        served.mkdir()
+        with open(served / "foo.txt", "wb") as out:
+            out.write(os.urandom(100000))
+        dest = d / "foo.txt"
+        with http_server(served) as (url, server):
+            download_file(f"{url}/foo.txt", dest, show_progress=False)
+        assert dest.read_bytes() == (served / "foo.txt").read_bytes()
+        assert not (d / "foo.txt.partial").exists()
+
+
+def test_download_file_resume():
+    with tempdir() as d:
+        served = d / "served"
+        served.mkdir()
+        data = os.urandom(100000)
+        with open(served / "foo.txt", "wb") as out:
+            out.write(data)
+        dest = d / "foo.txt"
+        partial = d / "foo.txt.partial"
+        validator = d / "foo.txt.partial.validator"
+
+        with http_server(served, truncate_after=40000) as (url, server):
+            with pytest.raises(IOError):
+                download_file(f"{url}/foo.txt", dest, show_progress=False)
+        assert partial.stat().st_size == 40000
+        last_modified = validator.read_text()
+        with http_server(served) as (url, server):
+            download_file(f"{url}/foo.txt", dest, show_progress=False)
+            assert server.requests[-1][2]["Range"] == "bytes=40000-"
+            assert server.requests[-1][2]["If-Range"] == last_modified
+        assert dest.read_bytes() == data
+        assert not partial.exists()
+        assert not validator.exists()
+
+        # A complete partial file is renamed without downloading it again
+        dest.unlink()
+        partial.write_bytes(data)
+        validator.write_text(last_modified)
+        with http_server(served) as (url, server):
+            download_file(f"{url}/foo.txt", dest, show_progress=False)
+        assert dest.read_bytes() == data
+        assert not partial.exists()
+        assert not validator.exists()
+
+        # If the file has changed, the download is restarted
+        dest.unlink()
+        partial.write_bytes(b"x" * 40000)
+        validator.write_text(last_modified)
+        data = os.urandom(100000)
+        with open(served / "foo.txt", "wb") as out:
+            out.write(data)
+        mtime = (served / "foo.txt").stat().st_mtime + 10
+        os.utime(served / "foo.txt", (mtime, mtime))
+        with http_server(served) as (url, server):
+            download_file(f"{url}/foo.txt", dest, show_progress=False)
+            assert server.requests[-1][2]["If-Range"] == last_modified
+        assert dest.read_bytes() == data
+        assert not partial.exists()
+
+        # A partial file without a validator is discarded
+        dest.unlink()
+        partial.write_bytes(b"x" * 40000)
+        with http_server(served) as (url, server):
+            download_file(f"{url}/foo.txt", dest, show_progress=False)
+            assert "Range" not in server.requests[-1][2]
+        assert dest.read_bytes() == data
+        assert not partial.exists()
+
+        # If the server doesn't support ranges, the download is restarted
+        dest.unlink()
+        partial.write_bytes(b"x" * 40000)
+        validator.write_text(last_modified)
+        with http_server(served, support_ranges=False) as (url, server):
+            download_file(f"{url}/foo.txt", dest, show_progress=False)
+        assert dest.read_bytes() == data
+        assert not partial.exists()
+
+
+def test_download_file_segments():
+    with tempdir() as d:
+        served = d / "served"
+        served.mkdir()
+        data = os.urandom(100000)
+        with open(served / "foo.txt", "wb") as out:
+            out.write(data)
+        dest = d / "foo.txt"
+
+        with http_server(served) as (url, server):
+            download_file(
+                f"{url}/foo.txt", dest, show_progress=False, segments=4,
+                min_segment_size=30000
+            )
+            assert server.requests[0][0] == "HEAD"
+            ranges = sorted(req[2]["Range"] for req in server.requests[1:])
+            assert ranges == [
+                "bytes=0-33333", "bytes=33334-66667", "bytes=66668-99999"
+            ]
+        assert dest.read_bytes() == data
+        assert not (d / "foo.txt.segments").exists()
+
+        # Falls back to a single stream if the server doesn't support ranges
+        dest.unlink()
+        with http_server(served, support_ranges=False) as (url, server):
+            download_file(
+                f"{url}/foo.txt", dest, show_progress=False, segments=4,
+                min_segment_size=1000
+            )
+            assert [req[0] for req in server.requests] == ["HEAD", "GET"]
+            assert "Range" not in server.requests[1][2]
+        assert dest.read_bytes() == data
+
+
+def test_download_file_connection_pool():
+    with tempdir() as d:
+        served = d / "served"
+        served.mkdir()
+        for i in range(5):
+            with open(served / f"foo{i}.txt", "wb") as out:
+                out.write(os.urandom(10000))
+        pool = ConnectionPool(max_size=2)
+        with http_server(served, keep_alive=True) as (url, server):
+            for i in range(5):
+                download_file(
+                    f"{url}/foo{i}.txt", d / f"foo{i}.txt", show_progress=False,
+                    connection_pool=pool
+                )
+            assert len(server.clients) == 1
+            # Segmented downloads open concurrent connections, of which at most
+            # `max_size` are kept
+            download_file(
+                f"{url}/foo0.txt", d / "bar.txt", show_progress=False, segments=4,
+                min_segment_size=2000, connection_pool=pool
+            )
+            assert sum(len(conns) for conns in pool._idle.values()) <= 2
+            with pytest.raises(HTTPError):
+                download_file(
+                    f"{url}/missing.txt", d / "missing.txt", show_progress=False,
+                    connection_pool=pool
+                )
+            pool.close()
+            assert not pool._idle
+        for i in range(5):
+            assert (d / f"foo{i}.txt").read_bytes() == \
+                (served / f"foo{i}.txt").read_bytes()
+        assert (d / "bar.txt").read_bytes() == (served / "foo0.txt").read_bytes()
+
+
+def test_connection_pool_environment_proxies():
+    with tempdir() as d:
+        served = d / "served"
+        served.mkdir()
+        with open(served / "foo.txt", "wb") as out:
+            out.write(os.urandom(10000))
+        pool = ConnectionPool(timeout=5)
+        no_env_proxies = dict(
+            (name, None) for name in ("http_proxy", "https_proxy", "no_proxy")
+        )
+        with http_server(served) as (url, server), setenv(no_env_proxies):
+            # Requests are sent to the proxy in the environment
+            with setenv({"HTTP_PROXY": url, "NO_PROXY": None}):
+                with pytest.raises(HTTPError):
+                    download_file(
+                        "http://pytest-wdl.invalid/foo.txt", d / "proxied.txt",
+                        show_progress=False, connection_pool=pool
+                    )
+                assert server.requests[-1][1] == "http://pytest-wdl.invalid/foo.txt"
+            # ...unless the host is excluded
+            with setenv({"HTTP_PROXY": "http://127.0.0.1:9", "NO_PROXY": "127.0.0.1"}):
+                download_file(
+                    f"{url}/foo.txt", d / "foo.txt", show_progress=False,
+                    connection_pool=pool
+                )
+        pool.close()
+        assert (d / "foo.txt").read_bytes() == (served / "foo.txt").read_bytes()
+
+
+def test_file_lock():
+    with tempdir() as d:
+        path = d / "foo.txt"
+        lock_path = d / "foo.txt.lock"
+        events = []
+
+        def hold():
+            with FileLock(path, poll_interval=0.01):
+                events.append("start")
+                time.sleep(0.1)
+                events.append("end")
+
+        threads = [threading.Thread(target=hold) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert events == ["start", "end"] * 3
+        assert not lock_path.exists()
+
+        with FileLock(path):
+            with pytest.raises(TimeoutError):
+                FileLock(path, timeout=0.05, poll_interval=0.01).acquire()
+
+
+def test_file_lock_stale():
+    with tempdir() as d:
+        path = d / "foo.txt"
+        lock_path = d / "foo.txt.lock"
+
+        # The owner process on this host no longer exists
+        proc = subprocess.Popen([sys.executable, "-c", "pass"])
+        proc.wait()
+        stale_token = f"{socket.gethostname()} {proc.pid} x"
+        with open(lock_path, "wt") as out:
+            out.write(stale_token)
+        with FileLock(path, timeout=1, poll_interval=0.01):
+            assert lock_path.read_text() != stale_token
+        assert not lock_path.exists()
+
+        # The lock has not been refreshed by its owner on another host
+        with open(lock_path, "wt") as out:
+            out.write("otherhost 1 x")
+        with pytest.raises(TimeoutError):
+            FileLock(path, timeout=0.05, poll_interval=0.01).acquire()
+        old = time.time() - 120
+        os.utime(lock_path, (old, old))
+        with FileLock(path, timeout=1, poll_interval=0.01):
+            pass
+        assert not lock_path.exists()
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 7) or
+    "forkserver" not in multiprocessing.get_all_start_methods(),
+    reason="the forkserver start method is not available"
+)
+def test_process_pool():
+    with process_pool(1) as pool:
+        # Workers are forked by the fork server, not by this process
+        assert pool.submit(os.getppid).result() != os.getpid()
+        # Workers are marked so that they do not start nested pools
+        assert pool.submit(in_worker_process).result()
+    assert not in_worker_process()
@@ -12,7 +12,11 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-from pytest_wdl.data_types.vcf import VcfDataFile
+import gzip
+
+from pytest_wdl.data_types.vcf import (
+    VcfDataFile, VcfReader, _encode_genotypes, genotype_concordance, join_records
+)
 from pytest_wdl.core import StringLocalizer
 from pytest_wdl.utils import tempdir, find_project_path
 from .. import no_internet
@@ -56,6 +60,234 @@ def test_vcf_data_file_different():
         v1.assert_contents_equal(v2)
 
 
+VCF_HEADER = (
+    "##fileformat=VCFv4.2\n"
+    "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\n"
+)
+
+
+def test_vcf_reader():
+    with tempdir() as temp:
+        vcf = temp / "foo.vcf.gz"
+        with gzip.open(vcf, "wt") as out:
+            out.write(VCF_HEADER)
+            out.write("chr1\t1111\t.\tA\tG\t1000\tPASS\t.\tDP:GT\t10:0/1\t5\n")
+            out.write("chr1\t2222\t.\tT\tC\t500\tPASS\t.\n")
+        with VcfReader(vcf) as reader:
+            assert reader.samples == ["S1", "S2"]
+            records = list(reader)
+        assert len(records) == 2
+        assert records[0].pos == 1111
+        assert records[0].genotypes == ["0/1", "."]
+        assert records[1].format is None
+        assert records[1].genotypes == []
+
+
+def test_vcf_data_file_samples():
+    with tempdir() as temp:
+        localizer1 = StringLocalizer(
+            VCF_HEADER +
+            "chr1\t1111\t.\tA\tG\t1000\tPASS\tDP=1\tGT:DP\t0/1:10\t1/1:5\n"
+        )
+        v1 = VcfDataFile(temp / "foo1.vcf", localizer1)
+        # Compressed, with different QUAL, INFO, and non-GT sample fields
+        vcf2 = temp / "foo2.vcf.gz"
+        with gzip.open(vcf2, "wt") as out:
+            out.write(VCF_HEADER)
+            out.write("chr1\t1111\t.\tA\tG\t999\tPASS\t.\tDP:GT\t9:0/1\t4:1/1\n")
+        v1.assert_contents_equal(vcf2)
+
+        # The genotype of the second sample differs
+        vcf3 = temp / "foo3.vcf"
+        with open(vcf3, "wt") as out:
+            out.write(VCF_HEADER)
+            out.write("chr1\t1111\t.\tA\tG\t1000\tPASS\t.\tGT\t0/1\t0/1\n")
+        with pytest.raises(AssertionError):
+            v1.assert_contents_equal(vcf3)
+
+
+def test_vcf_data_file_unordered():
+    with tempdir() as temp:
+        records = [
+            f"chr1\t{pos}\t.\tA\tG\t50\tPASS\t.\tGT\t0/1\t1/1\n"
+            for pos in range(1, 11)
+        ]
+        vcf1 = temp / "foo1.vcf"
+        with open(vcf1, "wt") as out:
+            out.write(VCF_HEADER)
+            out.writelines(records)
+        vcf2 = temp / "foo2.vcf.gz"
+        with gzip.open(vcf2, "wt") as out:
+            out.write(VCF_HEADER)
+            out.writelines(reversed(records))
+        with pytest.raises(AssertionError):
+            VcfDataFile(vcf1).assert_contents_equal(vcf2)
+        VcfDataFile(vcf1, unordered=True).assert_contents_equal(vcf2)
+
+
+def test_vcf_data_file_tolerance():
+    header = "##contig=<ID=chr2>\n##contig=<ID=chr1>\n" + VCF_HEADER
+    with tempdir() as temp:
+        vcf1 = temp / "foo1.vcf"
+        with open(vcf1, "wt") as out:
+            out.write(header)
+            out.write("chr2\t10\t.\tA\tG\t50.01\tPASS\tAF=0.5;DB\tGT:GQ\t0/1:30\t./.:.\n")
+            out.write("chr2\t20\t.\tA\tG,T\t40\tPASS\tAF=0.25,0.25\tGT\t1/2\t0/0\n")
+            out.write("chr2\t20\t.\tC\tT\t40\tPASS\tAF=0.5\tGT\t0/1\t0/0\n")
+            out.write("chr1\t5\t.\tT\tC\t60\tPASS\tAF=1\tGT\t1/1\t1/1\n")
+        vcf2 = temp / "foo2.vcf"
+        with open(vcf2, "wt") as out:
+            out.write(header)
+            out.write("chr2\t10\t.\tA\tG\t50.02\tPASS\tDB;AF=0.501\tGT:GQ\t0/1:31\t./.:.\n")
+            # Same position, different order
+            out.write("chr2\t20\t.\tC\tT\t40\tPASS\tAF=0.5\tGT\t0/1\t0/0\n")
+            out.write("chr2\t20\t.\tA\tG,T\t40\tPASS\tAF=0.25,0.26\tGT\t1/2\t0/0\n")
+            out.write("chr1\t5\t.\tT\tC\t60\tPASS\tAF=1\tGT\t1/1\t1/1\n")
+
+        fields = ["QUAL", "INFO/AF", "FORMAT/GQ"]
+        VcfDataFile(
+            vcf1, fields=fields, abs_tolerance=0.01, rel_tolerance=0.05
+        ).assert_contents_equal(vcf2)
+        with pytest.raises(AssertionError) as excinfo:
+            VcfDataFile(vcf1, fields=fields).assert_contents_equal(vcf2)
+        message = str(excinfo.value)
+        assert message.startswith("More than 0 records")
+        assert "chr2:10 A>G: QUAL ['50.01'] != ['50.02']" in message
+        VcfDataFile(
+            vcf1, fields=fields, allowed_diff_lines=2
+        ).assert_contents_equal(vcf2)
+
+        with VcfReader(vcf1) as reader1, VcfReader(vcf2) as reader2:
+            result = join_records(reader1, reader2, fields, contigs=reader1.contigs)
+        assert str(result) == (
+            "4 records in both files (2 concordant, 2 discordant), 0 only in the "
+            "first file, 0 only in the second file"
+        )
+        with VcfReader(vcf1) as reader1, VcfReader(vcf2) as reader2:
+            result = join_records(
+                reader1, reader2, ["INFO/AF"], abs_tolerance=0.01,
+                contigs=reader1.contigs
+            )
+        assert (result.both, result.concordant) == (4, 3)
+        assert (result.only1, result.only2) == (0, 0)
+
+        # Without ##contig lines, chr1 after chr2 is only allowed if the files
+        # have the same contig order
+        vcf3 = temp / "foo3.vcf"
+        with open(vcf3, "wt") as out:
+            out.write(VCF_HEADER)
+            out.write("chr1\t5\t.\tT\tC\t60\tPASS\tAF=1\tGT\t1/1\t1/1\n")
+            out.write("chr1\t6\t.\tT\tC\t60\tPASS\tAF=1\tGT\t1/1\t1/1\n")
+        with VcfReader(vcf3) as reader1, VcfReader(vcf2) as reader2:
+            with pytest.raises(AssertionError, match=f"in file {vcf2} are not sorted"):
+                join_records(reader1, reader2, [])
+        with VcfReader(vcf2) as reader1, VcfReader(vcf3) as reader2:
+            result = join_records(reader1, reader2, [], contigs=reader1.contigs)
+        assert (result.both, result.only1, result.only2) == (1, 3, 1)
+
+        with pytest.raises(ValueError):
+            VcfDataFile(vcf1, fields=["DP"])
+
+
+def test_vcf_data_file_discordance_rate():
+    pytest.importorskip("numpy")
+    samples = [f"S{i}" for i in range(8)]
+    header = (
+        "##fileformat=VCFv4.2\n"
+        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" +
+        "\t".join(samples) + "\n"
+    )
+    with tempdir() as temp:
+        vcf1 = temp / "foo1.vcf"
+        vcf2 = temp / "foo2.vcf"
+        with open(vcf1, "wt") as out1, open(vcf2, "wt") as out2:
+            out1.write(header)
+            # The samples are in reverse order in the second file
+            out2.write(header.replace("\t".join(samples), "\t".join(reversed(samples))))
+            for pos in range(1, 101):
+                genotypes = ["0/1", "1|0", "1/1", "./.", "0/0", "0|1", "1/1", "0/0"]
+                if pos == 50:
+                    genotypes2 = list(genotypes)
+                    genotypes2[2] = "0/1"
+                else:
+                    # Phasing and allele order are ignored
+                    genotypes2 = [
+                        gt.replace("|", "/").replace("1/0", "0/1") for gt in genotypes
+                    ]
+                line = f"chr1\t{pos}\t.\tA\tG\t50\tPASS\t.\tGT:DP\t"
+                out1.write(line + "\t".join(f"{gt}:10" for gt in genotypes) + "\n")
+                if pos != 100:
+                    out2.write(line + "\t".join(f"{gt}:9" for gt in reversed(genotypes2)) + "\n")
+
+        with VcfReader(vcf1) as reader1, VcfReader(vcf2) as reader2:
+            result = genotype_concordance(reader1, reader2, block_size=7)
+        assert (result.both, result.only1, result.only2) == (99, 1, 0)
+        assert result.genotypes == 800
+        assert result.discordant == [1, 1, 2, 1, 1, 1, 1, 1]
+        assert result.rate == 9 / 800
+        assert result.sample_rates()["S2"] == 0.02
+
+        VcfDataFile(vcf1, max_discordance_rate=0.02).assert_contents_equal(vcf2)
+        with pytest.raises(AssertionError) as excinfo:
+            VcfDataFile(vcf1, max_discordance_rate=0.01).assert_contents_equal(vcf2)
+        assert "S2 (2.00%)" in str(excinfo.value)
+        with pytest.raises(ValueError):
+            VcfDataFile(vcf1, fields=["QUAL"], max_discordance_rate=0.01)
+
+        # A malformed genotype fails the comparison, naming the record and sample
+        vcf3 = temp / "foo3.vcf"
+        with open(vcf3, "wt") as out:
+            out.write(header)
+            out.write(
+                "chr1\t1\t.\tA\tG\t50\tPASS\t.\tGT\t" +
+                "\t".join(["0/1"] * 7 + ["./*"]) + "\n"
+            )
+        with pytest.raises(AssertionError) as excinfo:
+            VcfDataFile(vcf1, max_discordance_rate=0.5).assert_contents_equal(vcf3)
+        assert str(excinfo.value) == (
+            f"Invalid genotype './*' of sample S7 at chr1:1 A>G in {vcf3}"
+        )
+
+        # Sites-only files have no genotypes to compare
+        sites1 = temp / "sites1.vcf"
+        sites2 = temp / "sites2.vcf"
+        for path, pos in ((sites1, 1), (sites2, 2)):
+            with open(path, "wt") as out:
+                out.write(
+                    "##fileformat=VCFv4.2\n"
+                    "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+                    f"chr1\t{pos}\t.\tA\tG\t50\tPASS\t.\n"
+                )
+        with pytest.raises(AssertionError) as excinfo:
+            VcfDataFile(sites1, max_discordance_rate=0.5).assert_contents_equal(
+                sites2
+            )
+        assert "have no samples" in str(excinfo.value)
+
+
+def test_encode_genotypes():
+    pytest.importorskip("numpy")
+    codes = {}
+    alleles = {}
+    encoded = _encode_genotypes(
+        [
+            "0/1:10", "1|0", "", ".", "./.:3:4", "10/11/12/13:1", "13|12|11|10",
+            "0/1:9:9"
+        ],
+        codes, alleles
+    )
+    assert encoded.tolist() == [0, 0, -1, -1, -1, 1, 1, 0]
+    assert codes == {
+        "": -1, ".": -1, "./.": -1, "0/1": 0, "1|0": 0, "10/11/12/13": 1,
+        "13|12|11|10": 1
+    }
+    # Known genotypes keep their codes
+    assert _encode_genotypes(["1/1", "1|0:5"], codes, alleles).tolist() == [2, 0]
+    with pytest.raises(AssertionError) as excinfo:
+        _encode_genotypes(["0/1", "0/x:1"], codes, alleles, lambda i: f"#{i}")
+    assert str(excinfo.value) == "Invalid genotype '0/x' of #1"
+
+
 @pytest.mark.skipif(no_internet, reason="no internet available")
 def test_vcf(workflow_data, workflow_runner):
     workflow_runner(